@@ -0,0 +1,227 @@
+""" Benchmark otp_to_ott.Plan building and serialization over the recorded OTP responses in tests/data
+
+    examples:
+      bin/plan_bench
+      bin/plan_bench -n 50 plan_bike_wes
+      bin/plan_bench --compare /tmp/old_otp_to_ott.py   (e.g., git show <rev>:ott/otp_client/otp_to_ott.py)
+      bin/plan_bench --save-baseline                    (after an intended perf change, or on new hardware)
+      bin/plan_bench --check --threshold 0.25           (exits 1 when a fixture is 25% slower / bigger than baseline)
+
+    for each fixture: Plan parse and json serialize times (ms and ops/sec), the time spent building the Leg, Step,
+    Elevation and Alert objects within a parse, and the plan's memory / peak memory while serializing
+
+    --compare runs the same fixtures through another version of otp_to_ott.py, serialized the old way, via
+    json_utils.json_repr() walking each object's __dict__, and prints the time / allocation savings side by side
+
+    NOTE: baseline.json holds the results of the last --save-baseline run ... timings are machine specific, so
+          re-baseline on the machine doing the --check runs
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+import tracemalloc
+import importlib.util
+import simplejson as json
+
+from ott.utils import json_utils
+from ott.otp_client import otp_to_ott
+
+import logging
+log = logging.getLogger(__file__)
+
+
+CLASS_NAMES = ('Leg', 'Step', 'Elevation', 'Alert')
+
+
+def get_data_dir():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests', 'data')
+
+
+def get_fixtures(names=None):
+    """ :return: list of (name, otp json dict) for each recorded plan, e.g., ('new/pdx2ohsu', {...}) """
+    ret_val = []
+    for f in sorted(glob.glob(os.path.join(get_data_dir(), '*', '*.json'))):
+        name = "{}/{}".format(os.path.basename(os.path.dirname(f)), os.path.basename(f)[:-5])
+        if 'adverts' in name:
+            continue
+        if names and not any(n in name for n in names):
+            continue
+        with open(f) as fp:
+            ret_val.append((name, json.load(fp)))
+    return ret_val
+
+
+def load_module(file_path, name='compare_otp_to_ott'):
+    """ load an alternate version of otp_to_ott.py for comparison runs """
+    spec = importlib.util.spec_from_file_location(name, file_path)
+    ret_val = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(ret_val)
+    return ret_val
+
+
+def serialize(module, plan, pretty=False):
+    """ new plan classes have to_json() ... older (__dict__ based) ones go thru json_repr's reflection """
+    if hasattr(plan, 'to_json'):
+        return plan.to_json(pretty)
+    return json_utils.json_repr(plan, pretty)
+
+
+def time_it(func, num, repeat=3):
+    """ :return: avg milliseconds per call (best of 'repeat' runs of 'num' calls) """
+    ret_val = None
+    for r in range(repeat):
+        start = time.perf_counter()
+        for i in range(num):
+            func()
+        ms = (time.perf_counter() - start) * 1000.0 / num
+        if ret_val is None or ms < ret_val:
+            ret_val = ms
+    return ret_val
+
+
+def class_times(module, jsn, num=20, class_names=CLASS_NAMES):
+    """ :return: dict of the avg milliseconds (per Plan) spent constructing each class (inclusive of what it builds) """
+    totals = dict((c, 0.0) for c in class_names)
+    originals = {}
+
+    def timed(name, init):
+        def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            init(self, *args, **kwargs)
+            totals[name] += time.perf_counter() - start
+        return wrapper
+
+    for c in class_names:
+        cls = getattr(module, c, None)
+        if cls is not None:
+            originals[c] = cls.__dict__.get('__init__')
+            cls.__init__ = timed(c, cls.__init__)
+    try:
+        for i in range(num):
+            module.Plan(jsn['plan'])
+    finally:
+        for c, init in originals.items():
+            cls = getattr(module, c)
+            if init is None:
+                del cls.__init__
+            else:
+                cls.__init__ = init
+    return dict((c, totals[c] * 1000.0 / num) for c in class_names)
+
+
+def measure(module, jsn, num=20):
+    """ :return: dict of parse / serialize times (ms and ops/sec), per class times and allocation stats (KB) """
+    ret_val = {}
+    ret_val['parse_ms'] = time_it(lambda: module.Plan(jsn['plan']), num)
+    plan = module.Plan(jsn['plan'])
+    ret_val['json_ms'] = time_it(lambda: serialize(module, plan), num)
+    ret_val['parse_ops'] = 1000.0 / ret_val['parse_ms'] if ret_val['parse_ms'] else 0.0
+    ret_val['json_ops'] = 1000.0 / ret_val['json_ms'] if ret_val['json_ms'] else 0.0
+    del plan
+
+    ret_val['class_ms'] = class_times(module, jsn, num)
+
+    tracemalloc.start()
+    plan = module.Plan(jsn['plan'])
+    ret_val['plan_kb'] = tracemalloc.get_traced_memory()[0] / 1024.0
+    out = serialize(module, plan)
+    ret_val['peak_kb'] = tracemalloc.get_traced_memory()[1] / 1024.0
+    tracemalloc.stop()
+    ret_val['out_bytes'] = len(out)
+    return ret_val
+
+
+def get_baseline_path():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def load_baseline(file_path=None):
+    ret_val = {}
+    file_path = file_path or get_baseline_path()
+    if os.path.exists(file_path):
+        with open(file_path) as f:
+            ret_val = json.load(f)
+    return ret_val
+
+
+def save_baseline(results, file_path=None):
+    keep = ('parse_ms', 'json_ms', 'peak_kb', 'out_bytes')
+    baseline = dict((name, dict((k, round(m[k], 3)) for k in keep)) for name, m in results.items())
+    with open(file_path or get_baseline_path(), 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+
+def find_regressions(results, baseline, threshold=0.2, mem_threshold=0.1):
+    """ :return: list of messages for each fixture metric that's more than threshold (fraction) over its baseline """
+    ret_val = []
+    for name, m in sorted(results.items()):
+        b = baseline.get(name)
+        if not b:
+            continue
+        for k, t in (('parse_ms', threshold), ('json_ms', threshold), ('peak_kb', mem_threshold)):
+            if k in b and b[k] > 0 and m[k] > b[k] * (1.0 + t):
+                ret_val.append("{} {} regressed: {:.2f} vs baseline {:.2f} (+{:.0%})".format(name, k, m[k], b[k], m[k] / b[k] - 1.0))
+    return ret_val
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='plan_bench', description=__doc__.split('\n')[0])
+    parser.add_argument('fixtures', nargs='*', help='substring(s) of fixture names to run (default all)')
+    parser.add_argument('-n', '--num', type=int, default=20, help='iterations per timing')
+    parser.add_argument('--compare', help='path to another otp_to_ott.py to compare against')
+    parser.add_argument('--baseline', help='baseline results file (default bench/baseline.json)')
+    parser.add_argument('--save-baseline', action='store_true', help='save these results as the baseline')
+    parser.add_argument('--check', action='store_true', help='exit 1 when a fixture regresses past the threshold')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed time regression (fraction of baseline)')
+    parser.add_argument('--mem-threshold', type=float, default=0.1, help='allowed peak memory regression')
+    parser.add_argument('--retries', type=int, default=2, help='re-measure regressed fixtures this many times')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)  # the fixtures have known-bad alerts, etc..., which log a lot
+    other = load_module(args.compare) if args.compare else None
+
+    fmt = "{:28} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}   {}"
+    print(fmt.format('fixture', 'parse ms', 'parse/s', 'json ms', 'json/s', 'plan KB', 'peak KB', 'class ms'))
+    results = {}
+    for name, jsn in get_fixtures(args.fixtures):
+        m = measure(otp_to_ott, jsn, args.num)
+        results[name] = m
+        classes = " ".join("{}={:.2f}".format(c, v) for c, v in m['class_ms'].items())
+        print(fmt.format(name, "{:.2f}".format(m['parse_ms']), "{:.0f}".format(m['parse_ops']),
+                         "{:.2f}".format(m['json_ms']), "{:.0f}".format(m['json_ops']),
+                         "{:.0f}".format(m['plan_kb']), "{:.0f}".format(m['peak_kb']), classes))
+        if other:
+            o = measure(other, jsn, args.num)
+            print(fmt.format('  (compare)', "{:.2f}".format(o['parse_ms']), "{:.0f}".format(o['parse_ops']),
+                             "{:.2f}".format(o['json_ms']), "{:.0f}".format(o['json_ops']),
+                             "{:.0f}".format(o['plan_kb']), "{:.0f}".format(o['peak_kb']), ""))
+            if o['out_bytes'] != m['out_bytes']:
+                print("  WARNING: output size differs ({} vs {} bytes)".format(m['out_bytes'], o['out_bytes']))
+
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        print("saved baseline to {}".format(args.baseline or get_baseline_path()))
+    elif args.check:
+        baseline = load_baseline(args.baseline)
+        regressions = find_regressions(results, baseline, args.threshold, args.mem_threshold)
+        for i in range(args.retries):
+            # timings are noisy, so re-measure the regressed fixtures (keeping their best numbers) before failing
+            if not regressions:
+                break
+            fixtures = dict(get_fixtures())
+            for name in set(r.split()[0] for r in regressions):
+                m = measure(otp_to_ott, fixtures[name], args.num)
+                for k in ('parse_ms', 'json_ms', 'peak_kb'):
+                    results[name][k] = min(results[name][k], m[k])
+            regressions = find_regressions(results, baseline, args.threshold, args.mem_threshold)
+        for r in regressions:
+            print(r)
+        if regressions:
+            sys.exit(1)
+        print("no regressions (threshold {:.0%})".format(args.threshold))
+
+
+if __name__ == '__main__':
+    main()
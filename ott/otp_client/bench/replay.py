@@ -0,0 +1,262 @@
+""" Load replay: drive the pyramid app with recorded requests, and report throughput and latency per route
+
+    requests are read from .jsonl logs (one {"url": ..., "method": ..., "body": ...} per line) or url lists (like
+    tests/data/json/urls.txt) ... urls that aren't one of our routes (e.g., old OTP / planner urls) get replayed as
+    /plan_trip calls with the same query string
+
+    modes:
+      in-process (default): calls the WSGI app built by pyramid.app.main from the .ini directly
+      --serve:              serves that app with waitress (using the .ini's threads / connection_limit) and replays
+                            over HTTP ... e.g., to size the waitress settings
+      --url:                replays over HTTP against an already running server
+
+    examples:
+      bin/replay_load config/stub.ini ott/otp_client/tests/data/json/urls.txt -n 500 -c 20
+      bin/replay_load config/stub.ini access_log.jsonl --serve --threads 50 --rate 100
+"""
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import threading
+import simplejson as json
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+import logging
+log = logging.getLogger(__file__)
+
+
+class Route(object):
+    def __init__(self, name, pattern):
+        self.name = name
+        self.regex = re.compile('^' + re.sub(r'\{\w+\}', '[^/]+?', pattern) + '$')
+
+
+class RouteCollector(object):
+    """ stands in for the pyramid Configurator in views.do_view_config(), collecting the app's routes (in order) """
+    def __init__(self):
+        self.routes = []
+
+    def add_route(self, name, pattern, **kwargs):
+        self.routes.append(Route(name, pattern))
+
+    def add_tween(self, *args, **kwargs):
+        pass
+
+    @classmethod
+    def get_routes(cls):
+        from ott.otp_client.pyramid import views
+        ret_val = cls()
+        views.do_view_config(ret_val)
+        return ret_val.routes
+
+
+def route_name(routes, path):
+    """ :return: name of the (first) route matching the path, else None """
+    for r in routes:
+        if r.regex.match(path):
+            return r.name
+    return None
+
+
+def read_requests(file_paths, routes):
+    """ :return: list of (route name, method, path with query, body) to replay """
+    ret_val = []
+    for file_path in file_paths:
+        with open(file_path) as f:
+            for line in f:
+                line = line.strip()
+                method, body = 'GET', None
+                if line.startswith('{'):
+                    r = json.loads(line)
+                    url = r.get('url') or r.get('path')
+                    method = r.get('method', method).upper()
+                    body = r.get('body')
+                else:
+                    m = re.search(r'(https?://\S+|/\S+\?\S+)', line)
+                    url = m.group(1).strip('"\'') if m else None
+                if not url:
+                    continue
+
+                u = urlparse(url)
+                path = u.path.rstrip('/') or '/'
+                name = route_name(routes, path)
+                if name is None:
+                    name, path = 'plan_trip', '/plan_trip'
+                if u.query:
+                    path = "{}?{}".format(path, u.query)
+                ret_val.append((name, method, path, body))
+    return ret_val
+
+
+class Stats(object):
+    """ latency samples (ms) and error counts per route """
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, ms, is_error):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(ms)
+            if is_error:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    @classmethod
+    def percentile(cls, sorted_vals, pct):
+        i = min(int(round(pct / 100.0 * len(sorted_vals) + 0.5)) - 1, len(sorted_vals) - 1)
+        return sorted_vals[max(i, 0)]
+
+    def report(self, secs):
+        """ :return: list of dicts (one per route, plus 'ALL') of count, errors, req/sec and p50 / p95 / p99 ms """
+        ret_val = []
+        everything = []
+        for name in sorted(self.latencies):
+            everything.extend(self.latencies[name])
+        for name, lats in sorted(self.latencies.items()) + [('ALL', everything)]:
+            s = sorted(lats)
+            errors = sum(self.errors.values()) if name == 'ALL' else self.errors.get(name, 0)
+            ret_val.append({
+                'route': name, 'count': len(s), 'errors': errors, 'rps': round(len(s) / secs, 1) if secs else 0.0,
+                'p50': round(self.percentile(s, 50), 1), 'p95': round(self.percentile(s, 95), 1),
+                'p99': round(self.percentile(s, 99), 1), 'max': round(s[-1], 1)
+            })
+        return ret_val
+
+
+def wsgi_caller(app):
+    """ :return: function making an in-process request to the WSGI app ... returns the http status """
+    from webob import Request
+
+    def call(method, path, body):
+        req = Request.blank(path, method=method)
+        if body is not None:
+            req.body = body.encode('utf-8') if not isinstance(body, bytes) else body
+            req.content_type = 'application/json'
+        resp = req.get_response(app)
+        resp.body  # read any streamed (app_iter) response
+        return resp.status_int
+    return call
+
+
+def http_caller(base_url, pool_size):
+    """ :return: function making an http request to a running server ... returns the http status """
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_maxsize=pool_size))
+
+    def call(method, path, body):
+        resp = session.request(method, base_url + path, data=body, timeout=60)
+        return resp.status_code
+    return call
+
+
+def replay(caller, reqs, num=None, concurrency=10, rate=None, shuffle=False):
+    """ replay 'num' requests (cycling thru reqs) on 'concurrency' threads, optionally paced at 'rate' req/sec
+        :return: (Stats, elapsed secs)
+    """
+    stats = Stats()
+    num = num or len(reqs)
+    order = [reqs[i % len(reqs)] for i in range(num)]
+    if shuffle:
+        random.shuffle(order)
+
+    start = time.time()
+
+    def do_request(i):
+        name, method, path, body = order[i]
+        if rate:
+            wait = start + i / float(rate) - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        t = time.time()
+        try:
+            status = caller(method, path, body)
+            is_error = status >= 500
+        except Exception as e:
+            log.debug(e)
+            is_error = True
+        stats.add(name, (time.time() - t) * 1000.0, is_error)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(do_request, range(num)))
+    return stats, time.time() - start
+
+
+def print_report(report, out=sys.stdout):
+    out.write("{:<32} {:>7} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8}\n".format('route', 'count', 'errors', 'req/sec', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for r in report:
+        out.write("{route:<32} {count:>7} {errors:>6} {rps:>8} {p50:>8} {p95:>8} {p99:>8} {max:>8}\n".format(**r))
+
+
+def server_settings(ini):
+    """ :return: the [server:main] settings (e.g., waitress threads and connection_limit) from an .ini file """
+    ret_val = {}
+    try:
+        from paste.deploy.loadwsgi import loadcontext, SERVER
+        ret_val = loadcontext(SERVER, 'config:' + os.path.abspath(ini)).config()
+    except Exception as e:
+        log.warning("couldn't read the [server:main] settings from {}: {}".format(ini, e))
+    return ret_val
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='replay_load', description='replay recorded requests against the app')
+    parser.add_argument('ini', help='app .ini file, e.g., config/stub.ini')
+    parser.add_argument('logs', nargs='+', help='.jsonl request logs and / or url lists')
+    parser.add_argument('--num', '-n', type=int, default=None, help='number of requests (cycles thru the logs)')
+    parser.add_argument('--concurrency', '-c', type=int, default=10)
+    parser.add_argument('--rate', '-r', type=float, default=None, help='requests per second (default: as fast as possible)')
+    parser.add_argument('--shuffle', action='store_true')
+    parser.add_argument('--serve', action='store_true', help='serve the app with waitress, and replay over http')
+    parser.add_argument('--threads', type=int, default=None, help='waitress threads (default: from the .ini)')
+    parser.add_argument('--connection-limit', type=int, default=None, help='waitress connection_limit (default: from the .ini)')
+    parser.add_argument('--port', type=int, default=54447)
+    parser.add_argument('--url', default=None, help='replay against a running server, e.g. http://localhost:54445')
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    args = parser.parse_args()
+
+    reqs = read_requests(args.logs, RouteCollector.get_routes())
+    if not reqs:
+        sys.exit("no requests found in {}".format(args.logs))
+
+    server = None
+    if args.url:
+        caller = http_caller(args.url.rstrip('/'), args.concurrency)
+    else:
+        from pyramid.paster import get_app
+        app = get_app(args.ini, 'main')
+        if args.serve:
+            import waitress
+            svr_cfg = server_settings(args.ini)
+            threads = args.threads or int(svr_cfg.get('threads', 200))
+            limit = args.connection_limit or int(svr_cfg.get('connection_limit', 200))
+            server = waitress.create_server(app, host='127.0.0.1', port=args.port, threads=threads, connection_limit=limit)
+            t = threading.Thread(target=server.run, name='waitress')
+            t.daemon = True
+            t.start()
+            caller = http_caller("http://127.0.0.1:{}".format(args.port), args.concurrency)
+        else:
+            caller = wsgi_caller(app)
+
+    stats, secs = replay(caller, reqs, args.num, args.concurrency, args.rate, args.shuffle)
+    report = stats.report(secs)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+        print("{} requests in {:.1f} secs".format(report[-1]['count'], secs))
+    if server:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
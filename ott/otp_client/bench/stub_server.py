@@ -0,0 +1,189 @@
+""" Local stand-in for the OTP and SOLR servers, serving the recorded responses in tests/data, for offline (and
+    repeatable) benchmarking of TripPlanner and the pyramid app ... see config/stub.ini
+
+    routes:
+      .../plan?...                    recorded OTP plan from tests/data/json or tests/data/new (picked by a hash of the
+                                      from / to places, or by name with &fixture=pdx2ohsu)
+      .../index/...                   OTP transit index stand-ins (e.g., routes/<id>/patterns)
+      /solr/select?q=...              geocoder answer, as a SOLR doc (name, lat, lon)
+      /adverts/..., /fares.json, /cancelled_routes.json    content
+
+    examples:
+      bin/stub_otp_server
+      bin/stub_otp_server --port 54446 --latency 150 --jitter 50 --error-rate 0.01
+"""
+import os
+import sys
+import glob
+import time
+import zlib
+import random
+import argparse
+import threading
+import simplejson as json
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+from ott.otp_client.bench.plan_bench import get_data_dir
+
+import logging
+log = logging.getLogger(__file__)
+
+
+PLACES = {
+    'pdx': ("PDX", 45.587546, -122.592925),
+    'ohsu': ("Oregon Health & Science University", 45.499218, -122.685160),
+    'zoo': ("Oregon Zoo", 45.509167, -122.713250),
+    'pge park': ("Providence Park", 45.521434, -122.691791),
+    'union station': ("Union Station", 45.528749, -122.676946),
+}
+
+
+class Fixtures(object):
+    """ the recorded OTP plans (raw bytes), plus the advert content, from tests/data """
+    def __init__(self, data_dir=None, dirs=('json', 'new')):
+        data_dir = data_dir or get_data_dir()
+        self.plans = []
+        self.content = {}
+        for d in dirs:
+            for f in sorted(glob.glob(os.path.join(data_dir, d, '*.json'))):
+                name = os.path.basename(f)[:-5]
+                with open(f, 'rb') as fp:
+                    body = fp.read()
+                if name.startswith('adverts'):
+                    self.content[name] = body
+                else:
+                    self.plans.append((name, body))
+
+    def plan(self, query):
+        """ :return: a recorded plan ... by name (fixture=<name>), else (repeatably) picked from the from / to places """
+        name = query.get('fixture')
+        if name:
+            for n, body in self.plans:
+                if n == name:
+                    return body
+        key = "{}|{}".format(query.get('fromPlace', ''), query.get('toPlace', ''))
+        return self.plans[zlib.crc32(key.encode('utf-8')) % len(self.plans)][1]
+
+    @classmethod
+    def geocode(cls, search):
+        """ :return: SOLR doc for a (known landmark, or else a made up, but repeatable Portland-ish) place """
+        s = " ".join(search.lower().split())
+        if s in PLACES:
+            name, lat, lon = PLACES[s]
+        else:
+            h = zlib.crc32(s.encode('utf-8'))
+            name, lat, lon = search, 45.45 + (h % 1000) / 10000.0, -122.75 + (h // 1000 % 1000) / 5000.0
+        return {'name': name, 'lat': lat, 'lon': lon, 'type': 'landmark', 'score': 1.0}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """ serves fixtures (see do_GET) after the server's artificial latency, jitter and error rate """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        path = url.path.rstrip('/')
+        svr = self.server
+
+        # step 1: artificial latency (+/- jitter) and errors
+        delay = svr.latency + random.uniform(-svr.jitter, svr.jitter)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+        if svr.error_rate > 0 and random.random() < svr.error_rate:
+            return self.send_body(b'{"error": "stub server error"}', 500)
+
+        # step 2: route to the fixture
+        if path.endswith('/plan'):
+            body = svr.fixtures.plan(query)
+        elif '/index/' in path:
+            body = self.index(path)
+        elif path.endswith('/select'):
+            doc = svr.fixtures.geocode(query.get('q', ''))
+            body = json.dumps({'response': {'numFound': 1, 'start': 0, 'docs': [doc]}})
+        elif path.endswith('fares.json'):
+            body = b'{}'
+        elif path.endswith('cancelled_routes.json'):
+            body = b'[]'
+        elif '/adverts' in path:
+            name = os.path.basename(path).replace('.json', '')
+            body = svr.fixtures.content.get(name) or svr.fixtures.content.get('adverts_bus', b'{}')
+        else:
+            return self.send_body(b'{"error": "not found"}', 404)
+        return self.send_body(body)
+
+    def index(self, path):
+        """ OTP transit index stand-ins """
+        ret_val = []
+        parts = path.split('/')
+        if path.endswith('/patterns') and 'routes' in parts:
+            route = parts[parts.index('routes') + 1]
+            ret_val = [{'id': "{}:0:01".format(route), 'desc': "stub pattern for {}".format(route)}]
+        return json.dumps(ret_val)
+
+    def send_body(self, body, status=200):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """ threaded OTP / SOLR stand-in ... latency and jitter are in milliseconds, error_rate is 0.0 to 1.0 """
+    daemon_threads = True
+
+    def __init__(self, port=54446, latency=0.0, jitter=0.0, error_rate=0.0, fixtures=None, host='127.0.0.1'):
+        HTTPServer.__init__(self, (host, port), StubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.fixtures = fixtures or Fixtures()
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def start(self):
+        """ serve from a background (daemon) thread ... e.g., for tests and in-process benchmarks """
+        t = threading.Thread(target=self.serve_forever, name='stub-server')
+        t.daemon = True
+        t.start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='stub_otp_server', description='local OTP + SOLR stand-in, serving tests/data')
+    parser.add_argument('--port', '-p', type=int, default=54446)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--latency', '-l', type=float, default=0.0, help='added latency (ms)')
+    parser.add_argument('--jitter', '-j', type=float, default=0.0, help='+/- random latency (ms)')
+    parser.add_argument('--error-rate', '-e', type=float, default=0.0, help='fraction of requests returning a 500')
+    parser.add_argument('--seed', type=int, default=None, help='random seed, for repeatable jitter / errors')
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    svr = StubServer(args.port, args.latency, args.jitter, args.error_rate, host=args.host)
+    print("stub OTP at {0}/otp_prod/plan and SOLR at {0}/solr ({1} recorded plans)".format(svr.url, len(svr.fixtures.plans)))
+    try:
+        svr.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
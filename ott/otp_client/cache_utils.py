@@ -0,0 +1,163 @@
+""" Small, thread-safe in-process caches (for the waitress worker threads)
+"""
+import time
+import threading
+from collections import OrderedDict
+
+from ott.otp_client.settings_utils import is_true
+
+import logging
+log = logging.getLogger(__file__)
+
+
+MISSING = object()
+
+
+class TtlLruCache(object):
+    """ bounded, thread-safe cache, with both a time-to-live (seconds) on each entry and LRU eviction once full
+
+        get() returns MISSING (or a supplied default) for a cache miss, so None is a legit cached value (e.g., for
+        negative caching).  Counters for hits, misses, evictions (LRU) and expirations (TTL) are kept in stats().
+    """
+    def __init__(self, max_size=1000, ttl=60, name=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, def_val=MISSING):
+        ret_val = def_val
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] < now:
+                del self._data[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+                ret_val = entry[1]
+        return ret_val
+
+    def put(self, key, value, ttl=None):
+        """ add an entry, with an optional per-entry ttl (seconds), evicting the least recently used if full """
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.time() + ttl
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def remove(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'name': self.name, 'size': len(self._data), 'max_size': self.max_size, 'ttl': self.ttl,
+            'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'expirations': self.expirations
+        }
+
+    @classmethod
+    def from_settings(cls, settings, prefix, max_size=1000, ttl=60):
+        """ build a cache from .ini settings like <prefix>_size and <prefix>_ttl ... a size of 0 turns it off
+            :return: cache object or None
+        """
+        ret_val = None
+        size = int(settings.get('{}_size'.format(prefix), max_size))
+        if size > 0:
+            ttl = float(settings.get('{}_ttl'.format(prefix), ttl))
+            ret_val = cls(max_size=size, ttl=ttl, name=prefix)
+        return ret_val
+
+
+class SingleFlight(object):
+    """ request coalescing: concurrent calls with the same key share the one (in-flight) call's result
+
+        the first caller of do() for a key (the leader) runs the function; callers arriving while it's in flight
+        wait (up to 'timeout' seconds) for the leader's result instead of making their own call ... a waiter that
+        times out goes ahead and makes its own call.  Counters are kept in stats().
+    """
+    class Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, timeout=30, name=None):
+        self.timeout = timeout
+        self.name = name
+        self.calls = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """ :return: func(*args, **kwargs), or the result of an identical (same key) call already in flight """
+        is_leader = False
+        with self._lock:
+            call = self._in_flight.get(key)
+            if call is None:
+                is_leader = True
+                call = self.Call()
+                self._in_flight[key] = call
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if is_leader:
+            try:
+                call.result = func(*args, **kwargs)
+            except Exception as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._in_flight[key]
+                call.done.set()
+            return call.result
+
+        if not call.done.wait(self.timeout):
+            with self._lock:
+                self.timeouts += 1
+            log.info("{}: timed out waiting on an in-flight call ... making our own".format(self.name))
+            return func(*args, **kwargs)
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def in_flight(self):
+        return len(self._in_flight)
+
+    def stats(self):
+        return {
+            'name': self.name, 'calls': self.calls, 'coalesced': self.coalesced, 'timeouts': self.timeouts,
+            'in_flight': len(self._in_flight)
+        }
+
+    @classmethod
+    def from_settings(cls, settings, prefix, timeout=30):
+        """ build from .ini settings <prefix> (true / false) and <prefix>_timeout ... :return: SingleFlight or None """
+        ret_val = None
+        if is_true(settings.get(prefix, 'true')):
+            ret_val = cls(timeout=float(settings.get('{}_timeout'.format(prefix), timeout)), name=prefix)
+        return ret_val
@@ -0,0 +1,144 @@
+""" Background refresh of the (remote) content used to decorate trip plans: adverts, fares and cancelled routes
+
+    each content source is re-built on its own schedule by a daemon thread, and swapped in as a new snapshot only
+    after a good load ... so plan_trip() only ever reads the last good snapshot, and never waits on (or is slowed by a
+    failing) adverts / fares / cancelled routes fetch
+
+    .ini settings: content_refresh_secs (0 turns off background refresh ... content is then loaded once, up front)
+                   and content_langs (languages to pre-query the adverts for)
+"""
+import time
+import threading
+
+from ott.otp_client.cache_utils import MISSING
+
+import logging
+log = logging.getLogger(__file__)
+
+
+ADVERT_MODES = ('rail', 'bus', 'walk', 'bicycle', 'car', 'ferry')
+
+
+class ContentSnapshot(object):
+    """ read-only snapshot of a content object (e.g., ott.data.content.Fares), with the answers to its common
+        query(...) calls made up front (in the refresh thread) rather than at request time
+    """
+    def __init__(self, content, queries=()):
+        self.content = content
+        answers = {}
+        for q in queries:
+            answers[q] = content.query(*q)
+        self._answers = answers
+
+    def query(self, *args):
+        ret_val = self._answers.get(args, MISSING)
+        if ret_val is MISSING:
+            ret_val = self.content.query(*args)
+        return ret_val
+
+
+class Source(object):
+    """ a named content source: factory() builds a new content object, refreshed every 'interval' seconds """
+    def __init__(self, name, factory, interval=300, queries=None):
+        self.name = name
+        self.factory = factory
+        self.interval = interval
+        self.queries = queries
+        self.next_load = 0
+        self.last_load = None
+        self.last_error = None
+        self.loads = 0
+        self.failures = 0
+
+    def load(self):
+        """ :return: new snapshot (raises if the content can't be built) """
+        content = self.factory()
+        if content is None:
+            raise ValueError("{} content is empty".format(self.name))
+        if self.queries is not None:
+            content = ContentSnapshot(content, self.queries)
+        return content
+
+
+class ContentRefresher(object):
+    """ holds the current snapshot of each content source, refreshing them in a background thread
+
+        snapshots live in a dict that's replaced (never changed in place) on every refresh, so readers see either
+        the old or the new snapshot, without locking
+    """
+    def __init__(self, retry=30):
+        self.retry = retry
+        self.sources = []
+        self._snapshots = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_source(self, name, factory, interval=300, queries=None):
+        self.sources.append(Source(name, factory, interval, queries))
+
+    def get(self, name, def_val=None):
+        return self._snapshots.get(name, def_val)
+
+    def set(self, name, content):
+        with self._lock:
+            snapshots = dict(self._snapshots)
+            snapshots[name] = content
+            self._snapshots = snapshots
+
+    def refresh(self, source):
+        """ re-build a source, keeping the last good snapshot on failure ... :return: True on a good load """
+        ret_val = False
+        now = time.time()
+        try:
+            content = source.load()
+            self.set(source.name, content)
+            source.last_load = now
+            source.loads += 1
+            source.next_load = now + source.interval
+            ret_val = True
+        except Exception as e:
+            source.last_error = str(e)
+            source.failures += 1
+            source.next_load = now + min(self.retry, source.interval)
+            log.warning("couldn't refresh {} content (keeping the last good copy): {}".format(source.name, e))
+        return ret_val
+
+    def refresh_all(self, due_only=False):
+        now = time.time()
+        for s in self.sources:
+            if not due_only or s.next_load <= now:
+                self.refresh(s)
+
+    def run(self):
+        while not self._stop.is_set():
+            self.refresh_all(due_only=True)
+            wait = min([s.next_load for s in self.sources] or [time.time() + 60]) - time.time()
+            self._stop.wait(min(max(wait, 1.0), 60.0))
+
+    def is_loaded(self):
+        """ :return: True once every source has had a good load (e.g., before that, plans lack fares and adverts) """
+        return all(s.loads for s in self.sources)
+
+    def start(self):
+        """ do the first load of each source (here, so content is there from the first request), and then start the
+            background refresh thread
+        """
+        if self._thread is None:
+            self.refresh_all()
+            self._thread = threading.Thread(target=self.run, name='content-refresher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        now = time.time()
+        ret_val = []
+        for s in self.sources:
+            ret_val.append({
+                'name': s.name, 'loads': s.loads, 'failures': s.failures, 'last_error': s.last_error,
+                'age': round(now - s.last_load, 1) if s.last_load else None
+            })
+        return ret_val
@@ -0,0 +1,204 @@
+""" Elevation profile engine for walk / bike legs
+
+    OTP gives each step of a leg a list of (distance, elevation) pairs, where the distance is relative to the start of
+    the step.  make_profile() pulls those pairs out of the steps in a single pass (handling both the OTP 0.10 / 1.x
+    [{"first": d, "second": e}] lists and the newer "d,e,d,e" string format), builds a distance-indexed profile
+    for the whole leg, then computes the high / low / rise / fall marks, the steepest up and down grades and a
+    down-sampled profile string from that.
+
+    NOTE: numpy is optional (see setup.py extras) ... when it's installed, the (distance, elevation) pairs are
+          gathered into one flat list and converted (and rounded) in a single numpy call, rather than a float() and
+          round() per point, and the profile math for long profiles (bike legs, etc...) is vectorized; otherwise
+          (and for short profiles, where numpy's per-call overhead outweighs the loop) the same numbers are computed
+          with a single pure python loop
+"""
+import itertools
+from operator import itemgetter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import logging
+log = logging.getLogger(__file__)
+
+
+NUMPY_MIN_POINTS = 200
+
+
+PAIR = itemgetter('first', 'second')
+
+
+def parse_steps(steps):
+    """ single pass over the OTP steps
+        :return: (distances along the leg, elevations rounded to 2 places, total leg distance) ... the distances and
+                 elevations are numpy arrays when numpy is installed, else lists
+    """
+    if numpy is not None:
+        return _numpy_parse_steps(steps)
+    return _python_parse_steps(steps)
+
+
+def _numpy_parse_steps(steps):
+    values = []  # flat list of each step's raw d,e,d,e values
+    offsets = []
+    counts = []
+    total = 0.0
+    for s in steps:
+        offset = total
+        total += s['distance']
+        e = s.get('elevation')
+        if not e:
+            continue
+        if isinstance(e, str):
+            v = e.split(',')
+            v = v[:len(v) // 2 * 2]
+        else:
+            v = list(itertools.chain.from_iterable(map(PAIR, e)))
+        values.extend(v)
+        offsets.append(offset)
+        counts.append(len(v) // 2)
+
+    pairs = numpy.array(values, dtype=float).reshape(-1, 2)
+    dists = pairs[:, 0] + numpy.repeat(offsets, counts)
+    return dists, numpy.round(pairs[:, 1], 2), total
+
+
+def _python_parse_steps(steps):
+    dists = []
+    elevs = []
+    total = 0.0
+    for s in steps:
+        offset = total
+        total += s['distance']
+        e = s.get('elevation')
+        if not e:
+            continue
+        if isinstance(e, str):
+            v = e.split(',')
+            dists.extend([offset + float(d) for d in v[0:len(v) - 1:2]])
+            elevs.extend([round(float(d), 2) for d in v[1::2]])
+        else:
+            dists.extend([offset + p['first'] for p in e])
+            elevs.extend([round(p['second'], 2) for p in e])
+    return dists, elevs, total
+
+
+def make_profile(steps, max_points=50, min_run=5.0):
+    """ :return: dict with the leg's distance, profile points (array & down-sampled string), marks and max grades
+        :param min_run: minimum distance (meters) between two profile points for them to count towards a grade
+                        ... keeps a few cm of sample noise from turning into a 100% grade
+    """
+    ret_val = None
+    dists, elevs, total = parse_steps(steps)
+    if len(elevs) > 0:
+        if numpy is not None and len(elevs) >= NUMPY_MIN_POINTS:
+            ret_val = _numpy_profile(dists, elevs, max_points, min_run)
+            elevs = elevs.tolist()
+        else:
+            if numpy is not None:
+                dists, elevs = dists.tolist(), elevs.tolist()
+            ret_val = _python_profile(dists, elevs, max_points, min_run)
+        ret_val['points_array'] = elevs
+    else:
+        ret_val = {'points_array': None, 'points': None, 'grade': make_grade()}
+    ret_val['distance'] = total
+    return ret_val
+
+
+def make_grade(up=0, down=0, ue=0, ud=0, de=0, dd=0):
+    """ steepest up & down grades (percent), plus the elevation & distance where each of those grades starts """
+    return {'up': up, 'down': down, 'ue': ue, 'ud': ud, 'de': de, 'dd': dd}
+
+
+def num_per_slice(num_points, max_points):
+    """ :return: number of points to average together when down-sampling (or 1 when no down-sampling needed) """
+    ret_val = 1
+    if num_points > (max_points * 1.15):
+        ret_val = int(round(num_points / max_points))
+        if ret_val == 1:
+            ret_val = 2
+    return ret_val
+
+
+def points_string(points):
+    return ','.join(["{0:.2f}".format(p) for p in points])
+
+
+def _numpy_profile(d, e, max_points, min_run):
+    """ :param d: numpy array of distances, and e: numpy array of elevations (as per parse_steps()) """
+    # step 1: marks
+    diff = numpy.diff(e)
+    ret_val = {
+        'start': float(e[0]), 'end': float(e[-1]), 'high': float(e.max()), 'low': float(e.min()),
+        'rise': float(diff[diff > 0].sum()), 'fall': float(diff[diff < 0].sum())
+    }
+
+    # step 2: grades between profile points that are at least min_run apart
+    grade = make_grade()
+    if len(e) > 1:
+        run = numpy.diff(d)
+        ok = run >= min_run
+        g = numpy.where(ok, diff / numpy.where(ok, run, 1.0) * 100.0, 0.0)
+        u = int(g.argmax())
+        if g[u] > 0:
+            grade.update(up=round(float(g[u]), 1), ue=float(e[u]), ud=round(float(d[u]), 1))
+        w = int(g.argmin())
+        if g[w] < 0:
+            grade.update(down=round(float(g[w]), 1), de=float(e[w]), dd=round(float(d[w]), 1))
+    ret_val['grade'] = grade
+
+    # step 3: down-sample the profile (averaging each slice of points, including the last partial slice)
+    n = num_per_slice(len(e), max_points)
+    if n > 1:
+        starts = numpy.arange(0, len(e), n)
+        counts = numpy.diff(numpy.append(starts, len(e)))
+        points = (numpy.add.reduceat(e, starts) / counts).tolist()
+    else:
+        points = e.tolist()
+    ret_val['points'] = points_string(points)
+    return ret_val
+
+
+def _python_profile(dists, elevs, max_points, min_run):
+    start = last = high = low = elevs[0]
+    last_dist = dists[0]
+    rise = fall = 0.0
+    grade = make_grade()
+    for i in range(1, len(elevs)):
+        p = elevs[i]
+        if p > high:
+            high = p
+        if p < low:
+            low = p
+        if p > last:
+            rise += (p - last)
+        elif p < last:
+            fall += (p - last)
+
+        run = dists[i] - last_dist
+        if run >= min_run:
+            g = (p - last) / run * 100.0
+            if g > grade['up']:
+                grade.update(up=g, ue=last, ud=last_dist)
+            elif g < grade['down']:
+                grade.update(down=g, de=last, dd=last_dist)
+        last = p
+        last_dist = dists[i]
+
+    grade.update(up=round(grade['up'], 1), down=round(grade['down'], 1),
+                 ud=round(grade['ud'], 1), dd=round(grade['dd'], 1))
+
+    points = elevs
+    n = num_per_slice(len(elevs), max_points)
+    if n > 1:
+        points = []
+        for i in range(0, len(elevs), n):
+            s = elevs[i:i+n]
+            points.append(sum(s) / len(s))
+
+    return {
+        'start': start, 'end': elevs[-1], 'high': high, 'low': low, 'rise': rise, 'fall': fall,
+        'grade': grade, 'points': points_string(points)
+    }
@@ -0,0 +1,108 @@
+""" Geocoder helpers for the trip planner
+"""
+import threading
+import contextlib
+
+from ott.utils import json_utils
+from ott.geocoder.geosolr import GeoSolr
+from ott.otp_client.cache_utils import TtlLruCache
+from ott.otp_client.cache_utils import MISSING
+
+import logging
+log = logging.getLogger(__file__)
+
+
+class PooledGeoSolr(GeoSolr):
+    """ GeoSolr, with its SOLR requests sent over a shared, keep-alive HttpPool (see http_utils.py)
+
+        GeoSolr fetches its SOLR json via ott.utils.json_utils.stream_json() ... while one of our geostr() calls is
+        running, that thread's stream_json() calls are handed to the pool instead (see pooled_stream_json), so the
+        query building and parsing of the SOLR docs stay GeoSolr's own
+        NOTE: on by default ... 'solr_pooled = false' in the .ini goes back to plain GeoSolr
+    """
+    def __init__(self, url, pool):
+        super(PooledGeoSolr, self).__init__(url)
+        self.pool = pool
+        install_pooled_stream_json()
+
+    def geostr(self, search, def_val=None):
+        with pooled(self.pool):
+            return super(PooledGeoSolr, self).geostr(search, def_val)
+
+
+POOLED = threading.local()
+STREAM_JSON = None
+
+
+@contextlib.contextmanager
+def pooled(pool):
+    """ send this thread's json_utils.stream_json() calls through the pool, for the duration of the block """
+    last = getattr(POOLED, 'pool', None)
+    POOLED.pool = pool
+    try:
+        yield pool
+    finally:
+        POOLED.pool = last
+
+
+def pooled_stream_json(url, args=None, *extra, **kwargs):
+    """ json_utils.stream_json(), via the thread's pool (see pooled()) when there is one """
+    pool = getattr(POOLED, 'pool', None)
+    if pool is None or extra or set(kwargs) - {'def_val'}:
+        return STREAM_JSON(url, args, *extra, **kwargs)
+    if args:
+        url = "{}{}{}".format(url, '&' if '?' in url else '?', args)
+    return pool.get_json(url, def_val=kwargs.get('def_val'))
+
+
+def install_pooled_stream_json():
+    """ wrap json_utils.stream_json (once), so pooled() can route its calls """
+    global STREAM_JSON
+    if STREAM_JSON is None and hasattr(json_utils, 'stream_json'):
+        STREAM_JSON = json_utils.stream_json
+        json_utils.stream_json = pooled_stream_json
+
+
+class CachingGeocoder(object):
+    """ TTL + LRU cache in front of a geocoder's geostr() (e.g., GeoSolr), keyed on the normalized place string
+
+        misses (no geocode found) are cached too, but for a shorter 'miss_ttl', so a repeated bad place name
+        doesn't keep going back to SOLR ... thread-safe, so a single instance is shared by all request threads
+        .ini settings: geocode_cache_size (0 turns caching off), geocode_cache_ttl and geocode_cache_miss_ttl (seconds)
+    """
+    def __init__(self, geo, cache, miss_ttl=60):
+        self.geo = geo
+        self.cache = cache
+        self.miss_ttl = miss_ttl
+
+    @classmethod
+    def normalize(cls, search):
+        """ ' PDX  Airport ' is 'pdx airport' """
+        return " ".join(search.split()).lower() if search else search
+
+    def geostr(self, search, def_val=None):
+        key = self.normalize(search)
+        ret_val = self.cache.get(key)
+        if ret_val is MISSING:
+            ret_val = self.geo.geostr(search)
+            if ret_val:
+                self.cache.put(key, ret_val)
+            else:
+                self.cache.put(key, None, ttl=self.miss_ttl)
+        if not ret_val:
+            ret_val = def_val
+        return ret_val
+
+    def __getattr__(self, name):
+        """ pass anything else along to the wrapped geocoder """
+        return getattr(self.geo, name)
+
+    @classmethod
+    def from_settings(cls, geo, settings, prefix='geocode_cache'):
+        """ :return: geo wrapped in a CachingGeocoder, or just geo when caching is turned off """
+        ret_val = geo
+        cache = TtlLruCache.from_settings(settings, prefix, max_size=5000, ttl=3600)
+        if cache is not None:
+            miss_ttl = float(settings.get('{}_miss_ttl'.format(prefix), 60))
+            ret_val = cls(geo, cache, miss_ttl)
+        return ret_val
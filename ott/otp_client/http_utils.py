@@ -0,0 +1,117 @@
+""" Shared, pooled (keep-alive) HTTP sessions ... one per backend (OTP, SOLR, etc...)
+
+    under waitress' 200 worker threads, opening a new TCP connection for every OTP / SOLR call adds up; HttpPool
+    wraps a requests.Session whose connection pool is shared by all threads, so connections get reused.
+
+    .ini settings (for a backend named 'otp' ... same for 'solr'):
+      otp_pool_size = 50           # max (idle) connections kept per host
+      otp_connect_timeout = 3.0    # seconds
+      otp_read_timeout = 30.0      # seconds
+      otp_keep_alive = true
+"""
+import time
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ott.otp_client.metrics import METRICS
+from ott.otp_client.settings_utils import is_true
+
+import logging
+log = logging.getLogger(__file__)
+
+
+class HttpPool(object):
+    """ thread-safe, pooled HTTP session for a single backend, plus request / connection reuse counters """
+    def __init__(self, name, pool_size=50, connect_timeout=3.0, read_timeout=30.0, keep_alive=True, retries=0):
+        self.name = name
+        self.timeout = (connect_timeout, read_timeout)
+        self.keep_alive = keep_alive
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retries, pool_block=False)
+        self.session = requests.Session()
+        self.session.headers['Accept'] = 'application/json'
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+    def get(self, url, params=None, timeout=None):
+        """ :return: requests.Response (raises for connection errors, timeouts and http error status codes) """
+        with self._lock:
+            self.requests += 1
+        start = time.perf_counter()
+        try:
+            ret_val = self.session.get(url, params=params, timeout=timeout or self.timeout)
+            ret_val.raise_for_status()
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            METRICS.inc('http_errors', backend=self.name)
+            raise
+        finally:
+            METRICS.observe('http_latency', (time.perf_counter() - start) * 1000.0, backend=self.name)
+        return ret_val
+
+    def get_text(self, url, params=None, timeout=None):
+        return self.get(url, params, timeout).text
+
+    def get_json(self, url, params=None, timeout=None, def_val=None):
+        """ GET json ... logs and returns def_val on any error (ala json_utils.proxy_json) """
+        ret_val = def_val
+        try:
+            ret_val = self.get(url, params, timeout).json()
+        except Exception as e:
+            log.warning("{} GET {} failed: {}".format(self.name, url, e))
+        return ret_val
+
+    def stats(self):
+        """ :return: dict of request, error, connection and connection reuse counts for this backend """
+        connections = 0
+        pool_requests = 0
+        try:
+            pools = self.adapter.poolmanager.pools
+            for k in pools.keys():
+                p = pools[k]
+                connections += p.num_connections
+                pool_requests += p.num_requests
+        except Exception as e:
+            log.debug(e)
+        return {
+            'name': self.name, 'requests': self.requests, 'errors': self.errors,
+            'connections': connections, 'reused': max(pool_requests - connections, 0)
+        }
+
+    @classmethod
+    def from_settings(cls, settings, name):
+        return cls(
+            name,
+            pool_size=int(settings.get('{}_pool_size'.format(name), 50)),
+            connect_timeout=float(settings.get('{}_connect_timeout'.format(name), 3.0)),
+            read_timeout=float(settings.get('{}_read_timeout'.format(name), 30.0)),
+            keep_alive=is_true(settings.get('{}_keep_alive'.format(name), 'true'))
+        )
+
+
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+
+def get_pool(name, settings=None):
+    """ :return: the (process wide) HttpPool for a backend, creating it (from .ini settings) on first use """
+    ret_val = POOLS.get(name)
+    if ret_val is None:
+        with POOLS_LOCK:
+            ret_val = POOLS.get(name)
+            if ret_val is None:
+                ret_val = HttpPool.from_settings(settings or {}, name)
+                POOLS[name] = ret_val
+    return ret_val
+
+
+def all_stats():
+    return [p.stats() for p in list(POOLS.values())]
@@ -0,0 +1,245 @@
+""" In-process metrics (latency histograms and counters), exported in the Prometheus text format at /metrics
+
+    recording is lock free: each (waitress) thread writes to its own shard of histograms / counters, and the shards
+    are only merged when /metrics is scraped ... so the metrics don't become a point of contention across 200 threads
+"""
+import time
+import bisect
+import contextlib
+import threading
+
+import logging
+log = logging.getLogger(__file__)
+
+
+class LatencyHistogram(object):
+    """ fixed bucket histogram of latencies (in milliseconds) """
+    BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last count is the +Inf bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.sum += ms
+
+    def percentile(self, pct, def_val=None):
+        """ :return: upper bound (ms) of the bucket holding the pct percentile (or def_val when empty) """
+        ret_val = def_val
+        if self.count > 0:
+            target = self.count * pct / 100.0
+            running = 0
+            for i, c in enumerate(self.counts):
+                running += c
+                if running >= target:
+                    ret_val = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                    break
+        return ret_val
+
+    def to_dict(self):
+        buckets = [str(b) for b in self.buckets] + ['+Inf']
+        return {'buckets': dict(zip(buckets, self.counts)), 'count': self.count, 'sum': round(self.sum, 1)}
+
+
+class Metrics(object):
+    """ registry of named, labeled latency histograms (ms) and counters, sharded per thread
+
+        the shards of threads that have since exited (e.g., a ThreadPoolExecutor's workers) are folded into a
+        retired shard, so the number of shards is bounded by the number of live threads
+    """
+    def __init__(self, prefix='ott'):
+        self.prefix = prefix
+        self._local = threading.local()
+        self._shards = []  # (thread, shard) pairs
+        self._retired = ({}, {})
+        self._lock = threading.Lock()
+
+    def shard(self):
+        ret_val = getattr(self._local, 'shard', None)
+        if ret_val is None:
+            ret_val = self._local.shard = ({}, {})
+            with self._lock:
+                self._retire()
+                self._shards.append((threading.current_thread(), ret_val))
+        return ret_val
+
+    def _retire(self):
+        """ fold the shards of dead threads into the retired shard (call with the lock held) """
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self.merge(self._retired, shard)
+        self._shards = live
+
+    @classmethod
+    def merge(cls, into, shard):
+        """ add a shard's histograms and counters to the into shard """
+        histograms, counters = into
+        for key, h in list(shard[0].items()):
+            m = histograms.get(key)
+            if m is None:
+                m = histograms[key] = LatencyHistogram(h.buckets)
+            m.counts = [a + b for a, b in zip(m.counts, list(h.counts))]
+            m.count += h.count
+            m.sum += h.sum
+        for key, c in list(shard[1].items()):
+            counters[key] = counters.get(key, 0) + c
+
+    def observe(self, name, ms, **labels):
+        """ add a latency (ms) to the 'name' histogram with these labels """
+        histograms = self.shard()[0]
+        key = (name, tuple(sorted(labels.items())))
+        h = histograms.get(key)
+        if h is None:
+            h = histograms[key] = LatencyHistogram()
+        h.add(ms)
+
+    def inc(self, name, num=1, **labels):
+        counters = self.shard()[1]
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + num
+
+    def collect(self):
+        """ :return: tuple of merged {key: LatencyHistogram} and {key: count} dicts, over every thread's shard """
+        ret_val = ({}, {})
+        with self._lock:
+            self._retire()
+            self.merge(ret_val, self._retired)
+            shards = [shard for _, shard in self._shards]
+        for shard in shards:
+            self.merge(ret_val, shard)
+        return ret_val
+
+    def to_prometheus(self, gauges=None):
+        """ :return: Prometheus text exposition of the histograms (in seconds) and counters, plus any extra gauges
+            :param gauges: list of (name, value, labels dict) tuples
+        """
+        lines = []
+        histograms, counters = self.collect()
+
+        seen = set()
+        for (name, labels), h in sorted(histograms.items()):
+            metric = "{}_{}_seconds".format(self.prefix, name)
+            if metric not in seen:
+                lines.append("# TYPE {} histogram".format(metric))
+                seen.add(metric)
+            running = 0
+            for b, c in zip(list(h.buckets) + ['+Inf'], h.counts):
+                running += c
+                le = b if b == '+Inf' else "{:g}".format(b / 1000.0)
+                lines.append("{}_bucket{} {}".format(metric, format_labels(labels, ('le', le)), running))
+            lines.append("{}_sum{} {:.6f}".format(metric, format_labels(labels), h.sum / 1000.0))
+            lines.append("{}_count{} {}".format(metric, format_labels(labels), h.count))
+
+        for (name, labels), c in sorted(counters.items()):
+            metric = "{}_{}_total".format(self.prefix, name)
+            if metric not in seen:
+                lines.append("# TYPE {} counter".format(metric))
+                seen.add(metric)
+            lines.append("{}{} {}".format(metric, format_labels(labels), c))
+
+        for name, value, labels in gauges or []:
+            if value is None:
+                continue
+            metric = "{}_{}".format(self.prefix, name)
+            if metric not in seen:
+                lines.append("# TYPE {} gauge".format(metric))
+                seen.add(metric)
+            lines.append("{}{} {}".format(metric, format_labels(tuple(sorted(labels.items()))), value))
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels, *extra):
+    """ (('route', 'plan_trip'),) is '{route="plan_trip"}' """
+    labels = tuple(labels) + extra
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + "}"
+
+
+METRICS = Metrics()
+
+
+class timed(object):
+    """ context manager adding the elapsed time of its block to a METRICS histogram
+        with timed('db_session', route='ti_stop'):
+            ...
+    """
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        METRICS.observe(self.name, (time.perf_counter() - self.start) * 1000.0, **self.labels)
+        if exc_type is not None:
+            METRICS.inc(self.name + '_errors', **self.labels)
+        return False
+
+
+class TimedDatabase(object):
+    """ wraps a gtfsdb Database, so the time spent in each managed_session() shows up in the db_session histogram """
+    def __init__(self, db):
+        self.db = db
+
+    @contextlib.contextmanager
+    def managed_session(self, *args, **kwargs):
+        with timed('db_session'):
+            with self.db.managed_session(*args, **kwargs) as session:
+                yield session
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+def metrics_tween_factory(handler, registry):
+    """ pyramid tween, recording the latency and errors (exceptions and 5xx responses) of every route """
+    def metrics_tween(request):
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = handler(request)
+            status = response.status_int
+            return response
+        finally:
+            route = request.matched_route.name if getattr(request, 'matched_route', None) else 'none'
+            METRICS.observe('route_latency', (time.perf_counter() - start) * 1000.0, route=route)
+            if status >= 500:
+                METRICS.inc('route_errors', route=route)
+    return metrics_tween
+
+
+WAITRESS_DISPATCHER = None
+
+
+def waitress_gauges():
+    """ :return: waitress task queue depth, and active / total worker threads, when served by waitress """
+    global WAITRESS_DISPATCHER
+    ret_val = []
+    try:
+        if WAITRESS_DISPATCHER is None:
+            # note: waitress doesn't hand its task dispatcher to the app, so find it (once) amongst the live objects
+            import gc
+            from waitress.task import ThreadedTaskDispatcher
+            WAITRESS_DISPATCHER = False
+            for o in gc.get_objects():
+                if isinstance(o, ThreadedTaskDispatcher):
+                    WAITRESS_DISPATCHER = o
+                    break
+        d = WAITRESS_DISPATCHER
+        if d:
+            ret_val.append(('waitress_queue_depth', len(d.queue), {}))
+            ret_val.append(('waitress_active_threads', d.active_count, {}))
+            ret_val.append(('waitress_threads', len(d.threads), {}))
+    except Exception as e:
+        log.debug(e)
+    return ret_val
@@ -0,0 +1,217 @@
+""" Origin - destination travel time matrices, built from (many) OTP trip plans
+
+    each cell of the matrix is the quickest itinerary between an origin and destination, summarized as just its
+    duration (minutes), number of transfers and walk time (minutes) ... see DateInfoExtended.summary()
+
+    examples:
+      bin/od_matrix origins.txt destinations.txt -o matrix.csv
+      bin/od_matrix stops.txt job_centers.txt -p "mode=TRANSIT,WALK&date=6/4/2020&time=8:00am" -w 16 -o matrix.npy
+
+    origins and destinations files have one place per line, either 'lat,lon', 'name::lat,lon' or a name to geocode
+"""
+import csv
+import sys
+import time
+import array
+import argparse
+import simplejson as json
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from ott.otp_client.otp_to_ott import DateInfoExtended
+from ott.utils.parse.url.trip_param_parser import TripParamParser
+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import logging
+log = logging.getLogger(__file__)
+
+
+NO_TRIP = -1
+COLUMNS = ('duration', 'transfers', 'walk')
+
+
+class ODMatrix(object):
+    """ N x M matrix of trip summaries (duration, transfers and walk minutes), stored in flat (row major) arrays
+        cells without a trip are NO_TRIP (-1)
+    """
+    def __init__(self, origins, destinations):
+        self.origins = list(origins)
+        self.destinations = list(destinations)
+        size = len(self.origins) * len(self.destinations)
+        self.data = {}
+        for c in COLUMNS:
+            self.data[c] = array.array('i', [NO_TRIP]) * size
+
+    def index(self, o, d):
+        return o * len(self.destinations) + d
+
+    def set(self, o, d, duration, transfers, walk):
+        i = self.index(o, d)
+        self.data['duration'][i] = duration
+        self.data['transfers'][i] = transfers
+        self.data['walk'][i] = walk
+
+    def get(self, o, d):
+        """ :return: (duration, transfers, walk) tuple for a cell """
+        i = self.index(o, d)
+        return tuple(self.data[c][i] for c in COLUMNS)
+
+    def write_csv(self, out):
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(('origin', 'destination') + COLUMNS)
+        for o, origin in enumerate(self.origins):
+            for d, dest in enumerate(self.destinations):
+                writer.writerow((origin, dest) + self.get(o, d))
+
+    def to_numpy(self):
+        """ :return: numpy array of shape (origins, destinations, 3) ... the last axis being duration, transfers, walk """
+        if numpy is None:
+            raise ImportError("numpy is needed for .npy output (pip install ott.otp_client[numpy])")
+        shape = (len(self.origins), len(self.destinations))
+        return numpy.stack([numpy.frombuffer(self.data[c], dtype=numpy.int32).reshape(shape) for c in COLUMNS], axis=-1)
+
+    def write(self, file_path):
+        """ write the matrix as .npy (numpy) or else as .csv """
+        if file_path.endswith('.npy'):
+            numpy.save(file_path, self.to_numpy())
+        else:
+            with open(file_path, 'w') as out:
+                self.write_csv(out)
+
+
+def summarize_plan(otp_text):
+    """ :return: (duration, transfers, walk) of the quickest itinerary in a raw OTP response, or None for no trip """
+    ret_val = None
+    try:
+        itins = json.loads(otp_text)['plan']['itineraries']
+        for i in itins:
+            duration, walk = DateInfoExtended.summary(i)
+            if ret_val is None or duration < ret_val[0]:
+                ret_val = (duration, max(int(i.get('transfers', 0)), 0), walk)  # OTP has -1 transfers for walk trips
+    except Exception as e:
+        log.debug(e)
+    return ret_val
+
+
+def geocode_place(planner, place):
+    """ :return: the place with its coordinates ('name::lat,lon'), geocoding it when needed ... or None if not found
+        (or the geocode fails, so one bad place only blanks its own cells, rather than the whole matrix)
+    """
+    ret_val = None
+    try:
+        param = TripParamParser(urlencode({'fromPlace': place}))
+        if param.has_valid_coord(place):
+            ret_val = place
+        else:
+            ret_val = planner.geo.geostr(param.strip_coord(place))
+    except Exception as e:
+        log.warning("geocode of '{}' failed: {}".format(place, e))
+    return ret_val
+
+
+def plan_matrix(planner, origins, destinations, params="", workers=8, progress=None):
+    """ build an ODMatrix by planning every origin - destination pair over a pool of 'workers' threads
+        :param planner: TripPlanner (which supplies geocoding, OTP backends, cancelled routes, etc...)
+        :param params: other trip params (as a url query string) for all the plans, e.g. 'mode=TRANSIT,WALK&time=8am'
+        :param progress: optional callback, called with (cells done, total cells, elapsed secs)
+    """
+    ret_val = ODMatrix(origins, destinations)
+    total = len(ret_val.origins) * len(ret_val.destinations)
+    start = time.time()
+
+    def plan_cell(o, d):
+        query = urlencode({'fromPlace': frms[o], 'toPlace': tos[d]})
+        if params:
+            query = "{}&{}".format(query, params)
+        param = TripParamParser(query)
+        return o, d, summarize_plan(planner.call_otp(param))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # step 1: geocode each origin and destination once (rather than once per cell)
+        places = list(set(ret_val.origins) | set(ret_val.destinations))
+        coords = dict(zip(places, executor.map(partial(geocode_place, planner), places)))
+        frms = [coords[p] for p in ret_val.origins]
+        tos = [coords[p] for p in ret_val.destinations]
+        for p in places:
+            if not coords[p]:
+                log.warning("couldn't geocode '{}' ... its cells will have no trip".format(p))
+
+        # step 2: plan the cells, keeping up to 2 x workers of them in flight (submitted lazily)
+        cells = ((o, d) for o in range(len(frms)) for d in range(len(tos)))
+        pending = set()
+        n = 0
+        while True:
+            for o, d in cells:
+                if frms[o] and tos[d]:
+                    pending.add(executor.submit(plan_cell, o, d))
+                else:
+                    n += 1
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                n += 1
+                try:
+                    o, d, cell = f.result()
+                    if cell:
+                        ret_val.set(o, d, *cell)
+                except Exception as e:
+                    log.warning(e)
+                if progress:
+                    progress(n, total, time.time() - start)
+    return ret_val
+
+
+def print_progress(done, total, secs, every=100):
+    if done % every == 0 or done == total:
+        rate = done / secs if secs > 0 else 0.0
+        eta = (total - done) / rate if rate > 0 else 0.0
+        sys.stderr.write("{}/{} plans ({:.1f} plans/sec, {:.0f} secs to go)\n".format(done, total, rate, eta))
+
+
+def read_places(file_path):
+    with open(file_path) as f:
+        return [l.strip() for l in f if l.strip() and not l.startswith('#')]
+
+
+def main():
+    from ott.otp_client.trip_planner import TripPlanner
+
+    parser = argparse.ArgumentParser(prog='od_matrix', description='build an origin - destination travel time matrix')
+    parser.add_argument('origins', help='file of origins, one place per line')
+    parser.add_argument('destinations', help='file of destinations, one place per line')
+    parser.add_argument('--output', '-o', default='matrix.csv', help='output file (.csv or .npy)')
+    parser.add_argument('--params', '-p', default='', help='other trip params, e.g. "mode=TRANSIT,WALK&time=8:00am"')
+    parser.add_argument('--workers', '-w', type=int, default=8, help='number of concurrent OTP calls')
+    parser.add_argument('--otp', default='http://localhost/prod', help='OTP planner url(s), comma separated')
+    parser.add_argument('--solr', default='http://localhost/solr', help='SOLR geocoder url')
+    args = parser.parse_args()
+
+    if args.output.endswith('.npy') and numpy is None:
+        sys.exit("numpy is needed for .npy output")
+
+    planner = TripPlanner(otp_url=args.otp, solr=args.solr)
+    origins = read_places(args.origins)
+    destinations = read_places(args.destinations)
+
+    start = time.time()
+    matrix = plan_matrix(planner, origins, destinations, args.params, args.workers, print_progress)
+    matrix.write(args.output)
+    secs = time.time() - start
+    print("{} x {} matrix written to {} in {:.1f} secs".format(len(origins), len(destinations), args.output, secs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+""" Routing of OTP calls across several (equivalent) OTP backends
+
+    - each call goes to the backend with the best score (recent latency, scaled by its number of in-flight calls)
+    - when the call runs longer than the backend's p95 latency (or otp_hedge_ms), or fails, a hedged duplicate is sent
+      to the next best backend, and the first good response wins ... calls run on a pool of otp_hedge_threads threads
+    - a backend failing (e.g., timing out) otp_breaker_failures times in a row is taken out of rotation (circuit
+      breaker) for otp_breaker_secs, after which a single call is let through to test it
+    - per-backend latency histograms are available via stats()
+
+    .ini settings:
+      otp_url = http://otp1/otp_prod, http://otp2/otp_prod    # one or more OTP urls (comma separated)
+      otp_hedge_ms = 0                                        # 0 is 'hedge after the p95 latency', -1 turns off hedging
+      otp_breaker_failures = 3
+      otp_breaker_secs = 30
+      otp_hedge_threads = 50                                  # max (hedged) OTP calls in flight
+"""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from ott.otp_client.metrics import LatencyHistogram
+
+import logging
+log = logging.getLogger(__file__)
+
+
+class Backend(object):
+    """ a single OTP server, plus its latency stats and circuit breaker state """
+    def __init__(self, url, alpha=0.2):
+        self.url = url
+        self.alpha = alpha
+        self.ewma = None
+        self.in_flight = 0
+        self.histogram = LatencyHistogram()
+        self.calls = 0
+        self.errors = 0
+        self.hedges = 0
+        self.failures = 0  # consecutive
+        self.open_until = 0
+        self.half_open = False
+
+    def score(self):
+        """ lower is better ... an untried backend scores as 0, so it gets tried """
+        return (self.ewma or 0.0) * (1 + self.in_flight)
+
+    def is_available(self, now):
+        """ closed breaker, or an open one whose time is up (and isn't already being tested by a half open call) """
+        return self.open_until <= now and not self.half_open
+
+    def p95(self, min_count=20, def_val=None):
+        ret_val = def_val
+        if self.histogram.count >= min_count:
+            ret_val = self.histogram.percentile(95, def_val)
+        return ret_val
+
+    def to_dict(self):
+        return {
+            'url': self.url, 'calls': self.calls, 'errors': self.errors, 'hedges': self.hedges,
+            'in_flight': self.in_flight, 'ewma_ms': round(self.ewma, 1) if self.ewma else None,
+            'open': self.open_until > time.time(), 'latency': self.histogram.to_dict()
+        }
+
+
+class OtpBackends(object):
+    """ load balancer (with hedging and circuit breaking) over a list of OTP urls, using a shared HttpPool """
+    def __init__(self, urls, pool, hedge_ms=0, def_hedge_ms=1000, breaker_failures=3, breaker_secs=30, threads=50):
+        if isinstance(urls, str):
+            urls = urls.split(',')
+        self.backends = [Backend(u.strip()) for u in urls if u.strip()]
+        self.pool = pool
+        self.hedge_ms = hedge_ms
+        self.def_hedge_ms = def_hedge_ms
+        self.breaker_failures = breaker_failures
+        self.breaker_secs = breaker_secs
+        self._lock = threading.Lock()
+        self._executor = None
+        if len(self.backends) > 1:
+            self._executor = ThreadPoolExecutor(max_workers=threads)
+
+    def choose(self, exclude=None):
+        """ :return: the best scoring, available backend (or None) ... when every breaker is open, the backend whose
+                     breaker opened first gets a single (half open) test call
+        """
+        ret_val = None
+        now = time.time()
+        with self._lock:
+            candidates = [b for b in self.backends if b is not exclude]
+            available = [b for b in candidates if b.is_available(now)]
+            if available:
+                ret_val = min(available, key=lambda b: b.score())
+            else:
+                closed = [b for b in candidates if not b.half_open]
+                if closed:
+                    ret_val = min(closed, key=lambda b: b.open_until)
+                    ret_val.half_open = True
+            if ret_val:
+                if ret_val.open_until:
+                    ret_val.half_open = True  # breaker was open ... this is the single (half open) test call
+                ret_val.in_flight += 1
+                ret_val.calls += 1
+        return ret_val
+
+    def call_backend(self, backend, query):
+        """ GET <backend url>?<query>, recording its latency / failure ... :return: response text """
+        start = time.time()
+        try:
+            ret_val = self.pool.get_text("{0}?{1}".format(backend.url, query))
+        except Exception:
+            with self._lock:
+                backend.in_flight -= 1
+                backend.errors += 1
+                backend.failures += 1
+                if backend.half_open or backend.failures >= self.breaker_failures:
+                    backend.open_until = time.time() + self.breaker_secs
+                    log.warning("OTP backend {} is failing ... out of rotation for {} secs".format(backend.url, self.breaker_secs))
+                backend.half_open = False
+            raise
+
+        ms = (time.time() - start) * 1000.0
+        with self._lock:
+            backend.in_flight -= 1
+            backend.failures = 0
+            backend.half_open = False
+            backend.open_until = 0
+            backend.histogram.add(ms)
+            backend.ewma = ms if backend.ewma is None else backend.alpha * ms + (1 - backend.alpha) * backend.ewma
+        return ret_val
+
+    def hedge_delay(self, backend):
+        """ :return: seconds to wait on a backend before sending a hedged request (None is no hedging) """
+        ret_val = None
+        if self.hedge_ms > 0:
+            ret_val = self.hedge_ms / 1000.0
+        elif self.hedge_ms == 0:
+            ret_val = backend.p95(def_val=self.def_hedge_ms) / 1000.0
+        return ret_val
+
+    def get_text(self, query):
+        """ call OTP with the url query string ... :return: text of the first good response (raises on failure) """
+        primary = self.choose()
+        if primary is None:
+            raise IOError("no OTP backends available")
+
+        # step 1: single backend (or hedging turned off) ... just make the call
+        delay = self.hedge_delay(primary)
+        if self._executor is None or delay is None:
+            return self.call_backend(primary, query)
+
+        # step 2: call the primary backend, and wait up to the hedge delay for its response
+        futures = [self._executor.submit(self.call_backend, primary, query)]
+        done, pending = wait(futures, timeout=delay)
+
+        # step 3: no response yet (or an error), so send a hedged request to the next best backend
+        if not done or futures[0].exception() is not None:
+            backup = self.choose(exclude=primary)
+            if backup:
+                with self._lock:
+                    backup.hedges += 1
+                futures.append(self._executor.submit(self.call_backend, backup, query))
+
+        # step 4: first good response wins ... the loser (if still queued) is cancelled, else its response is ignored
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                if f.exception() is None:
+                    for p in pending:
+                        p.cancel()
+                    return f.result()
+                error = f.exception()
+        raise error
+
+    def stats(self):
+        with self._lock:
+            return [b.to_dict() for b in self.backends]
+
+    @classmethod
+    def from_settings(cls, urls, pool, settings):
+        return cls(
+            urls, pool,
+            hedge_ms=float(settings.get('otp_hedge_ms', 0)),
+            breaker_failures=int(settings.get('otp_breaker_failures', 3)),
+            breaker_secs=float(settings.get('otp_breaker_secs', 30)),
+            threads=int(settings.get('otp_hedge_threads', 50))
+        )
@@ -0,0 +1,234 @@
+""" Streaming (itinerary-at-a-time) reader and writer for OpenTripPlanner plan responses
+
+    otp_to_ott.Plan wants the whole OTP response as a dict tree, and then builds every Itinerary / Leg / Step before
+    anything gets serialized.  The PlanReader below instead does a light-weight scan over the raw OTP text, noting
+    where each piece of the plan lives, and only decodes one itinerary at a time.  write_plan() then builds and writes
+    each Itinerary as soon as it's decoded, so peak memory scales with a single itinerary rather than the whole plan.
+"""
+import re
+import sys
+import simplejson as json
+
+from ott.utils import json_utils
+from ott.otp_client import otp_to_ott
+
+import logging
+log = logging.getLogger(__file__)
+
+
+_WS = re.compile(r'[ \t\n\r]*')
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_SCALAR = re.compile(r'[^,\]}\s]+')
+_TOKEN = re.compile(r'["\[\]{}]')
+_DECODER = json.JSONDecoder()
+
+
+class PlanReader(object):
+    """ event-based reader over the raw text (or bytes) of an OTP plan response
+
+        the scan walks the top-level response and the 'plan' object, recording the (start, end) span of each
+        element we care about, without decoding (building dicts for) any of them.  The pieces are then decoded
+        lazily, on demand, e.g., the 'from' and 'to' places, the 'error' object and each itinerary.
+    """
+    def __init__(self, body):
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        self.body = body
+        self.spans = {}
+        self.itinerary_spans = []
+        self.scan()
+
+    def scan(self):
+        """ walk the top level response object: { "requestParameters": {}, "plan": {}, "error": {} } """
+        for key, start, end in self.iter_members(self.body, 0):
+            if key == 'plan' and self.body[start] == '{':
+                for k, s, e in self.iter_members(self.body, start):
+                    if k == 'itineraries' and self.body[s] == '[':
+                        self.itinerary_spans = list(self.iter_elements(self.body, s))
+                    else:
+                        self.spans[k] = (s, e)
+            elif key == 'error':
+                self.spans['error'] = (start, end)
+
+    def decode(self, span):
+        ret_val = None
+        if span:
+            ret_val = _DECODER.raw_decode(self.body, span[0])[0]
+        return ret_val
+
+    def has_plan(self):
+        return 'from' in self.spans and 'to' in self.spans
+
+    def get_from(self):
+        return self.decode(self.spans.get('from'))
+
+    def get_to(self):
+        return self.decode(self.spans.get('to'))
+
+    def get_error(self):
+        return self.decode(self.spans.get('error'))
+
+    def num_itineraries(self):
+        return len(self.itinerary_spans)
+
+    def iter_itineraries(self):
+        """ yields each OTP itinerary as a (freshly decoded) dict ... one at a time """
+        for span in self.itinerary_spans:
+            yield self.decode(span)
+
+    @classmethod
+    def iter_members(cls, text, pos):
+        """ yields (key, value start, value end) for each member of the json object starting at text[pos] """
+        pos = cls.skip_ws(text, pos + 1)
+        while text[pos] != '}':
+            m = _STRING.match(text, pos)
+            key = json.loads(m.group())
+            pos = cls.skip_ws(text, m.end())
+            pos = cls.skip_ws(text, pos + 1)  # skip the ':'
+            end = cls.skip_value(text, pos)
+            yield key, pos, end
+            pos = cls.skip_ws(text, end)
+            if text[pos] == ',':
+                pos = cls.skip_ws(text, pos + 1)
+
+    @classmethod
+    def iter_elements(cls, text, pos):
+        """ yields (value start, value end) for each element of the json array starting at text[pos] """
+        pos = cls.skip_ws(text, pos + 1)
+        while text[pos] != ']':
+            end = cls.skip_value(text, pos)
+            yield pos, end
+            pos = cls.skip_ws(text, end)
+            if text[pos] == ',':
+                pos = cls.skip_ws(text, pos + 1)
+
+    @classmethod
+    def skip_ws(cls, text, pos):
+        return _WS.match(text, pos).end()
+
+    @classmethod
+    def skip_value(cls, text, pos):
+        """ return the position just past the json value starting at text[pos] (without decoding that value) """
+        c = text[pos]
+        if c == '"':
+            return _STRING.match(text, pos).end()
+        if c not in '[{':
+            return _SCALAR.match(text, pos).end()
+
+        depth = 0
+        while True:
+            m = _TOKEN.search(text, pos)
+            c = m.group()
+            if c == '"':
+                pos = _STRING.match(text, m.start()).end()
+                continue
+            depth += 1 if c in '[{' else -1
+            pos = m.end()
+            if depth == 0:
+                return pos
+
+
+class JsonCloser(object):
+    """ tracks the objects and arrays left open by json written a chunk at a time, so a stream cut short (e.g., by an
+        error building the next itinerary) can still be finished as valid json
+
+        NOTE: each chunk must end on a complete value or an opening [ or { ... never on a dangling ',' or ':'
+    """
+    def __init__(self):
+        self.stack = []
+
+    def add(self, chunk):
+        """ note the brackets (outside of strings) in chunk :return: the chunk """
+        pos = 0
+        while True:
+            m = _TOKEN.search(chunk, pos)
+            if m is None:
+                return chunk
+            c = m.group()
+            if c == '"':
+                pos = _STRING.match(chunk, m.start()).end()
+                continue
+            if c in '[{':
+                self.stack.append('}' if c == '{' else ']')
+            else:
+                self.stack.pop()
+            pos = m.end()
+
+    def close(self, error):
+        """ :return: json closing everything left open, with 'error' added to the outermost object
+                     (or just the error object, when nothing has been written yet)
+        """
+        err = json_utils.json_repr({'error': error})
+        if not self.stack:
+            return err
+        ret_val = ''.join(reversed(self.stack[1:]))
+        ret_val += ', ' + err[1:] if self.stack[0] == '}' else ']'
+        self.stack = []
+        return ret_val
+
+
+def iter_itineraries(reader, params=None, fares=None, path="planner.html?itin_num={0}", fields=otp_to_ott.ALL_FIELDS):
+    """ yields otp_to_ott.Itinerary objects, one at a time, from a PlanReader
+        NOTE: mirrors otp_to_ott.Plan.parse_itineraries(), including the 'selected' itinerary logic
+    """
+    url_params = None
+    if params:
+        url_params = params.ott_url_params()
+    selected = otp_to_ott.Plan.get_selected_itinerary(params, reader.num_itineraries())
+
+    for i, jsn in enumerate(reader.iter_itineraries()):
+        itin_num = i+1
+        url = otp_to_ott.Plan.make_itin_url(path, url_params, itin_num)
+        itin = otp_to_ott.Itinerary(jsn, itin_num, url, fares, fields)
+        itin.selected = i == selected
+        yield itin
+
+
+def iter_plan(reader, params=None, fares=None, fields=otp_to_ott.ALL_FIELDS, modes=None):
+    """ yields an OTT plan object's json in chunks ... {"from": {}, "to": {}, "itineraries": [], "params": {}, "max_walk": "1.4"}
+        each itinerary is built and serialized only when its chunk is asked for (e.g., by a streaming http response)
+
+        :param modes: optional list, which gets the dominant transit mode of the first itinerary (for adverts)
+    """
+    # step 1: the plan's from & to places
+    frm = otp_to_ott.Place(reader.get_from(), 'from', fields)
+    to = otp_to_ott.Place(reader.get_to(), 'to', fields)
+    yield '{"from": ' + frm.to_json() + ', "to": ' + to.to_json()
+
+    # step 2: itineraries, one at a time (with the separating comma in the same chunk -- see JsonCloser)
+    yield ', "itineraries": ['
+    for itin in iter_itineraries(reader, params, fares, fields=fields):
+        if itin.itin_num == 1 and modes is not None:
+            modes.append(itin.dominant_mode)
+        yield (', ' if itin.itin_num > 1 else '') + itin.to_json()
+    yield ']'
+
+    # step 3: plan params
+    yield ', "params": ' + json_utils.json_repr(otp_to_ott.Plan.make_plan_params(params)) + ', "max_walk": "1.4"}'
+
+
+def write_plan(reader, out, params=None, fares=None, fields=otp_to_ott.ALL_FIELDS):
+    """ writes an OTT plan object (see iter_plan) to 'out' ... each itinerary is built, serialized and written to
+        'out' before the next one is parsed
+
+        :return: the dominant transit mode of the first itinerary (for things like adverts)
+    """
+    modes = []
+    for chunk in iter_plan(reader, params, fares, fields, modes):
+        out.write(chunk)
+    return modes[0] if modes else 'rail'
+
+
+def main():
+    """ parse_otp_json's streaming cousin ... writes the OTT plan for an OTP response file to stdout """
+    file = './ott/otp_client/tests/data/json/plan_bike_wes.json'
+    if len(sys.argv) > 1:
+        file = sys.argv[1]
+    with open(file, 'rb') as f:
+        reader = PlanReader(f.read())
+    write_plan(reader, sys.stdout)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
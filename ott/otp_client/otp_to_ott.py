@@ -11,6 +11,7 @@ import simplejson as json
 from ott.utils import object_utils
 from ott.utils import date_utils
 from ott.utils import json_utils
+from ott.otp_client.elevation import make_profile
 
 import logging
 log = logging.getLogger(__file__)
@@ -27,13 +28,159 @@ def remove_agency_from_id(id):
     return ret_val
 
 
-class Error(object):
+_UNSET = object()
+
+
+class Base(object):
+    """ base class for the OTT plan object tree
+
+        the plan classes use __slots__ (no per-object __dict__), and list their slots in the order the attributes are
+        assigned.  That slot order doubles as the (precomputed) field list for to_dict(), which keeps the json output
+        identical to what json_utils.json_repr() used to produce when walking each object's __dict__
+    """
+    __slots__ = ()
+
+    @classmethod
+    def get_fields(cls):
+        """ :return: tuple of all slots (base classes first) for this class ... computed once per class """
+        ret_val = cls.__dict__.get('_fields')
+        if ret_val is None:
+            fields = []
+            for c in reversed(cls.__mro__):
+                fields.extend(c.__dict__.get('__slots__', ()))
+            ret_val = cls._fields = tuple(fields)
+        return ret_val
+
+    def to_dict(self):
+        """ :return: a dict (of dicts, lists and values) of every assigned attribute, ready for json serialization
+            NOTE: plain values (and lists of plain values, like elevation points) are shared, not copied
+        """
+        ret_val = {}
+        for f in self.get_fields():
+            v = getattr(self, f, _UNSET)
+            if v is _UNSET:
+                continue
+            if v.__class__ not in _PLAIN_TYPES:
+                v = to_dict_value(v)
+            ret_val[f] = v
+        return ret_val
+
+    def to_json(self, pretty=False):
+        """ serialize to_dict() with json.dumps(), using the same dumps() args as json_utils.json_repr()
+            NOTE: skips json_repr()'s 2nd (reflection) walk of the tree ... falls back to json_repr() if its
+                  output format isn't one we recognize
+        """
+        d = self.to_dict()
+        kwargs = JSON_REPR_ARGS[bool(pretty)]
+        if kwargs is None:
+            return json_utils.json_repr(d, pretty)
+        return json.dumps(d, **kwargs)
+
+
+def find_json_repr_args(pretty, probe={'b': None, 'a': [1, 2.5, 'x', True, {'d': 1, 'c': None}]}):
+    """ :return: the json.dumps() kwargs that reproduce json_utils.json_repr() output (or None if not found) """
+    ret_val = None
+    try:
+        target = json_utils.json_repr(probe, pretty)
+        candidates = [{'indent': 4, 'sort_keys': True}, {'indent': 4}, {'indent': 2, 'sort_keys': True}, {'indent': 2}]
+        if not pretty:
+            candidates = [{}, {'sort_keys': True}]
+        for c in candidates:
+            if json.dumps(probe, **c) == target:
+                ret_val = c
+                break
+    except Exception as e:
+        log.warning(e)
+    return ret_val
+
+
+JSON_REPR_ARGS = {False: find_json_repr_args(False), True: find_json_repr_args(True)}
+
+
+_PLAIN_TYPES = frozenset([str, int, float, bool, type(None)])
+
+
+def to_dict_value(v):
+    """ convert plan objects (and lists / dicts of plan objects) into dicts
+        NOTE: lists in the plan tree are all of one type, so only the first element is checked
+    """
+    ret_val = v
+    if isinstance(v, Base):
+        ret_val = v.to_dict()
+    elif isinstance(v, list):
+        if len(v) > 0 and v[0].__class__ not in _PLAIN_TYPES:
+            ret_val = [to_dict_value(i) for i in v]
+    elif isinstance(v, dict):
+        ret_val = {k: to_dict_value(i) for k, i in v.items()}
+    return ret_val
+
+
+class Fields(object):
+    """ sparse fieldset (projection) for the plan tree ... i.e., which of the optional subtrees get built
+
+        the 'fields' (or 'include') url param is a comma separated list of subtree names, or dotted paths, e.g.:
+          fields=legs
+          fields=itineraries.legs.steps,elevation
+
+        optional subtrees:
+          legs      - each itinerary's legs (without legs, itineraries are just summaries)
+          steps     - walk / bike turn-by-turn steps of a leg
+          elevation - elevation profile of a leg
+          alerts    - leg and itinerary alerts
+          map_img   - endpoint map image urls for the plan and each leg
+          stop      - stop info & schedule urls on each leg's from / to
+
+        NOTE: anything not listed is never built (not just dropped when serializing); steps, elevation & alerts
+              imply legs; and no fields param at all (the default) builds everything
+    """
+    NAMES = ('legs', 'steps', 'elevation', 'alerts', 'map_img', 'stop')
+    IMPLIES = {'steps': 'legs', 'elevation': 'legs', 'alerts': 'legs'}
+
+    def __init__(self, names=NAMES):
+        self.names = frozenset(names)
+
+    def has(self, name):
+        return name in self.names
+
+    @classmethod
+    def factory(cls, fields_str=None):
+        """ :return: Fields object from a comma separated fields param (None builds everything) """
+        if fields_str is None:
+            return ALL_FIELDS
+
+        names = set()
+        for f in fields_str.split(','):
+            for n in f.strip().split('.'):
+                if n in cls.NAMES:
+                    names.add(n)
+                    if n in cls.IMPLIES:
+                        names.add(cls.IMPLIES[n])
+        return Fields(names)
+
+    @classmethod
+    def from_param_parser(cls, param):
+        """ parse the 'fields' (or 'include') param from a TripParamParser (or any other ParamParser) """
+        f = param.get('fields')
+        if f is None:
+            f = param.get('include')
+        return cls.factory(f)
+
+
+ALL_FIELDS = Fields()
+
+
+class Error(Base):
+    __slots__ = ('id', 'msg')
+
     def __init__(self, jsn, params=None):
         self.id  = jsn['id']
         self.msg = jsn['msg']
 
 
-class DateInfo(object):
+class DateInfo(Base):
+    __slots__ = ('start_time_ms', 'end_time_ms', 'start_date', 'end_date', 'start_time', 'end_time', 'service_date',
+                 'duration_ms', 'duration', 'date', 'pretty_date', 'day', 'month', 'year')
+
     def __init__(self, jsn):
         # import pdb; pdb.set_trace()
         self.start_time_ms = jsn['startTime']
@@ -93,6 +240,11 @@ class DateInfo(object):
 class DateInfoExtended(DateInfo):
     """
     """
+    __slots__ = ('extended', 'total_time_hours', 'total_time_mins', 'duration_min',
+                 'transit_time_hours', 'transit_time_mins', 'start_transit', 'end_transit',
+                 'bike_time_hours', 'bike_time_mins', 'walk_time_hours', 'walk_time_mins',
+                 'wait_time_hours', 'wait_time_mins', 'drive_time_hours', 'drive_time_mins', 'text')
+
     def __init__(self, jsn):
         super(DateInfoExtended, self).__init__(jsn)
         self.extended = True
@@ -141,6 +293,15 @@ class DateInfoExtended(DateInfo):
         self.text = self.get_text()
 
 
+    @classmethod
+    def summary(cls, jsn):
+        """ :return: tuple of (duration, walk) minutes for an OTP itinerary ... the same numbers a DateInfoExtended
+                     has, minus all the date parsing and formatting (e.g., for od_matrix.py's many, many plans)
+        """
+        walk = get_element(jsn, 'walkTime', 0)
+        tot = walk + get_element(jsn, 'transitTime', 0) + get_element(jsn, 'waitingTime', 0)
+        return int(round(tot / 60)), int(round(walk / 60))
+
     def get_text(self):
         """
         """
@@ -152,7 +313,10 @@ class DateInfoExtended(DateInfo):
         return ret_val
 
 
-class Elevation(object):
+class Elevation(Base):
+    __slots__ = ('points', 'points_array', 'distance', 'start_ft', 'end_ft', 'high_ft', 'low_ft', 'rise_ft', 'fall_ft',
+                 'grade')
+
     def __init__(self, steps):
         self.points   = None
         self.points_array = None
@@ -165,152 +329,41 @@ class Elevation(object):
         self.fall_ft  = None
         self.grade    = None
 
-        self.distance = self.make_distance(steps)
-        self.points_array, self.points = self.make_points(steps)
-        self.grade = self.find_max_grade(steps)
-        self.set_marks()
-
-    @classmethod
-    def make_distance(cls, steps):
-        """ loop through distance
-        """
-        ret_val = None
-        try:
-            dist = 0
-            for s in steps:
-                dist += s['distance']
-            ret_val = dist
-        except Exception as ex:
-            log.warning(ex)
-        return ret_val
-
-    @classmethod
-    def make_point_string(cls, points, max_len=50):
-        """
-        """
-        points_array = points
-
-        if len(points) > (max_len * 1.15):
-            # reduce the point array down to something around the size of max_len (or smaller)
-            points_array = []
-
-            # slice the array up into chunks
-            # @see http://stackoverflow.com/questions/1335392/iteration-over-list-slices (thank you Nadia)
-            slice_size = int(round(len(points) / max_len))
-            if slice_size == 1:
-                slice_size = 2
-            list_of_slices = zip(*(iter(points),) * slice_size)
-
-            # average up the slices
-            for s in list_of_slices:
-                avg = sum(s) / len(s)
-                points_array.append(avg)
-
-        points_string = ','.join(["{0:.2f}".format(p) for p in points_array])
-        return points_string
-
-    @classmethod
-    def make_points(cls, steps):
-        """ parse leg for list of elevation points and distances
-        """
-        points_array  = None
-        points_string = None
         try:
-            points = [] 
-            for s in steps:
-                for e in s['elevation']: 
-                    elev = e['second']
-                    dist = e['first']
-                    points.append(round(elev, 2))
-            if len(points) > 0:
-                points_array  = points
-                points_string = cls.make_point_string(points)
+            # single pass over the leg's steps ... see elevation.py
+            profile = make_profile(steps)
+            self.distance = profile['distance']
+            self.points_array = profile['points_array']
+            self.points = profile['points']
+            self.grade = profile['grade']
+            self.set_marks(profile)
         except Exception as e:
             log.warning(e)
-        return points_array, points_string
 
-    @classmethod
-    def find_max_grade(cls, steps):
-        """ parse leg for list of elevation points and distances
+    def set_marks(self, profile):
+        """ start / end / high / low, and how much of a rise and fall there is, as strings with 1 decimal place
         """
-        r = {'up': 0, 'down': 0, 'ue': 0, 'ud': 0, 'de': 0, 'dd': 0}
-        ret_val = r
-        try:
-            for s in steps:
-                first = True
-                going_up = False
-                for e in s['elevation']: 
-                    dist = e['first']
-                    elev = e['second']
-
-                    if first:
-                        first = False
-                        r['ue'] = elev
-                        r['ud'] = dist
-                        r['de'] = elev
-                        r['dd'] = dist
-                    else:
-                        # going up
-                        if elev > r['lue']:
-                            # set up vals
-                            r['lue'] = elev
-                            r['lud'] = dist
-
-                            # set down vals
-                            going_up = True
-                        elif elev < r['lue']:
-                            last_elev = elev
-        except Exception as e:
-            log.warning(e)
+        if 'start' in profile:
+            self.start_ft = "{0:.1f}".format(profile['start'])
+            self.end_ft   = "{0:.1f}".format(profile['end'])
+            self.high_ft  = "{0:.1f}".format(profile['high'])
+            self.low_ft   = "{0:.1f}".format(profile['low'])
+            self.rise_ft  = "{0:.1f}".format(profile['rise'])
+            self.fall_ft  = "{0:.1f}".format(profile['fall'])
 
-        return ret_val
-
-    def set_marks(self):
-        """ finds start / end / high / low
-        """
-        try:
-            start = self.points_array[0]
-            end   = self.points_array[len(self.points_array) - 1]
-            high  = self.points_array[0]
-            low   = self.points_array[0]
-            rise  = 0.0
-            fall  = 0.0
-            slope = 0.0
-
-            # find high, low and rise, fall points
-            last = self.points_array[0]
-            for p in self.points_array:
-                if p > high:
-                    high = p
-                if p < low:
-                    low = p
-                if p > last:
-                    rise += (p - last)
-                if p < last:
-                    fall += (p - last)
-                last = p
-
-            # end results as strings with 2 decimal places
-            self.start_ft = "{0:.1f}".format(start)
-            self.end_ft   = "{0:.1f}".format(end)
-            self.high_ft  = "{0:.1f}".format(high)
-            self.low_ft   = "{0:.1f}".format(low)
-
-            # find how much of a rise and fall in feet there are from the avg height
-            self.rise_ft = "{0:.1f}".format(rise)
-            self.fall_ft = "{0:.1f}".format(fall)
-        except Exception as e:
-            log.warning(e)
 
+class Place(Base):
+    __slots__ = ('name', 'lat', 'lon', 'stop', 'map_img')
 
-class Place(object):
-    def __init__(self, jsn, name=None):
+    def __init__(self, jsn, name=None, fields=ALL_FIELDS):
         """ """
         self.name = jsn['name']
         self.lat  = jsn['lat']
         self.lon  = jsn['lon']
-        self.stop = Stop.factory(jsn, self.name)
-        self.map_img = self.make_img_url(lon=self.lon, lat=self.lat, icon=self.endpoint_icon(name))
+        if fields.has('stop'):
+            self.stop = Stop.factory(jsn, self.name)
+        if fields.has('map_img'):
+            self.map_img = self.make_img_url(lon=self.lon, lat=self.lat, icon=self.endpoint_icon(name))
 
     def endpoint_icon(self, name):
         """ """
@@ -328,23 +381,26 @@ class Place(object):
         return url % kwargs
 
     def append_url_params(self, route=None, month=None, day=None):
-        if self.stop:
+        if getattr(self, 'stop', None):
             self.stop.append_params_schedule_url(route, month, day)
             self.stop.append_params_info_url(month, day)
 
     @classmethod
-    def factory(cls, jsn, obj=None, name=None):
+    def factory(cls, jsn, obj=None, name=None, fields=ALL_FIELDS):
         """ will create a Place object from json (jsn) data, 
             optionally assign the resultant object to some other object, as this alleviates the awkward 
-            construct of 'from' that uses a python keyword, (e.g.,  self.__dict__['from'] = Place(j['from'])
+            construct of 'from' that uses a python keyword, (e.g.,  setattr(self, 'from', Place(j['from'])))
         """
-        p = Place(jsn, name)
+        p = Place(jsn, name, fields)
         if obj and name:
-            obj.__dict__[name] = p
+            setattr(obj, name, p)
         return p
 
 
-class Alert(object):
+class Alert(Base):
+    __slots__ = ('type', 'route_id', 'text', 'url', 'start_date', 'start_date_pretty', 'start_time_pretty', 'long_term',
+                 'future')
+
     def __init__(self, jsn, route_id=None):
         self.type = 'ROUTE'
         self.route_id = route_id
@@ -423,19 +479,21 @@ class Alert(object):
         return ret_val
 
 
-class Fare(object):
+class Fare(Base):
     """ 
     """
+    __slots__ = ('adult', 'adult_day', 'honored', 'honored_day', 'youth', 'youth_day', 'tram', 'notes')
+
+    # fares (other than the adult fare from OTP) read from the agency's fares content, along with their defaults
+    FARE_INFO = (
+        ("adult_day", "$5.00"), ("honored", "$1.25"), ("honored_day", "$2.50"),
+        ("youth", "$1.25"), ("youth_day", "$2.50"), ("tram", "$4.70"), ("notes", None)
+    )
+
     def __init__(self, jsn, fares):
         self.adult = self.get_fare(jsn, '$2.50')
         if fares:
-            self.adult_day = fares.query("adult_day", "$5.00")
-            self.honored = fares.query("honored", "$1.25")
-            self.honored_day = fares.query("honored_day", "$2.50")
-            self.youth = fares.query("youth", "$1.25")
-            self.youth_day = fares.query("youth_day", "$2.50")
-            self.tram = fares.query("tram", "$4.70")
-            self.notes = fares.query("notes")
+            self.update_fare_info(fares)
 
     def get_fare(self, jsn, def_val):
         """  TODO -- need to figure out exceptions and populate self.note 
@@ -451,23 +509,19 @@ class Fare(object):
             pass
         return ret_val
 
-    def update_fare_info(self,  def_val):
-        """ read (periodically) a config file containing all fares an agency might present
+    def update_fare_info(self, fares):
+        """ fill in the rest of the fares from the agency's fares content (e.g., a ContentSnapshot ... see content.py)
+            NOTE: that content is refreshed in the background, so this never waits on a fetch of the fares config
         """
-        ret_val = def_val
-        try:
-            if datetime.now() - self.last_update > timedelta(minutes = self.avert_timeout):
-                log.warning("updating the advert content")
-                self.last_update = datetime.now()
-        except Exception as e:
-            log.warning("ERROR updating the advert content {0}".format(e))
-
-        return ret_val
+        for name, def_val in self.FARE_INFO:
+            setattr(self, name, fares.query(name, def_val))
 
 
-class Stop(object):
+class Stop(Base):
     """
     """
+    __slots__ = ('name', 'agency', 'id', 'info', 'schedule')
+
     def __init__(self, jsn, name=None):
         # OLD OTP: "stop": {"agencyId":"TriMet", "name":"SW Arthur & 1st", "id":"143","info":"stop.html?stop_id=143", "schedule":"stop_schedule.html?stop_id=143"},
         # NEW OTP: "from": { "name":"SE 13th & Lambert","stopId":"TriMet:6693","stopCode":"6693","lon":-122.652906,"lat":45.468484,"arrival":1478551773000,"departure":1478551774000,"zoneId":"B","stopIndex":11,"stopSequence":12,"vertexType":"TRANSIT"}
@@ -520,7 +574,10 @@ class Stop(object):
         return ret_val
 
 
-class Route(object):
+class Route(Base):
+    __slots__ = ('route_id_cleanup', 'agency_id', 'agency_name', 'id', 'name', 'headsign', 'trip', 'url',
+                 'schedulemap_url')
+
     def __init__(self, jsn):
         # TODO IMPORTANT
         # TODO We should probably use ott.data's DAO objects here ... very confusing to have multiple routes
@@ -605,7 +662,10 @@ class Route(object):
         return ret_val
 
 
-class Step(object):
+class Step(Base):
+    __slots__ = ('name', 'lat', 'lon', 'distance_meters', 'distance_feet', 'distance', 'compass_direction',
+                 'relative_direction')
+
     def __init__(self, jsn):
         self.name = jsn['streetName']
         self.lat  = jsn['lat']
@@ -650,29 +710,35 @@ class Step(object):
         return ret_val
 
 
-class Leg(object):
+class Leg(Base):
     """
     """
-    def __init__(self, jsn):
+    __slots__ = ('mode', 'from', 'to', 'steps', 'elevation', 'date_info', 'compass_direction',
+                 'distance_meters', 'distance_feet', 'distance', 'route', 'alerts', 'transfer', 'interline')
+
+    def __init__(self, jsn, fields=ALL_FIELDS):
         self.mode = jsn['mode']
 
-        fm = Place.factory(jsn['from'], self, 'from')
-        to = Place.factory(jsn['to'],   self, 'to')
+        fm = Place.factory(jsn['from'], self, 'from', fields)
+        to = Place.factory(jsn['to'],   self, 'to', fields)
 
-        self.steps = self.get_steps(jsn)
-        self.elevation = None
-        if self.steps and 'steps' in jsn:
-            self.elevation = Elevation(jsn['steps'])
+        if fields.has('steps'):
+            self.steps = self.get_steps(jsn)
+        if fields.has('elevation'):
+            self.elevation = None
+            if 'steps' in jsn and jsn['steps']:
+                self.elevation = Elevation(jsn['steps'])
 
         self.date_info = DateInfo(jsn)
-        self.compass_direction = self.get_compass_direction()
+        self.compass_direction = self.get_compass_direction(jsn)
         self.distance_meters = jsn['distance']
         self.distance_feet = m_to_ft(jsn['distance'])
         self.distance = pretty_distance(self.distance_feet)
 
         # transit related attributes
         self.route = None
-        self.alerts = None
+        if fields.has('alerts'):
+            self.alerts = None
         self.transfer = None
         self.interline = None
 
@@ -681,7 +747,7 @@ class Leg(object):
         if self.is_transit_mode():
             self.route = Route(jsn)
             route_id = self.route.id
-            if 'alerts' in jsn:
+            if 'alerts' in jsn and fields.has('alerts'):
                 self.alerts = Alert.factory(jsn['alerts'], route_id=self.route.id)
             self.interline = self.is_interline(jsn)
 
@@ -697,16 +763,16 @@ class Leg(object):
         return ret_val
 
     def is_transit_mode(self):
-        return self.mode in ['BUS', 'TRAM', 'RAIL', 'TRAIN', 'SUBWAY', 'CABLECAR', 'GONDOLA', 'FUNICULAR', 'FERRY']
+        return is_transit_mode(self.mode)
 
     def is_sea_mode(self):
-        return self.mode in ['FERRY']
+        return is_sea_mode(self.mode)
 
     def is_air_mode(self):
-        return self.mode in ['GONDOLA']
+        return is_air_mode(self.mode)
 
     def is_non_transit_mode(self):
-        return self.mode in ['BIKE', 'BICYCLE', 'WALK', 'CAR', 'AUTO']
+        return is_non_transit_mode(self.mode)
 
     def get_steps(self, jsn):
         ret_val = None
@@ -718,93 +784,113 @@ class Leg(object):
 
         return ret_val
 
-    def get_compass_direction(self):
+    def get_compass_direction(self, jsn):
+        """ compass direction of the first step (read from the OTP json, so it's there even when steps aren't built)
+        """
         ret_val = None
-        if self.steps and len(self.steps) > 0:
-            v = self.steps[0].compass_direction
+        if 'steps' in jsn and jsn['steps'] and len(jsn['steps']) > 0:
+            v = Step.get_direction(get_element(jsn['steps'][0], 'absoluteDirection'))
             if v:
                 ret_val = v
 
         return ret_val
 
 
-class Itinerary(object):
+class Itinerary(Base):
     """
     """
-    def __init__(self, jsn, itin_num, url, fares):
+    __slots__ = ('dominant_mode', 'selected', 'has_alerts', 'alerts', 'url', 'itin_num', 'transfers', 'fare',
+                 'date_info', 'transfer', 'legs')
+
+    def __init__(self, jsn, itin_num, url, fares, fields=ALL_FIELDS):
         self.dominant_mode = None
         self.selected = False
         self.has_alerts = False
-        self.alerts = []
         self.url = url
         self.itin_num = itin_num
         self.transfers = jsn['transfers']
         self.fare = Fare(jsn, fares)
         self.date_info = DateInfoExtended(jsn)
-        self.legs = self.parse_legs(jsn['legs'])
+        legs = self.parse_legs(jsn['legs'], fields)
+        if legs is not None:
+            self.legs = legs
 
-    def set_dominant_mode(self, leg):
+    def set_dominant_mode(self, mode):
         """ dominant transit leg -- rail > bus
         """
         if object_utils.has_content(self.dominant_mode) is False:
-            self.dominant_mode = object_utils.safe_str(leg.mode).lower()
+            self.dominant_mode = object_utils.safe_str(mode).lower()
 
-        if leg.is_transit_mode() and not leg.is_sea_mode():
-            if self.dominant_mode != 'rail' and leg.mode == 'BUS':
+        if is_transit_mode(mode) and not is_sea_mode(mode):
+            if self.dominant_mode != 'rail' and mode == 'BUS':
                 self.dominant_mode = 'bus'
             else:
                 self.dominant_mode = 'rail'
 
-    def parse_legs(self, legs):
+    def parse_legs(self, legs, fields=ALL_FIELDS):
+        """ :return: list of Legs (or None when the legs aren't in the fieldset ... the itinerary is then a summary)
         """
-        """
-        ret_val = []
+        ret_val = None
 
-        # step 1: build the legs
-        for l in legs:
-            leg = Leg(l)
-            ret_val.append(leg)
+        # step 1: build the legs (or when only a summary is wanted, just look at the leg modes)
+        if fields.has('legs'):
+            ret_val = []
+            for l in legs:
+                leg = Leg(l, fields)
+                ret_val.append(leg)
+            modes = [leg.mode for leg in ret_val]
+        else:
+            modes = [l['mode'] for l in legs]
 
         # step 2: find transfer legs e.g., this pattern TRANSIT LEG, WALK/BIKE LEG, TRANSIT LEG
-        num_legs = len(ret_val) 
-        for i, leg in enumerate(ret_val):
-            self.set_dominant_mode(leg)
-            if leg.is_transit_mode() and i+2 < num_legs: 
-                if ret_val[i+2].is_transit_mode() and ret_val[i+1].is_non_transit_mode():
+        num_legs = len(modes)
+        for i, mode in enumerate(modes):
+            self.set_dominant_mode(mode)
+            if is_transit_mode(mode) and i+2 < num_legs:
+                if is_transit_mode(modes[i+2]) and is_non_transit_mode(modes[i+1]):
                     self.transfer = True
 
         # step 3: find 'unique' alerts and build an alerts object for the itinerary
-        alerts_hash = {}
-        for leg in ret_val:
-            if leg.alerts:
-                self.has_alerts = True
-                try:
-                    for a in leg.alerts:
-                        alerts_hash[a.text] = a
-                except Exception as e:
-                    pass
-
-        self.alerts = []
-        for v in alerts_hash.values():
-            self.alerts.append(v)
+        if fields.has('alerts'):
+            alerts_hash = {}
+            for leg in ret_val:
+                if leg.alerts:
+                    self.has_alerts = True
+                    try:
+                        for a in leg.alerts:
+                            alerts_hash[a.text] = a
+                    except Exception as e:
+                        pass
+
+            self.alerts = []
+            for v in alerts_hash.values():
+                self.alerts.append(v)
+        else:
+            for l in legs:
+                if l.get('alerts') and is_transit_mode(l['mode']):
+                    self.has_alerts = True
 
         return ret_val
 
 
-class Plan(object):
+class Plan(Base):
     """ top level class of the ott 'plan' object tree
 
         contains these elements:
           self.from, self.to, self.params, self.arrive_by, self.optimize (plus other helpers 
     """
-    def __init__(self, jsn, params=None, fares=None, path="planner.html?itin_num={0}"):
-        """ creates a self.from and self.to element in the Plan object """
-        Place.factory(jsn['from'], self, 'from')
-        Place.factory(jsn['to'],   self, 'to')
-        self.itineraries = self.parse_itineraries(jsn['itineraries'], path, params, fares)
+    __slots__ = ('from', 'to', 'itineraries', 'params', 'max_walk')
+
+    def __init__(self, jsn, params=None, fares=None, path="planner.html?itin_num={0}", fields=ALL_FIELDS):
+        """ creates a self.from and self.to element in the Plan object
+            :param fields: Fields object (see above), which controls which optional subtrees get built
+        """
+        Place.factory(jsn['from'], self, 'from', fields)
+        Place.factory(jsn['to'],   self, 'to', fields)
+        self.itineraries = self.parse_itineraries(jsn['itineraries'], path, params, fares, fields)
         self.set_plan_params(params)
 
-    def parse_itineraries(self, itineraries, path, params, fares):
+    def parse_itineraries(self, itineraries, path, params, fares, fields=ALL_FIELDS):
         """  TODO explain me...
         """
         ret_val = []
@@ -814,7 +900,7 @@ class Plan(object):
             if params: 
                 url_params = params.ott_url_params()
             url = self.make_itin_url(path, url_params, itin_num)
-            itin = Itinerary(jsn, itin_num, url, fares)
+            itin = Itinerary(jsn, itin_num, url, fares, fields)
             ret_val.append(itin)
 
         # set the selected 
@@ -824,7 +910,8 @@ class Plan(object):
 
         return ret_val
 
-    def make_itin_url(self, path, query_string, itin_num):
+    @classmethod
+    def make_itin_url(cls, path, query_string, itin_num):
         """
         """
         ret_val = None
@@ -837,7 +924,8 @@ class Plan(object):
 
         return ret_val
 
-    def get_selected_itinerary(self, params, max=3):
+    @classmethod
+    def get_selected_itinerary(cls, params, max=3):
         """ return list position (index starts at zero) of the 'selected' itinerary
             @see ParamParser
         """
@@ -852,7 +940,8 @@ class Plan(object):
 
         return ret_val
 
-    def pretty_mode(self, mode):
+    @classmethod
+    def pretty_mode(cls, mode):
         """ TOD0 TODO TODO localize
         """
         ret_val = 'Transit'
@@ -887,24 +976,44 @@ class Plan(object):
     def set_plan_params(self, params):
         """ passed in by a separate routine, rather than parsed from returned itinerary
         """
+        self.params = self.make_plan_params(params)
+        self.max_walk = "1.4"
+
+    @classmethod
+    def make_plan_params(cls, params):
+        ret_val = {}
         if params:
-            self.params  = {
+            ret_val = {
                 "is_arrive_by" : params.arrive_depart,
                 "optimize"     : params.optimize,
                 "map_planner"  : params.map_url_params(),
                 "edit_trip"    : params.ott_url_params(),
                 "return_trip"  : params.ott_url_params_return_trip(),
-                "modes"        : self.pretty_mode(params.mode),
+                "modes"        : cls.pretty_mode(params.mode),
                 "walk"         : pretty_distance_meters(params.walk_meters)
             }
-        else:
-            self.params = {}
-        self.max_walk = "1.4"
+        return ret_val
 
 
 """
 UTILITY METHODS
 """
+def is_transit_mode(mode):
+    return mode in ['BUS', 'TRAM', 'RAIL', 'TRAIN', 'SUBWAY', 'CABLECAR', 'GONDOLA', 'FUNICULAR', 'FERRY']
+
+
+def is_sea_mode(mode):
+    return mode in ['FERRY']
+
+
+def is_air_mode(mode):
+    return mode in ['GONDOLA']
+
+
+def is_non_transit_mode(mode):
+    return mode in ['BIKE', 'BICYCLE', 'WALK', 'CAR', 'AUTO']
+
+
 def get_element(jsn, name, def_val=None):
     """
     """
@@ -1041,7 +1150,7 @@ def main():
     pretty = False
     if argv:
         pretty = 'pretty' in argv or 'p' in argv
-    y = json_utils.json_repr(p, pretty)
+    y = p.to_json(pretty)
     print(y)
 
 
@@ -0,0 +1,39 @@
+""" Server side cache of (serialized) trip plans, keyed on the (normalized) trip parameters
+"""
+from ott.otp_client.cache_utils import TtlLruCache
+
+import logging
+log = logging.getLogger(__file__)
+
+
+class PlanCache(TtlLruCache):
+    """ TTL + LRU cache of plan_trip() json responses
+
+        a plan echoes its request back (the from / to places, plus the edit_trip, return_trip, map_planner and
+        itinerary urls), so the key is every request param that gets echoed ... the (geocoded) OTP, OTT and map
+        planner url params, exactly as the TripParamParser normalizes them ... plus anything else that changes our
+        response (the fields projection, pretty printing, language, etc...)
+
+        .ini settings: plan_cache_size (0 turns caching off) and plan_cache_ttl (seconds)
+    """
+    def __init__(self, max_size=1000, ttl=60, name='plan_cache'):
+        super(PlanCache, self).__init__(max_size, ttl, name)
+
+    @classmethod
+    def make_key(cls, param, *extra):
+        """ :return: (hashable) key for a TripParamParser, plus any extra (response changing) values """
+        ret_val = [param.otp_url_params(), param.ott_url_params(), param.map_url_params()]
+        ret_val.extend(extra)
+        return tuple(ret_val)
+
+    @classmethod
+    def from_settings(cls, settings, prefix='plan_cache', max_size=1000, ttl=60):
+        ret_val = None
+        size = int(settings.get('{}_size'.format(prefix), max_size))
+        if size > 0:
+            ret_val = cls(
+                max_size=size,
+                ttl=float(settings.get('{}_ttl'.format(prefix), ttl)),
+                name=prefix
+            )
+        return ret_val
@@ -1,4 +1,6 @@
 from ott.utils.svr.pyramid.app_config import AppConfig
+from ott.otp_client.metrics import TimedDatabase
+from ott.otp_client.settings_utils import is_true
 
 import logging
 log = logging.getLogger(__file__)
@@ -16,9 +18,15 @@ def main(global_config, **ini_settings):
     from gtfsdb import Database
     kw = app.gtfsdb_param_from_config()
     db = Database(**kw)
-    app.set_db(db)
+    app.set_db(TimedDatabase(db))  # times each managed_session() for /metrics
+
+    if is_true(ini_settings.get('stop_index', 'false')):
+        from ott.otp_client.transit_index.stops import Stops
+        from ott.otp_client.transit_index.stop_index import StopIndex
+        Stops.stop_index = StopIndex.from_db(db, float(ini_settings.get('stop_index_cell_deg', 0.01)))
 
     from . import views
     app.config_include_scan(views)
+    views.warm_up()
 
     return app.make_wsgi_app()
@@ -2,20 +2,35 @@ from pyramid.response import Response
 from pyramid.view import view_config
 
 from ott.otp_client.trip_planner import TripPlanner
+from ott.otp_client.trip_planner import parse_batch
+from ott.otp_client.plan_cache import PlanCache
+from ott.otp_client.cache_utils import SingleFlight
+from ott.otp_client.otp_backends import OtpBackends
+from ott.otp_client.timing import StageTimer
+from ott.otp_client.metrics import METRICS
+from ott.otp_client.settings_utils import is_true
+from ott.otp_client import metrics as metrics_utils
+from ott.otp_client.geocoder import PooledGeoSolr
+from ott.otp_client.geocoder import CachingGeocoder
+from ott.otp_client import http_utils
 from ott.otp_client.transit_index.routes import Routes
 from ott.otp_client.transit_index.stops import Stops
 from ott.otp_client.transit_index.patterns import Patterns
+from ott.otp_client.transit_index.feed_version import FeedWatcher
+from ott.otp_client.transit_index.route_cache import RouteListCache
+from ott.otp_client.transit_index.stop_routes_index import StopRoutesIndex
+from ott.otp_client.transit_index.pattern_cache import PatternGeometryCache
 
 from ott.geocoder.geosolr import GeoSolr
 from ott.utils.parse.url.param_parser import ParamParser
 from ott.utils.parse.url.geo_param_parser import GeoParamParser
 
 from ott.utils import otp_utils
-from ott.utils import json_utils
 
 from ott.utils.svr.pyramid import response_utils
 from ott.utils.svr.pyramid import globals
 
+import simplejson as json
 import logging
 log = logging.getLogger(__file__)
 
@@ -33,6 +48,7 @@ def set_app_config(app_cfg):
 def do_view_config(cfg):
     cfg.add_route('plan_trip', '/plan_trip')
     cfg.add_route('ti_plan_trip', '/ti/plan_trip')
+    cfg.add_route('plan_trips', '/plan_trips')
 
     cfg.add_route('ti_route_patterns', '/ti/routes/{route}/patterns')
     cfg.add_route('ti_route', '/ti/routes/{route}')
@@ -48,6 +64,10 @@ def do_view_config(cfg):
     cfg.add_route('ti_pattern_geom_geojson', '/ti/patterns/{agency}:{pattern}/geometry/geojson')
     cfg.add_route('ti_pattern_geom_via_trip_geojson', '/ti/patterns/trip/{agency}:{trip}/geometry/geojson')
 
+    cfg.add_route('metrics', '/metrics')
+    cfg.add_tween('ott.otp_client.metrics.metrics_tween_factory')
+    cfg.add_tween('ott.otp_client.query_stats.query_stats_tween_factory')
+
 
 @view_config(route_name='ti_pattern_geom_geojson', renderer='json', http_cache=globals.CACHE_LONG)
 def pattern_geom_geojson(request):
@@ -59,7 +79,7 @@ def pattern_geom_geojson(request):
     # import pdb; pdb.set_trace()
     pattern_id = request.matchdict['pattern']
     agency_id = request.matchdict['agency']
-    return Patterns.query_geometry_geojson(APP_CONFIG, pattern_id, agency_id)
+    return pattern_geom_response(pattern_id, agency_id, 'geojson')
 
 
 @view_config(route_name='ti_pattern_geom_via_trip_geojson', renderer='json', http_cache=globals.CACHE_LONG)
@@ -72,7 +92,7 @@ def pattern_geom_via_trip_geojson(request):
     trip_id = request.matchdict['trip']
     agency_id = request.matchdict['agency']
     pattern_id = Patterns.query_pattern_id_from_trip_id(APP_CONFIG, trip_id, agency_id)
-    return Patterns.query_geometry_geojson(APP_CONFIG, pattern_id, agency_id)
+    return pattern_geom_response(pattern_id, agency_id, 'geojson')
 
 
 @view_config(route_name='ti_pattern_geom', renderer='json', http_cache=globals.CACHE_LONG)
@@ -86,7 +106,7 @@ def pattern_geom(request):
     # import pdb; pdb.set_trace()
     pattern_id = request.matchdict['pattern']
     agency_id = request.matchdict['agency']
-    return Patterns.query_geometry_encoded(APP_CONFIG, pattern_id, agency_id)
+    return pattern_geom_response(pattern_id, agency_id, 'encoded')
 
 
 @view_config(route_name='ti_pattern_geom_ti', renderer='json', http_cache=globals.CACHE_LONG)
@@ -120,7 +140,7 @@ def pattern_geom_ti(request):
     agency_id, route_id = otp_utils.breakout_agency_id(route)
     pattern_id = request.matchdict['pattern']
 
-    return Patterns.query_geometry_encoded(APP_CONFIG, pattern_id, agency_id)
+    return pattern_geom_response(pattern_id, agency_id, 'encoded')
 
 
 @view_config(route_name='ti_nearest_stops', renderer='json', http_cache=globals.CACHE_LONG)
@@ -133,8 +153,9 @@ def nearest_stops(request):
     agency_id = APP_CONFIG.get_agency(params)
     if params.has_radius():
         limit = params.get_first_val_as_int('limit', 10)
+        radius = params.get_first_val_as_int('radius', None)
         with APP_CONFIG.db.managed_session(timeout=10) as session:
-            ret_val = Stops.nearest_stops(session, params.point, agency_id, limit)
+            ret_val = Stops.nearest_stops(session, params.point, agency_id, limit, radius=radius)
     elif params.has_bbox():
         limit = params.get_first_val_as_int('limit', 1000)
         with APP_CONFIG.db.managed_session(timeout=10) as session:
@@ -204,19 +225,8 @@ def stop_routes_str(request):
       routes: "200::MAX Green Line:;190::MAX Yellow Line:"
     """
     # import pdb; pdb.set_trace()
-    ret_val = ""
-    #import pdb; pdb.set_trace()
     routes = stop_routes(request)
-    if routes and len(routes):
-        spc = ""
-        for r in routes:
-            snow_stop = ""  # data not in GTFS atm, but....
-            agency_id, route_id = otp_utils.breakout_agency_id(r.get("id"))
-            long_name = r.get("longName", "")
-            short_name = r.get("shortName", "")
-            rte = "{}:{}:{}:{}".format(route_id, short_name, long_name, snow_stop)
-            ret_val = "{}{}{}".format(ret_val, spc, rte)
-            spc = ";"
+    ret_val = Routes.routes_str(routes)
     return ret_val
 
 
@@ -228,6 +238,11 @@ def route_list(request):
     """
     params = ParamParser(request)
     agency_id = APP_CONFIG.get_agency(params)
+    cache = get_route_list_cache()
+    if cache:
+        body = cache.get(agency_id, params.get_date())
+        if body is not None:
+            return Response(body=body, content_type='application/json', charset='utf-8')
     with APP_CONFIG.db.managed_session(timeout=10) as session:
         ret_val = Routes.route_list_factory(session, params.get_date(), agency_id)
     return ret_val
@@ -267,17 +282,30 @@ def route_patterns(request):
     """
     route = request.matchdict['route']
     ti_url = "{}/index/routes/{}/patterns".format(get_otp_url(), route)
-    ret_val = json_utils.proxy_json(ti_url)
+    ret_val = http_utils.get_pool('otp', APP_CONFIG.ini_settings).get_json(ti_url)
     return ret_val
 
 
 @view_config(route_name='plan_trip', renderer='json', http_cache=globals.CACHE_SHORT)
 @view_config(route_name='ti_plan_trip', renderer='json', http_cache=globals.CACHE_SHORT)
 def plan_trip(request):
+    """
+    :note: with the plan_trip_stream setting (or a stream=true param), the plan is streamed back one itinerary at a
+           time (see TripPlanner.iter_trip), rather than built and serialized whole ... the streamed Server-Timing
+           header only covers the stages up to the OTP call (the rest go to the /metrics stage histograms)
+    """
     ret_val = None
     try:
-        trip = get_planner().plan_trip(request)
+        timer = StageTimer()
+        if is_true(APP_CONFIG.ini_settings.get('plan_trip_stream', 'false')) or is_true(request.params.get('stream')):
+            chunks = get_planner().iter_trip(request, timer=timer)
+            ret_val = Response(app_iter=(c.encode('utf-8') for c in chunks), content_type='application/json', charset='utf-8')
+            ret_val.headers['Server-Timing'] = timer.server_timing()
+            return ret_val
+
+        trip = get_planner().plan_trip(request, timer=timer)
         ret_val = response_utils.json_response(trip)
+        ret_val.headers['Server-Timing'] = timer.server_timing()
     except Exception as e:
         log.warning(e)
         ret_val = response_utils.sys_error_response()
@@ -286,20 +314,174 @@ def plan_trip(request):
     return ret_val
 
 
+@view_config(route_name='plan_trips', request_method='POST')
+def plan_trips(request):
+    """
+    Batch trip planning: POST a json list (or ndjson lines) of trips, and get back ndjson plans as they complete
+    :see trip_planner.parse_batch for the POST format
+    :returns: ndjson lines of {"id": <trip id>, "response": <plan_trip response>} ... or a 413 error for a batch of
+              more than batch_max_trips trips
+    """
+    try:
+        trips = list(parse_batch(request.text))
+    except Exception as e:
+        log.warning(e)
+        return response_utils.sys_error_response()
+
+    max_trips = int(APP_CONFIG.ini_settings.get('batch_max_trips', 10000))
+    concurrency = int(APP_CONFIG.ini_settings.get('batch_concurrency', 8))
+    if len(trips) > max_trips:
+        msg = "batch of {} trips is bigger than the {} trip limit".format(len(trips), max_trips)
+        log.warning(msg)
+        body = json.dumps({'error': {'id': 413, 'msg': msg}})
+        return Response(status=413, body=body.encode('utf-8'), content_type='application/json', charset='utf-8')
+
+    def ndjson():
+        for trip_id, plan in get_planner().plan_trips(trips, concurrency):
+            line = '{{"id": {}, "response": {}}}\n'.format(json.dumps(trip_id), plan)
+            yield line.encode('utf-8')
+
+    return Response(app_iter=ndjson(), content_type='application/x-ndjson', charset='utf-8')
+
+
+@view_config(route_name='metrics')
+def metrics(request):
+    """
+    Prometheus (text format) metrics: latency histograms and error counts per route, OTP / SOLR http calls, DB
+    sessions and plan_trip stages, plus waitress queue depth and cache / pool / backend counters
+    """
+    gauges = metrics_utils.waitress_gauges()
+    for p in http_utils.all_stats():
+        for k in ('requests', 'errors', 'connections', 'reused'):
+            gauges.append(('http_pool_' + k, p[k], {'backend': p['name']}))
+
+    planner = getattr(APP_CONFIG, 'trip_planner', None)
+    if planner:
+        caches = [planner.plan_cache, getattr(planner.geo, 'cache', None)]
+        for c in caches:
+            if c is None:
+                continue
+            st = c.stats()
+            for k in ('size', 'hits', 'misses', 'evictions', 'expirations'):
+                gauges.append(('cache_' + k, st[k], {'cache': st['name']}))
+        if planner.single_flight:
+            st = planner.single_flight.stats()
+            for k in ('calls', 'coalesced', 'timeouts', 'in_flight'):
+                gauges.append(('plan_coalesce_' + k, st[k], {}))
+        for b in planner.otp.stats():
+            gauges.append(('otp_backend_in_flight', b['in_flight'], {'backend': b['url']}))
+            gauges.append(('otp_backend_hedges', b['hedges'], {'backend': b['url']}))
+            gauges.append(('otp_backend_errors', b['errors'], {'backend': b['url']}))
+            gauges.append(('otp_backend_open', 1 if b['open'] else 0, {'backend': b['url']}))
+        for c in planner.content.stats():
+            gauges.append(('content_failures', c['failures'], {'content': c['name']}))
+            gauges.append(('content_age_seconds', c['age'], {'content': c['name']}))
+
+    body = METRICS.to_prometheus(gauges)
+    return Response(body=body.encode('utf-8'), content_type='text/plain', charset='utf-8')
+
+
+def get_otp_urls():
+    """ :return: list of OTP urls (the otp_url setting can be a comma separated list of OTP servers) """
+    if getattr(APP_CONFIG, 'otp_urls', None) is None:
+        urls = APP_CONFIG.ini_settings.get('otp_url', '')
+        APP_CONFIG.otp_urls = [u.strip() for u in urls.split(',') if u.strip()]
+    return APP_CONFIG.otp_urls
+
+
 def get_otp_url():
     if getattr(APP_CONFIG, 'otp_url', None) is None:
-        APP_CONFIG.otp_url = APP_CONFIG.ini_settings.get('otp_url')
+        APP_CONFIG.otp_url = get_otp_urls()[0]
     return APP_CONFIG.otp_url
 
 
+def get_feed_watcher():
+    """ FeedWatcher (stored in our APP_CONFIG), telling the TI caches when a new gtfsdb feed is loaded """
+    if getattr(APP_CONFIG, 'feed_watcher', None) is None:
+        APP_CONFIG.feed_watcher = FeedWatcher.from_settings(APP_CONFIG.db, APP_CONFIG.ini_settings)
+    return APP_CONFIG.feed_watcher
+
+
+def get_route_list_cache():
+    """ prebuilt /ti/routes responses (or None, when route_list_cache is off) """
+    if getattr(APP_CONFIG, 'route_list_cache', None) is None:
+        cache = False
+        if is_true(APP_CONFIG.ini_settings.get('route_list_cache', 'false')):
+            cache = RouteListCache.from_settings(APP_CONFIG.db, get_feed_watcher(), APP_CONFIG.ini_settings)
+        APP_CONFIG.route_list_cache = cache
+    return APP_CONFIG.route_list_cache
+
+
+def pattern_geom_response(pattern_id, agency_id, fmt='encoded'):
+    """
+    pattern geometry from the pattern cache, as a json response with an ETag (so If-None-Match requests get a 304) ...
+    or else (no cache) the geometry straight from gtfsdb
+    """
+    cached = Patterns.cached_geometry(APP_CONFIG, pattern_id, agency_id, fmt)
+    if cached:
+        body, etag = cached
+        ret_val = Response(body=body, content_type='application/json', charset='utf-8', conditional_response=True)
+        ret_val.etag = etag
+    elif fmt == 'geojson':
+        ret_val = Patterns.query_geometry_geojson(APP_CONFIG, pattern_id, agency_id)
+    else:
+        ret_val = Patterns.query_geometry_encoded(APP_CONFIG, pattern_id, agency_id)
+    return ret_val
+
+
+def warm_up():
+    """ called at startup: prebuild the TI caches and indexes, and have them rebuilt when a new feed is loaded """
+    try:
+        watcher = get_feed_watcher()
+        watcher.check(force=True)
+        if Stops.stop_index:
+            def rebuild_stop_index(version):
+                with APP_CONFIG.db.managed_session(timeout=10) as session:
+                    Stops.stop_index.rebuild(session)
+            watcher.add_listener(rebuild_stop_index)
+
+        if is_true(APP_CONFIG.ini_settings.get('stop_routes_index', 'false')):
+            Routes.stop_routes_index = StopRoutesIndex.from_db(APP_CONFIG.db)
+
+            def rebuild_stop_routes_index(version):
+                with APP_CONFIG.db.managed_session(timeout=10) as session:
+                    Routes.stop_routes_index.rebuild(session)
+            watcher.add_listener(rebuild_stop_routes_index)
+
+        cache = get_route_list_cache()
+        if cache:
+            cache.warm([APP_CONFIG.ini_settings.get('agency_id')])
+
+        Patterns.geometry_cache = PatternGeometryCache.from_settings(APP_CONFIG.db, watcher, APP_CONFIG.ini_settings)
+        if Patterns.geometry_cache is not None and is_true(APP_CONFIG.ini_settings.get('pattern_cache_warm', 'false')):
+            Patterns.geometry_cache.warm([APP_CONFIG.ini_settings.get('agency_id')])
+
+        # poll for new feeds in the background (the listeners above then rebuild off the request threads)
+        watcher.start()
+    except Exception as e:
+        log.warning(e)
+
+
 def get_planner():
     """ cache's up TripPlanner object (stores it in our APP_CONFIG) """
     # import pdb; pdb.set_trace()
     if getattr(APP_CONFIG, 'trip_planner', None) is None:
-        planner_url = get_otp_url() + '/plan'  # todo ... url append method available?
+        planner_urls = [u + '/plan' for u in get_otp_urls()]  # todo ... url append method available?
         advert_url = APP_CONFIG.ini_settings.get('advert_url')
         fare_url = APP_CONFIG.ini_settings.get('fare_url')
         cancelled_url = APP_CONFIG.ini_settings.get('cancelled_routes_url')
-        solr = GeoSolr(APP_CONFIG.ini_settings.get('solr_url'))
-        APP_CONFIG.trip_planner = TripPlanner(otp_url=planner_url, solr=solr, adverts=advert_url, fares=fare_url, cancelled_routes=cancelled_url)
+        solr_url = APP_CONFIG.ini_settings.get('solr_url')
+        if is_true(APP_CONFIG.ini_settings.get('solr_pooled', 'true')):
+            solr = PooledGeoSolr(solr_url, http_utils.get_pool('solr', APP_CONFIG.ini_settings))
+        else:
+            solr = GeoSolr(solr_url)
+        solr = CachingGeocoder.from_settings(solr, APP_CONFIG.ini_settings)
+        plan_cache = PlanCache.from_settings(APP_CONFIG.ini_settings)
+        single_flight = SingleFlight.from_settings(APP_CONFIG.ini_settings, 'plan_coalesce')
+        otp_pool = http_utils.get_pool('otp', APP_CONFIG.ini_settings)
+        otp_backends = OtpBackends.from_settings(planner_urls, otp_pool, APP_CONFIG.ini_settings)
+        slow_ms = float(APP_CONFIG.ini_settings.get('plan_slow_ms', 0))
+        content_refresh = float(APP_CONFIG.ini_settings.get('content_refresh_secs', 300))
+        langs = tuple(l.strip() for l in APP_CONFIG.ini_settings.get('content_langs', 'en,es').split(','))
+        APP_CONFIG.trip_planner = TripPlanner(otp_url=planner_urls, solr=solr, adverts=advert_url, fares=fare_url, cancelled_routes=cancelled_url, plan_cache=plan_cache, otp_pool=otp_pool, single_flight=single_flight, content_refresh=content_refresh, langs=langs, otp_backends=otp_backends, slow_ms=slow_ms)
     return APP_CONFIG.trip_planner
@@ -0,0 +1,152 @@
+""" SQL query counts and timings per request (via SQLAlchemy engine events), with N+1 detection
+
+    the TI views build their output from (lazy) gtfsdb ORM relationships, so a request can quietly run a query per
+    row ... counting queries per request, and looking for the same SQL statement run over and over, shows that up
+
+    - install() hooks the engine's before / after_cursor_execute events, and counts queries for every thread that is
+      inside a count_queries() block
+    - query_stats_tween_factory counts the queries of each request, adding X-Query-Count / X-Query-Ms headers and
+      logging (plus the db_n_plus_1 counter in /metrics) any request repeating a statement query_stats_repeats times
+    - query_budget() is the test mode ... it raises QueryBudgetExceeded when a block runs more queries than allowed
+
+    .ini settings:
+      query_stats = false           # count and time the SQL queries of every request
+      query_stats_header = true     # add the X-Query-* debug headers to responses
+      query_stats_repeats = 5       # a statement run this many times in one request is flagged as a likely N+1
+"""
+import time
+import threading
+import contextlib
+
+from ott.otp_client.metrics import METRICS
+from ott.otp_client.settings_utils import is_true
+
+import logging
+log = logging.getLogger(__file__)
+
+
+_LOCAL = threading.local()
+_INSTALLED = set()
+
+
+class QueryStats(object):
+    """ number of queries, time spent (ms) and number of runs per SQL statement, for a block of code (or request) """
+    def __init__(self):
+        self.count = 0
+        self.ms = 0.0
+        self.statements = {}
+
+    def add(self, statement, ms):
+        self.count += 1
+        self.ms += ms
+        self.statements[statement] = self.statements.get(statement, 0) + 1
+
+    def repeated(self, min_repeats=5):
+        """ :return: list of (statement, runs) for statements run at least min_repeats times ... most runs first """
+        ret_val = [(s, n) for s, n in self.statements.items() if n >= min_repeats]
+        ret_val.sort(key=lambda x: x[1], reverse=True)
+        return ret_val
+
+    def to_dict(self):
+        return {'count': self.count, 'ms': round(self.ms, 1), 'statements': len(self.statements)}
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def _active():
+    ret_val = getattr(_LOCAL, 'stack', None)
+    if ret_val is None:
+        ret_val = _LOCAL.stack = []
+    return ret_val
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    if _active():
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+    if starts:
+        ms = (time.perf_counter() - starts.pop()) * 1000.0
+        for stats in _active():
+            stats.add(statement, ms)
+
+
+def install(engine=None):
+    """ listen to the query events of an engine (default: every SQLAlchemy engine) ... safe to call more than once """
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    target = engine if engine is not None else Engine
+    if id(target) not in _INSTALLED:
+        event.listen(target, 'before_cursor_execute', _before_execute)
+        event.listen(target, 'after_cursor_execute', _after_execute)
+        _INSTALLED.add(id(target))
+
+
+@contextlib.contextmanager
+def count_queries():
+    """ count (and time) the queries run by this thread inside the block ... blocks can be nested
+        with count_queries() as stats:
+            ...
+        print(stats.count, stats.ms)
+    """
+    install()
+    stats = QueryStats()
+    stack = _active()
+    stack.append(stats)
+    try:
+        yield stats
+    finally:
+        stack.remove(stats)
+
+
+@contextlib.contextmanager
+def query_budget(max_queries, min_repeats=None):
+    """ test mode: raise QueryBudgetExceeded if the block runs more than max_queries queries (or, when min_repeats is
+        given, runs any one statement min_repeats or more times)
+    """
+    with count_queries() as stats:
+        yield stats
+    if stats.count > max_queries:
+        raise QueryBudgetExceeded("{} queries run, but the budget is {}".format(stats.count, max_queries))
+    if min_repeats:
+        repeated = stats.repeated(min_repeats)
+        if repeated:
+            raise QueryBudgetExceeded("likely N+1: statement run {} times: {}".format(repeated[0][1], repeated[0][0][:200]))
+
+
+def query_stats_tween_factory(handler, registry):
+    """ pyramid tween, counting the SQL queries of each request (when the query_stats setting is on) """
+    settings = registry.settings or {}
+    if not is_true(settings.get('query_stats', 'false')):
+        return handler
+
+    install()
+    add_header = is_true(settings.get('query_stats_header', 'true'))
+    min_repeats = int(settings.get('query_stats_repeats', 5))
+
+    def query_stats_tween(request):
+        with count_queries() as stats:
+            response = handler(request)
+
+        if stats.count > 0:
+            route = request.matched_route.name if getattr(request, 'matched_route', None) else 'none'
+            METRICS.inc('db_queries', stats.count, route=route)
+            METRICS.observe('db_query_time', stats.ms, route=route)
+
+            repeated = stats.repeated(min_repeats)
+            if repeated:
+                METRICS.inc('db_n_plus_1', route=route)
+                log.warning("likely N+1 in {}: {} queries ({:.1f} ms), with a statement run {} times: {}".format(
+                    request.path_qs, stats.count, stats.ms, repeated[0][1], repeated[0][0][:200]))
+
+            if add_header:
+                response.headers['X-Query-Count'] = str(stats.count)
+                response.headers['X-Query-Ms'] = "{:.1f}".format(stats.ms)
+                if repeated:
+                    response.headers['X-Query-Repeats'] = str(repeated[0][1])
+        return response
+    return query_stats_tween
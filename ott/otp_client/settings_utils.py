@@ -0,0 +1,6 @@
+""" helpers for reading the .ini settings """
+
+
+def is_true(val):
+    """ :return: True when a setting's value is 'true', 'yes', 'on' or '1' (in any case) """
+    return str(val).lower() in ('true', 'yes', 'on', '1')
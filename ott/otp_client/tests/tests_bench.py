@@ -0,0 +1,49 @@
+import os
+import unittest
+
+from ott.otp_client.bench import replay
+
+
+class ReplayTest(unittest.TestCase):
+
+    def test_read_requests(self):
+        routes = [replay.Route('ti_stop', '/ti/stops/{stop}'), replay.Route('plan_trip', '/plan_trip')]
+        self.assertEqual(replay.route_name(routes, '/ti/stops/TriMet:2'), 'ti_stop')
+        self.assertIsNone(replay.route_name(routes, '/ti/stops/TriMet:2/routes'))
+
+        urls = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'json', 'urls.txt')
+        reqs = replay.read_requests([urls], routes)
+        self.assertTrue(len(reqs) >= 4)
+        for name, method, path, body in reqs:
+            self.assertEqual(name, 'plan_trip')
+            self.assertTrue(path.startswith('/plan_trip?'))
+
+    def test_replay(self):
+        reqs = [('a', 'GET', '/a', None), ('b', 'GET', '/b', None)]
+        stats, secs = replay.replay(lambda m, p, b: 500 if p == '/b' else 200, reqs, num=10, concurrency=2)
+        report = dict((r['route'], r) for r in stats.report(secs))
+        self.assertEqual(report['a']['count'], 5)
+        self.assertEqual(report['b']['errors'], 5)
+        self.assertEqual(report['ALL']['count'], 10)
+
+
+class PlanBenchTest(unittest.TestCase):
+
+    def test_regressions(self):
+        from ott.otp_client.bench import plan_bench
+        baseline = {'a': {'parse_ms': 1.0, 'json_ms': 1.0, 'peak_kb': 100.0}}
+        ok = {'a': {'parse_ms': 1.1, 'json_ms': 0.5, 'peak_kb': 105.0}, 'new': {'parse_ms': 9.0}}
+        self.assertEqual(plan_bench.find_regressions(ok, baseline, 0.2, 0.1), [])
+        bad = {'a': {'parse_ms': 1.5, 'json_ms': 1.0, 'peak_kb': 120.0}}
+        self.assertEqual(len(plan_bench.find_regressions(bad, baseline, 0.2, 0.1)), 2)
+
+    def test_measure(self):
+        from ott.otp_client import otp_to_ott
+        from ott.otp_client.bench import plan_bench
+        name, jsn = plan_bench.get_fixtures(['plan_walk'])[0]
+        leg_init = otp_to_ott.Leg.__init__
+        m = plan_bench.measure(otp_to_ott, jsn, num=1)
+        self.assertTrue(m['parse_ops'] > 0)
+        self.assertEqual(sorted(m['class_ms']), sorted(plan_bench.CLASS_NAMES))
+        self.assertTrue(m['class_ms']['Leg'] > 0)
+        self.assertIs(otp_to_ott.Leg.__init__, leg_init)  # un-patched after the per class timings
@@ -0,0 +1,114 @@
+import time
+import unittest
+
+from ott.otp_client.cache_utils import TtlLruCache
+from ott.otp_client.cache_utils import MISSING
+from ott.otp_client.plan_cache import PlanCache
+
+
+class MockParams(object):
+    """ just enough of a TripParamParser for PlanCache.make_key() """
+    def __init__(self, url_params, ott_params=None):
+        self.url_params = url_params
+        self.ott_params = ott_params or url_params
+
+    def otp_url_params(self):
+        return self.url_params
+
+    def ott_url_params(self):
+        return self.ott_params
+
+    def map_url_params(self):
+        return self.ott_params
+
+
+class CacheTest(unittest.TestCase):
+
+    def test_lru(self):
+        c = TtlLruCache(max_size=2, ttl=60)
+        c.put('a', 1)
+        c.put('b', 2)
+        self.assertEqual(c.get('a'), 1)  # a is now most recently used
+        c.put('c', 3)
+        self.assertEqual(c.get('b'), MISSING)
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('c'), 3)
+        self.assertEqual(c.stats()['evictions'], 1)
+        self.assertEqual(c.stats()['hits'], 3)
+        self.assertEqual(c.stats()['misses'], 1)
+
+    def test_ttl(self):
+        c = TtlLruCache(max_size=10, ttl=0.05)
+        c.put('a', None)
+        self.assertIsNone(c.get('a'))  # None is a cache-able (negative) value
+        c.put('b', 'b', ttl=60)
+        time.sleep(0.1)
+        self.assertEqual(c.get('a'), MISSING)
+        self.assertEqual(c.get('b'), 'b')
+        self.assertEqual(c.stats()['expirations'], 1)
+
+    def test_plan_cache_key(self):
+        """ only requests echoing the same params back share a key """
+        c = PlanCache()
+        k1 = c.make_key(MockParams("fromPlace=PDX::45.58812,-122.59301&toPlace=45.5,-122.6&time=1:41pm"), ('fields', 'x'))
+        k2 = c.make_key(MockParams("fromPlace=PDX::45.58812,-122.59301&toPlace=45.5,-122.6&time=1:41pm"), ('fields', 'x'))
+        self.assertEqual(k1, k2)
+
+        k3 = c.make_key(MockParams("fromPlace=PDX::45.58812,-122.59302&toPlace=45.5,-122.6&time=1:41pm"), ('fields', 'x'))
+        self.assertNotEqual(k1, k3)
+        k4 = c.make_key(MockParams("fromPlace=PDX::45.58812,-122.59301&toPlace=45.5,-122.6&time=1:42pm"), ('fields', 'x'))
+        self.assertNotEqual(k1, k4)
+        k5 = c.make_key(MockParams("fromPlace=PDX::45.58812,-122.59301&toPlace=45.5,-122.6&time=1:41pm"), ('fields', 'y'))
+        self.assertNotEqual(k1, k5)
+        k6 = c.make_key(MockParams("fromPlace=PDX::45.58812,-122.59301&toPlace=45.5,-122.6&time=1:41pm", "itin_num=2"), ('fields', 'x'))
+        self.assertNotEqual(k1, k6)
+
+    def test_geocode_cache(self):
+        from ott.otp_client.geocoder import CachingGeocoder
+
+        class MockGeo(object):
+            calls = 0
+
+            def geostr(self, search, def_val=None):
+                self.calls += 1
+                return "PDX::45.5881,-122.593" if search.lower() == 'pdx' else def_val
+
+        geo = CachingGeocoder(MockGeo(), TtlLruCache(max_size=10, ttl=60))
+        self.assertEqual(geo.geostr('PDX'), "PDX::45.5881,-122.593")
+        self.assertEqual(geo.geostr(' pdx '), "PDX::45.5881,-122.593")
+        self.assertIsNone(geo.geostr('xyz'))
+        self.assertEqual(geo.geostr('XYZ', 'def'), 'def')  # negative cache hit
+        self.assertEqual(geo.geo.calls, 2)
+
+    def test_single_flight(self):
+        import threading
+        from ott.otp_client.cache_utils import SingleFlight
+
+        sf = SingleFlight(timeout=5)
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def slow_call(v):
+            started.set()
+            release.wait(5)
+            return v
+
+        def worker(v):
+            results.append(sf.do('key', slow_call, v))
+
+        leader = threading.Thread(target=worker, args=('first',))
+        leader.start()
+        started.wait(5)
+        waiters = [threading.Thread(target=worker, args=('other',)) for _ in range(3)]
+        for w in waiters:
+            w.start()
+        while sf.stats()['coalesced'] < 3:
+            time.sleep(0.01)
+        release.set()
+        for t in [leader] + waiters:
+            t.join()
+
+        self.assertEqual(results, ['first'] * 4)
+        self.assertEqual(sf.stats()['calls'], 1)
+        self.assertEqual(sf.stats()['in_flight'], 0)
@@ -0,0 +1,52 @@
+import unittest
+
+from ott.otp_client.content import ContentRefresher
+from ott.otp_client.otp_to_ott import Fare
+
+
+class MockFares(object):
+    def __init__(self, adult_day):
+        self.adult_day = adult_day
+        self.queries = 0
+
+    def query(self, name, def_val=None):
+        self.queries += 1
+        return self.adult_day if name == 'adult_day' else def_val
+
+
+class ContentTest(unittest.TestCase):
+
+    def test_refresh(self):
+        loads = [MockFares("$5.00"), None, MockFares("$6.00")]
+        c = ContentRefresher()
+        c.add_source('fares', lambda: loads.pop(0), queries=Fare.FARE_INFO)
+
+        c.refresh_all()
+        fares = c.get('fares')
+        self.assertEqual(fares.query('adult_day', '$5.00'), "$5.00")
+        self.assertEqual(fares.content.queries, len(Fare.FARE_INFO))  # answered from the snapshot
+
+        c.refresh_all()  # bad load ... keep the last good snapshot
+        self.assertIs(c.get('fares'), fares)
+        self.assertEqual(c.stats()[0]['failures'], 1)
+
+        c.refresh_all()
+        self.assertEqual(c.get('fares').query('adult_day', '$1.00'), "$6.00")
+        self.assertEqual(fares.query('adult_day', '$5.00'), "$5.00")  # old snapshots don't change
+
+    def test_fare_info(self):
+        f = Fare({}, MockFares("$7.00"))
+        self.assertEqual(f.adult, "$2.50")
+        self.assertEqual(f.adult_day, "$7.00")
+        self.assertEqual(f.honored, "$1.25")
+        self.assertIsNone(f.notes)
+
+    def test_start(self):
+        """ start() does the first load before returning ... is_loaded() waits on every source's first good load """
+        c = ContentRefresher()
+        c.add_source('fares', lambda: MockFares("$5.00"), interval=60)
+        c.add_source('adverts', lambda: None, interval=60)
+        c.start()
+        c.stop()
+        self.assertEqual(c.get('fares').adult_day, "$5.00")
+        self.assertFalse(c.is_loaded())  # the adverts never loaded
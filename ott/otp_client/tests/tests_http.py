@@ -0,0 +1,168 @@
+import time
+import unittest
+
+from ott.otp_client import http_utils
+from ott.otp_client.otp_backends import OtpBackends
+from ott.otp_client.metrics import LatencyHistogram
+
+
+class HttpPoolTest(unittest.TestCase):
+    def test_from_settings(self):
+        settings = {'xyz_pool_size': '7', 'xyz_connect_timeout': '1.5', 'xyz_read_timeout': '9', 'xyz_keep_alive': 'false'}
+        p = http_utils.HttpPool.from_settings(settings, 'xyz')
+        self.assertEqual(p.timeout, (1.5, 9.0))
+        self.assertFalse(p.keep_alive)
+        self.assertEqual(p.adapter._pool_maxsize, 7)
+        self.assertEqual(p.stats()['requests'], 0)
+
+    def test_get_pool(self):
+        p = http_utils.get_pool('test_pool')
+        self.assertIs(p, http_utils.get_pool('test_pool', {'test_pool_pool_size': 1}))
+
+
+class MockPool(object):
+    """ fake HttpPool, where the 'slow' server takes a while, and the 'down' server always fails """
+    def get_text(self, url):
+        if 'slow' in url:
+            time.sleep(0.5)
+        if 'down' in url:
+            raise IOError("timed out")
+        return url
+
+
+class OtpBackendsTest(unittest.TestCase):
+
+    def test_hedge(self):
+        """ a slow primary gets a hedge, and the first good response (the hedge's) wins ... a failed one hedges right away """
+        pool = MockPool()
+        b = OtpBackends(['http://slow/plan', 'http://fast/plan'], pool, hedge_ms=50)
+        b.backends[1].ewma = 1000.0  # make the slow backend look like the better choice
+        start = time.time()
+        self.assertEqual(b.get_text('a=b'), 'http://fast/plan?a=b')
+        self.assertTrue(time.time() - start < 0.4)  # didn't wait on the slow backend
+        self.assertEqual(b.backends[1].hedges, 1)
+
+        b = OtpBackends(['http://down/plan', 'http://up/plan'], pool, hedge_ms=1000, breaker_failures=5)
+        b.backends[1].ewma = 1000.0
+        start = time.time()
+        self.assertEqual(b.get_text('a=b'), 'http://up/plan?a=b')
+        self.assertTrue(time.time() - start < 0.5)  # hedged right away, rather than after the hedge delay
+        self.assertEqual(b.backends[1].hedges, 1)
+
+    def test_hedge_threads(self):
+        b = OtpBackends.from_settings('http://a/plan,http://b/plan', MockPool(), {'otp_hedge_threads': '7'})
+        self.assertEqual(b._executor._max_workers, 7)
+
+    def test_breaker(self):
+        b = OtpBackends(['http://down/plan', 'http://up/plan'], MockPool(), hedge_ms=-1, breaker_failures=2)
+        b.backends[1].ewma = 1000.0
+        for i in range(2):
+            self.assertRaises(IOError, b.get_text, 'a=b')
+        self.assertEqual(b.get_text('a=b'), 'http://up/plan?a=b')  # down is now out of rotation
+        self.assertTrue(b.stats()[0]['open'])
+
+        # once its time is up, a single (half open) test call goes to the down backend
+        b.backends[0].open_until = time.time() - 1
+        b.backends[1].ewma = 1000.0
+        self.assertIs(b.choose(), b.backends[0])
+        self.assertIs(b.choose(), b.backends[1])
+        self.assertIs(b.choose(), b.backends[1])
+
+    def test_histogram(self):
+        h = LatencyHistogram()
+        for ms in [1, 20, 20, 20, 20, 20, 20, 20, 20, 20, 20, 20, 20, 20, 20, 20, 20, 20, 20, 400]:
+            h.add(ms)
+        self.assertEqual(h.percentile(50), 25)
+        self.assertEqual(h.percentile(99), 500)
+        self.assertEqual(h.to_dict()['count'], 20)
+
+
+class StubServerTest(unittest.TestCase):
+
+    def test_stub_server(self):
+        from ott.otp_client.bench.stub_server import StubServer
+        svr = StubServer(port=0, latency=10).start()
+        try:
+            pool = http_utils.HttpPool('stub')
+            plan = pool.get_json(svr.url + "/otp_prod/plan", params={'fromPlace': 'PDX', 'toPlace': 'OHSU'})
+            self.assertIn('plan', plan)
+            again = pool.get_json(svr.url + "/otp_prod/plan", params={'fromPlace': 'PDX', 'toPlace': 'OHSU'})
+            self.assertEqual(plan, again)
+            doc = pool.get_json(svr.url + "/solr/select", params={'q': 'pdx'})['response']['docs'][0]
+            self.assertEqual(doc['name'], "PDX")
+            self.assertEqual(pool.stats()['requests'], 3)
+        finally:
+            svr.shutdown()
+            svr.server_close()
+
+    def test_pooled_geosolr(self):
+        """ PooledGeoSolr answers just like GeoSolr (its parsing is GeoSolr's), but over the pool """
+        from ott.geocoder.geosolr import GeoSolr
+        from ott.otp_client.geocoder import PooledGeoSolr
+        from ott.otp_client.bench.stub_server import StubServer
+        svr = StubServer(port=0, latency=0).start()
+        try:
+            pool = http_utils.HttpPool('stub_solr')
+            geo = PooledGeoSolr(svr.url + "/solr", pool)
+            self.assertEqual(geo.geostr('pdx'), GeoSolr(svr.url + "/solr").geostr('pdx'))
+            self.assertIn('::', geo.geostr('pdx'))
+            self.assertEqual(pool.stats()['requests'], 2)  # the plain GeoSolr lookup didn't use the pool
+        finally:
+            svr.shutdown()
+            svr.server_close()
+
+
+class TimingTest(unittest.TestCase):
+
+    def test_stage_timer(self):
+        from ott.otp_client.timing import StageTimer, StageStats
+        timer = StageTimer()
+        with timer.stage('geocode'):
+            time.sleep(0.01)
+        timer.add('otp', 0.5)
+        hdr = timer.server_timing()
+        self.assertTrue(hdr.startswith('geocode;dur=1'))
+        self.assertIn('otp;dur=500.00', hdr)
+        self.assertIn('total;dur=', hdr)
+
+        stats = StageStats('test', slow_ms=1)
+        stats.record(timer, lambda: 'info')
+        stats.record(timer)
+        self.assertEqual(stats.stats()['otp']['count'], 2)
+        self.assertEqual(stats.stats()['otp']['buckets']['500'], 2)
+
+    def test_metrics(self):
+        import threading
+        from ott.otp_client.metrics import Metrics
+        m = Metrics()
+
+        def work():
+            for i in range(100):
+                m.observe('route_latency', 20.0, route='plan_trip')
+            m.inc('route_errors', route='plan_trip')
+
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        text = m.to_prometheus([('waitress_queue_depth', 3, {})])
+        self.assertIn('ott_route_latency_seconds_count{route="plan_trip"} 400', text)
+        self.assertIn('ott_route_latency_seconds_bucket{route="plan_trip",le="0.025"} 400', text)
+        self.assertIn('ott_route_latency_seconds_bucket{route="plan_trip",le="0.01"} 0', text)
+        self.assertIn('ott_route_errors_total{route="plan_trip"} 4', text)
+        self.assertIn('ott_waitress_queue_depth 3', text)
+
+    def test_metrics_shards(self):
+        """ the shards of exited threads are folded into one retired shard, so the shard count stays bounded """
+        import threading
+        from ott.otp_client.metrics import Metrics
+        m = Metrics()
+        for i in range(50):
+            t = threading.Thread(target=m.inc, args=('calls',))
+            t.start()
+            t.join()
+            self.assertTrue(len(m._shards) <= 2)
+        self.assertEqual(m.collect()[1][('calls', ())], 50)
+        self.assertEqual(len(m._shards), 0)
@@ -0,0 +1,128 @@
+import os
+import io
+import glob
+import unittest
+import simplejson as json
+
+from ott.otp_client import otp_to_ott
+from ott.otp_client import otp_stream
+from ott.otp_client import elevation
+
+
+def get_plan_files():
+    """ all the recorded OTP plan responses in tests/data (skipping the adverts content) """
+    dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+    ret_val = []
+    for f in sorted(glob.glob(os.path.join(dir, '*', '*.json'))):
+        if 'adverts' not in f:
+            ret_val.append(f)
+    return ret_val
+
+
+def read_file(file_path):
+    with open(file_path, 'rb') as f:
+        ret_val = f.read()
+    return ret_val
+
+
+class OtpToOttTest(unittest.TestCase):
+    """ test parsing of recorded OTP responses into OTT plan objects """
+
+    def test_plan(self):
+        for f in get_plan_files():
+            j = json.loads(read_file(f))
+            plan = otp_to_ott.Plan(j['plan'])
+            self.assertTrue(len(plan.itineraries) > 0, f)
+            self.assertTrue(plan.itineraries[0].selected, f)
+
+    def test_to_dict(self):
+        """ plan objects are __slots__ based, and to_dict() keeps the old attribute (__dict__) order """
+        f = get_plan_files()[0]
+        plan = otp_to_ott.Plan(json.loads(read_file(f))['plan'])
+        self.assertFalse(hasattr(plan, '__dict__'))
+
+        d = plan.to_dict()
+        self.assertEqual(list(d.keys()), ['from', 'to', 'itineraries', 'params', 'max_walk'])
+        leg = d['itineraries'][0]['legs'][0]
+        self.assertEqual(list(leg.keys())[:4], ['mode', 'from', 'to', 'steps'])
+
+    def test_fields(self):
+        """ optional subtrees not in the fieldset are never built (and so aren't in the output) """
+        f = otp_to_ott.Fields.factory('itineraries.legs.steps')
+        self.assertTrue(f.has('legs') and f.has('steps'))
+        self.assertFalse(f.has('elevation') or f.has('alerts') or f.has('map_img') or f.has('stop'))
+        self.assertTrue(otp_to_ott.Fields.factory('elevation').has('legs'))
+        self.assertTrue(otp_to_ott.Fields.factory(None).has('map_img'))
+
+        for file_path in get_plan_files():
+            jsn = json.loads(read_file(file_path))['plan']
+            full = otp_to_ott.Plan(jsn).to_dict()
+            summary = otp_to_ott.Plan(jsn, fields=otp_to_ott.Fields.factory('')).to_dict()
+            self.assertNotIn('map_img', summary['from'])
+            for i, itin in enumerate(summary['itineraries']):
+                self.assertNotIn('legs', itin)
+                self.assertNotIn('alerts', itin)
+                self.assertEqual(itin['dominant_mode'], full['itineraries'][i]['dominant_mode'], file_path)
+                self.assertEqual(itin['has_alerts'], full['itineraries'][i]['has_alerts'], file_path)
+                self.assertEqual(itin['date_info'], full['itineraries'][i]['date_info'], file_path)
+
+            legs = otp_to_ott.Plan(jsn, fields=otp_to_ott.Fields.factory('legs')).to_dict()
+            leg = legs['itineraries'][0]['legs'][0]
+            full_leg = full['itineraries'][0]['legs'][0]
+            self.assertNotIn('steps', leg)
+            self.assertNotIn('elevation', leg)
+            self.assertNotIn('stop', leg['from'])
+            self.assertEqual(leg['compass_direction'], full_leg['compass_direction'])
+
+    def test_elevation(self):
+        """ 10m climb over 100m, then a 5m drop over 50m ... in both OTP elevation formats """
+        steps = [
+            {'distance': 100.0, 'elevation': [{'first': 0.0, 'second': 10.0}, {'first': 100.0, 'second': 20.0}]},
+            {'distance': 50.0, 'elevation': '0,20.0,50,15.0'}
+        ]
+        p = elevation.make_profile(steps)
+        self.assertEqual(p['distance'], 150.0)
+        self.assertEqual(p['points_array'], [10.0, 20.0, 20.0, 15.0])
+        self.assertEqual((p['high'], p['low'], p['rise'], p['fall']), (20.0, 10.0, 10.0, -5.0))
+        self.assertEqual(p['grade']['up'], 10.0)
+        self.assertEqual(p['grade']['down'], -10.0)
+        self.assertEqual(p['grade']['dd'], 100.0)
+
+        e = otp_to_ott.Elevation(steps)
+        self.assertEqual((e.start_ft, e.end_ft, e.rise_ft, e.fall_ft), ("10.0", "15.0", "10.0", "-5.0"))
+
+    def test_elevation_points_string(self):
+        """ down-sampled profile string averages every slice of points, including a short last slice """
+        steps = [{'distance': 1000.0, 'elevation': [{'first': float(i), 'second': float(i)} for i in range(121)]}]
+        p = elevation.make_profile(steps, max_points=50)
+        points = p['points'].split(',')
+        self.assertEqual(len(points), 61)
+        self.assertEqual(points[0], "0.50")
+        self.assertEqual(points[-1], "120.00")
+
+    def test_stream_plan(self):
+        """ the streaming reader / writer should produce the same OTT json as Plan + json_repr """
+        for f in get_plan_files():
+            body = read_file(f)
+            plan = otp_to_ott.Plan(json.loads(body)['plan'])
+
+            reader = otp_stream.PlanReader(body)
+            self.assertEqual(reader.num_itineraries(), len(plan.itineraries), f)
+
+            out = io.StringIO()
+            mode = otp_stream.write_plan(reader, out)
+            self.assertEqual(json.loads(out.getvalue()), json.loads(plan.to_json()), f)
+            self.assertEqual(mode, plan.dominant_transit_mode(), f)
+
+    def test_stream_reader(self):
+        body = '{"requestParameters": {"x": "{[\\"]}"}, "plan": {"date": 1, "from": {"name": "A"}, "to": {"name": "B"}, "itineraries": [ ]}, "error": null}'
+        reader = otp_stream.PlanReader(body)
+        self.assertTrue(reader.has_plan())
+        self.assertEqual(reader.get_from(), {"name": "A"})
+        self.assertEqual(reader.get_to(), {"name": "B"})
+        self.assertEqual(reader.num_itineraries(), 0)
+        self.assertIsNone(reader.get_error())
+
+        reader = otp_stream.PlanReader(b'{"error": {"id": 404, "msg": "PATH_NOT_FOUND"}}')
+        self.assertFalse(reader.has_plan())
+        self.assertEqual(reader.get_error()['id'], 404)
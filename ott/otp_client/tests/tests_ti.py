@@ -1,8 +1,20 @@
 import os
+import time
+import datetime
+import threading
 import unittest
+import simplejson as json
 
 from ott.otp_client.transit_index.routes import Routes
 from ott.otp_client.transit_index.stops import Stops
+from ott.otp_client.transit_index.stop_index import StopIndex, StopGrid, distances, numpy
+from ott.otp_client.transit_index.feed_version import FeedWatcher
+from ott.otp_client.transit_index.route_cache import RouteListCache
+from ott.otp_client.transit_index.stop_routes_index import StopRoutesIndex
+from ott.otp_client.transit_index.pattern_cache import PatternGeometryCache
+from ott.otp_client.transit_index.patterns import Patterns
+from ott.otp_client.transit_index import export
+from ott.otp_client.query_stats import count_queries, query_budget, QueryBudgetExceeded
 from ott.utils.geo.bbox import BBox
 from ott.utils.geo.point import Point
 
@@ -91,3 +103,376 @@ class TiTest(unittest.TestCase):
             stops = Stops.nearest_stops(self.db.session, point)
             self.assertTrue(len(stops) > 5)
             self.assertTrue(stops[0].get('dist') > 1000 and stops[0].get('dist') < 2000)
+
+    def test_query_budgets(self):
+        """ each TI list query should be a constant number of SQL queries, however many rows come back """
+        self.db.session.expire_all()
+        with query_budget(1, min_repeats=2):
+            routes = Routes.route_list_factory(self.db.session)
+        self.assertTrue(len(routes) == 2)
+        with query_budget(2, min_repeats=2):
+            routes = Routes.route_list_factory(self.db.session, date="9-15-2018")
+        self.assertTrue(len(routes) == 2)
+
+        # detailed stops (with amenities) are 2 queries, however many stops
+        with query_budget(2, min_repeats=2):
+            stops = Stops._query_current_stops(self.db.session, detailed=True).all()
+            stops = Stops._stop_list_from_gtfsdb_list(stops, None, None, 1000, detailed=True)
+        self.assertTrue(len(stops) > 5)
+
+        with query_budget(1, min_repeats=2):
+            Stops.nearest_stops(self.db.session, Point(x=-117.15, y=36.43))
+        with query_budget(2, min_repeats=2):
+            Stops.nearest_stops(self.db.session, Point(x=-117.15, y=36.43), detailed=True)
+
+        if self.DO_PG:
+            bbox = BBox(min_lat=36.0, max_lat=37.0, min_lon=-117.5, max_lon=-116.0)
+            with query_budget(1, min_repeats=2):
+                Stops.bbox_stops(self.db.session, bbox)
+            with query_budget(2, min_repeats=2):
+                Stops.bbox_stops(self.db.session, bbox, detailed=True)
+            with query_budget(1, min_repeats=2):
+                Stops.nearest_stops(self.db.session, Point(x=-117.15, y=36.43))
+
+    def test_nearest_radius(self):
+        """ nearest stops, sorted by distance (computed by PostGIS, or vectorized on SQLite) and within the radius """
+        point = Point(x=-117.15, y=36.43)
+        stops = Stops.nearest_stops(self.db.session, point, limit=5)
+        self.assertEqual(len(stops), 5)
+        dists = [s.get('dist') for s in stops]
+        self.assertEqual(dists, sorted(dists))
+
+        radius = (dists[1] + dists[2]) / 2.0
+        stops = Stops.nearest_stops(self.db.session, point, limit=5, radius=radius)
+        self.assertEqual([s.get('dist') for s in stops], dists[:2])
+        self.assertEqual(Stops.nearest_stops(self.db.session, point, radius=1.0), [])
+
+    def test_stop_list_limit(self):
+        stops = Stops._query_current_stops(self.db.session).all()
+        self.assertTrue(len(stops) > 3)
+        self.assertEqual(len(Stops._stop_list_from_gtfsdb_list(stops, None, None, limit=3)), 3)
+
+    def test_query_stats(self):
+        """ repeated statements get flagged as likely N+1 queries """
+        from sqlalchemy import create_engine
+        engine = create_engine('sqlite://')
+        with count_queries() as stats:
+            for i in range(6):
+                engine.execute("select 1").fetchall()
+        self.assertEqual(stats.count, 6)
+        self.assertEqual(stats.repeated(5)[0][1], 6)
+        with self.assertRaises(QueryBudgetExceeded):
+            with query_budget(10, min_repeats=5):
+                for i in range(5):
+                    engine.execute("select 1").fetchall()
+
+
+class TiDbTest(unittest.TestCase):
+    """ base of the TI tests below, sharing TiTest's (sqlite) gtfsdb """
+    def setUp(self):
+        if TiTest.db is None:
+            TiTest.db = load_sqlite()
+        self.db = TiTest.db
+
+
+@unittest.skipIf(numpy is None, "the stop index needs numpy")
+class StopIndexTest(TiDbTest):
+
+    def setUp(self):
+        super(StopIndexTest, self).setUp()
+        self.index = StopIndex()
+        self.index.rebuild(self.db.session)
+
+    def tearDown(self):
+        Stops.stop_index = None
+
+    def test_bbox(self):
+        grid = self.index.grid
+        self.assertTrue(len(grid) > 5)
+        bbox = BBox(min_lat=36.4, max_lat=36.95, min_lon=-117.2, max_lon=-116.7)
+        expected = set(s for s, lat, lon in zip(grid.stop_ids, grid.lats, grid.lons) if 36.4 <= lat <= 36.95 and -117.2 <= lon <= -116.7)
+        stops = self.index.bbox_stops(bbox, 'DTA')
+        self.assertEqual(set(s['id'] for s in stops), set("DTA:" + s for s in expected))
+        self.assertEqual(len(self.index.bbox_stops(bbox, limit=2)), min(2, len(expected)))
+
+        # Stops.bbox_stops answers from the index, without a db query
+        Stops.stop_index = self.index
+        with query_budget(0):
+            self.assertEqual(len(Stops.bbox_stops(None, bbox, 'DTA')), len(expected))
+
+    def test_nearest(self):
+        point = Point(x=-117.15, y=36.43)
+        stops = self.index.nearest_stops(point, limit=3, detailed=True)
+        self.assertEqual(len(stops), 3)
+        self.assertTrue(stops[0]['dist'] <= stops[1]['dist'] <= stops[2]['dist'])
+        self.assertTrue('amenities' in stops[0])
+
+        # same stops (and order) as Stops makes from the db, plus the dist
+        grid = self.index.grid
+        dist = distances(point.lat, point.lon, grid.lats, grid.lons)
+        expected = [grid.stop_ids[i] for i in numpy.argsort(dist, kind='stable')[:3]]
+        self.assertEqual([s['id'] for s in stops], expected)
+        db_stop = Stops.stop(self.db.session, expected[0], detailed=True).__dict__
+        self.assertEqual(dict(stops[0], dist=None), dict(db_stop, dist=None))
+        self.assertEqual(stops, Stops.nearest_stops(self.db.session, point, limit=3, detailed=True))
+
+        far = self.index.nearest_stops(point, limit=10, radius=stops[1]['dist'] + 0.5)
+        self.assertEqual(len(far), 2)
+
+    def test_grid_vs_brute_force(self):
+        """ random stops in a Portland sized area ... grid answers match a scan of every stop """
+        rnd = numpy.random.RandomState(42)
+        lats = 45.3 + rnd.random_sample(2000) * 0.4
+        lons = -122.9 + rnd.random_sample(2000) * 0.6
+        ids = [str(i) for i in range(2000)]
+        grid = StopGrid(ids, [{} for i in ids], lats, lons, cell_deg=0.01)
+        for lat, lon in ((45.5, -122.6), (45.31, -122.89), (46.5, -121.0)):
+            dist = distances(lat, lon, lats, lons)
+            expected = [ids[i] for i in numpy.argsort(dist, kind='stable')[:10]]
+            self.assertEqual([grid.stop_ids[i] for i, d in grid.nearest(lat, lon, 10)], expected)
+
+        i = grid.in_bbox(45.5, 45.55, -122.7, -122.6, limit=5000)
+        expected = numpy.count_nonzero((lats >= 45.5) & (lats <= 45.55) & (lons >= -122.7) & (lons <= -122.6))
+        self.assertEqual(len(i), expected)
+
+
+class RouteListCacheTest(TiDbTest):
+
+    def test_feed_version(self):
+        watcher = FeedWatcher(self.db, check_secs=0)
+        version = watcher.check()
+        self.assertTrue(version)
+        self.assertEqual(watcher.check(), version)
+
+    def test_route_list_cache(self):
+        watcher = FeedWatcher(self.db, check_secs=3600)
+        cache = RouteListCache(self.db, watcher, days=7)
+
+        body = cache.get('DTA')
+        self.assertEqual(json.loads(body), Routes.route_list_factory(self.db.session, None, 'DTA'))
+        with query_budget(0):
+            self.assertTrue(cache.get('DTA') is body)
+
+        today = datetime.date.today()
+        self.assertEqual(json.loads(cache.get('DTA', today)), Routes.route_list_factory(self.db.session, today, 'DTA'))
+        self.assertTrue(cache.get('DTA', "9-15-2018") is None)  # outside the window ... query the db
+
+        # a new feed (version) drops, and rebuilds, the lists
+        from gtfsdb import FeedInfo
+        seen = []
+        watcher.add_listener(seen.append)
+        session = self.db.session
+        session.add(FeedInfo(feed_publisher_name='test', feed_publisher_url='http://test', feed_lang='en', feed_version='2'))
+        session.commit()
+        try:
+            watcher.checked = 0
+            self.assertTrue(cache.get('DTA') is not body)
+            self.assertEqual(seen, [watcher.version])
+        finally:
+            session.query(FeedInfo).filter(FeedInfo.feed_publisher_name == 'test').delete()
+            session.commit()
+
+    def test_concurrent_misses(self):
+        """ threads missing on the same route list wait on the one build """
+        class SlowCache(RouteListCache):
+            builds = 0
+
+            def build(self, agency_id, date):
+                SlowCache.builds += 1
+                time.sleep(0.2)
+                return b'[]'
+
+        watcher = FeedWatcher(self.db, check_secs=3600)
+        watcher.check(force=True)
+        cache = SlowCache(self.db, watcher)
+        threads = [threading.Thread(target=cache.get, args=('DTA',)) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(SlowCache.builds, 1)
+        self.assertEqual(cache.get('DTA'), b'[]')
+
+    def test_feed_poller(self):
+        """ a started watcher polls in the background, and calls its listeners there (not on the request thread) """
+        watcher = FeedWatcher(self.db, check_secs=0.05)
+        watcher.check(force=True)
+        seen = []
+        watcher.add_listener(lambda version: seen.append(threading.current_thread().name))
+
+        from gtfsdb import FeedInfo
+        session = self.db.session
+        session.add(FeedInfo(feed_publisher_name='test', feed_publisher_url='http://test', feed_lang='en', feed_version='4'))
+        session.commit()
+        try:
+            watcher.start()
+            for _ in range(40):
+                if seen:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(seen, ['feed-watcher'])
+        finally:
+            watcher.stop()
+            session.query(FeedInfo).filter(FeedInfo.feed_publisher_name == 'test').delete()
+            session.commit()
+
+
+class PatternCacheTest(TiDbTest):
+
+    class Cache(PatternGeometryCache):
+        """ sqlite gtfsdb has no pattern geometries, so make some up """
+        def query_geometry(self, pattern_id, agency_id=None, fmt='encoded'):
+            if pattern_id == 'NONE':
+                return None if fmt == 'geojson' else {'points': None, 'length': 0}
+            if fmt == 'geojson':
+                return {'type': 'LineString', 'coordinates': [[-122.6, 45.5], [-122.7, 45.6]]}
+            return {'points': '_p~iF~ps|U_ulLnnqC', 'length': 2}
+
+    def test_geometry(self):
+        """ geometries are cached per (agency, pattern, format), with an etag of their body """
+        cache = self.Cache(self.db, FeedWatcher(self.db, check_secs=3600), ttl=3600, miss_ttl=5)
+        body, etag = cache.geometry('P1', 'DTA', 'encoded')
+        self.assertEqual(json.loads(body)['length'], 2)
+        self.assertEqual(etag, PatternGeometryCache.make_etag(body))
+        with query_budget(0):
+            self.assertEqual(cache.geometry('P1', 'DTA', 'encoded'), (body, etag))
+
+        gbody, getag = cache.geometry('P1', 'DTA', 'geojson')
+        self.assertEqual(json.loads(gbody)['type'], 'LineString')
+        self.assertNotEqual(getag, etag)
+        self.assertEqual(len(cache), 2)
+
+        # the same geometry gets the same etag (e.g., after a restart)
+        other = self.Cache(self.db, FeedWatcher(self.db, check_secs=3600))
+        self.assertEqual(other.geometry('P1', 'DTA', 'encoded')[1], etag)
+
+        # empty geometries are only kept for miss_ttl seconds
+        cache.geometry('NONE', 'DTA', 'geojson')
+        expires = cache._data[('DTA', 'NONE', 'geojson')][0]
+        self.assertTrue(expires < cache._data[('DTA', 'P1', 'geojson')][0] - 3000)
+
+    def test_new_feed(self):
+        """ a new feed (version) drops the cached geometries, and trip -> pattern lookups """
+        cache = self.Cache(self.db, FeedWatcher(self.db, check_secs=3600))
+        cache.geometry('P1', 'DTA', 'geojson')
+        seen = []
+        self.assertEqual(cache.pattern_id_from_trip('T1', 'DTA', lambda t, a: seen.append(t) or 'P1'), 'P1')
+        self.assertEqual(cache.pattern_id_from_trip('T1', 'DTA', lambda t, a: seen.append(t) or 'P1'), 'P1')
+        self.assertEqual(seen, ['T1'])
+
+        from gtfsdb import FeedInfo
+        session = self.db.session
+        session.add(FeedInfo(feed_publisher_name='test', feed_publisher_url='http://test', feed_lang='en', feed_version='3'))
+        session.commit()
+        try:
+            cache.watcher.checked = 0
+            cache.check_version()
+            self.assertEqual(len(cache), 0)
+        finally:
+            session.query(FeedInfo).filter(FeedInfo.feed_publisher_name == 'test').delete()
+            session.commit()
+
+        cache.warm(['DTA'])  # no geospatial patterns in sqlite ... nothing to warm
+        self.assertEqual(len(cache), 0)
+
+    def test_patterns(self):
+        """ Patterns answers from its (at first empty) geometry cache, rather than gtfsdb """
+        class AppConfig(object):
+            db = self.db
+
+            def get_agency(self):
+                return 'DTA'
+
+        app_config = AppConfig()
+        Patterns.geometry_cache = self.Cache(self.db, FeedWatcher(self.db, check_secs=3600))
+        try:
+            self.assertEqual(len(Patterns.geometry_cache), 0)
+            body, etag = Patterns.cached_geometry(app_config, 'P1', fmt='geojson')
+            self.assertEqual(json.loads(body)['type'], 'LineString')
+            with query_budget(0):
+                self.assertEqual(Patterns.cached_geometry(app_config, 'P1', 'DTA', 'geojson'), (body, etag))
+
+            class TripPatterns(Patterns):
+                seen = []
+
+                @classmethod
+                def _query_pattern_id_from_trip_id(cls, app_config, trip_id, agency_id):
+                    cls.seen.append(trip_id)
+                    return 'P1'
+
+            self.assertEqual(TripPatterns.query_pattern_id_from_trip_id(app_config, 'T1'), 'P1')
+            self.assertEqual(TripPatterns.query_pattern_id_from_trip_id(app_config, 'T1'), 'P1')
+            self.assertEqual(TripPatterns.seen, ['T1'])
+        finally:
+            Patterns.geometry_cache = None
+
+
+class StopRoutesIndexTest(TiDbTest):
+
+    def tearDown(self):
+        Routes.stop_routes_index = None
+
+    def test_same_as_db(self):
+        """ the index answers just like the (Current)RouteStops queries, for every stop, with and without dates """
+        from gtfsdb import Stop
+        session = self.db.session
+        stop_ids = [s.stop_id for s in session.query(Stop)]
+        dates = (None, "9-15-2018", datetime.date.today())
+        expected = dict(((s, d), Routes.stop_routes_factory(session, s, d)) for s in stop_ids for d in dates)
+        self.assertTrue(len([v for v in expected.values() if v]) > 5)
+
+        index = StopRoutesIndex()
+        index.rebuild(session)
+        Routes.stop_routes_index = index
+        with query_budget(0):
+            for (s, d), routes in expected.items():
+                self.assertEqual(Routes.stop_routes_factory(None, s, d), routes)
+            self.assertEqual(Routes.stop_routes_factory(None, 'DADAN', agency_id='X')[0]['id'][:2], 'X:')
+
+    def test_dated_agency(self):
+        """ dated lookups only return the route stops of the given agency (as per RouteStop.query_by_stop) """
+        index = StopRoutesIndex()
+        index.rebuild(self.db.session)
+        routes = index.stop_routes('EMSI', "9-15-2018")
+        self.assertEqual(len(routes), 2)
+        self.assertEqual(index.stop_routes('EMSI', "9-15-2018", 'DTA'), routes)
+        self.assertEqual(index.stop_routes('EMSI', "9-15-2018", 'X'), [])
+        self.assertEqual(len(index.stop_routes('DADAN', agency_id='X')), 2)  # current route stops aren't filtered
+
+
+class ExportTest(TiDbTest):
+
+    def test_route_strs(self):
+        """ the exported route strings match the per stop /routes/str answers, in a couple of (streamed) queries """
+        session = self.db.session
+        for date in (None, "9-15-2018"):
+            with query_budget(3):
+                rows = list(export.stop_route_strs(session, date, 'DTA', yield_per=2))
+            self.assertTrue(len([r for r in rows if r['routes']]) > 5)
+            for r in rows:
+                stop_id = r['id'].split(':')[1]
+                self.assertEqual(r['routes'], Routes.routes_str(Routes.stop_routes_factory(session, stop_id, date)))
+
+        # dated route stops of other agencies are left out
+        rows = list(export.stop_route_strs(session, "9-15-2018", 'X'))
+        self.assertTrue(len(rows) > 5)
+        self.assertEqual([r for r in rows if r['routes']], [])
+
+    def test_write_dataset(self):
+        """ NDJSON rows are the endpoint dicts, CSV rows the same values """
+        import io
+        import csv
+        from gtfsdb import CurrentStops
+        session = self.db.session
+        num_stops = session.query(CurrentStops).filter(CurrentStops.location_type == 0).count()
+
+        out = io.StringIO()
+        self.assertEqual(export.write_dataset(session, 'stops', out, agency_id='DTA'), num_stops)
+        stops = [json.loads(l) for l in out.getvalue().splitlines()]
+        self.assertEqual(stops[0], json.loads(json.dumps(Stops.stop(session, stops[0]['id'].split(':')[1], 'DTA').__dict__)))
+
+        out = io.StringIO()
+        num = export.write_dataset(session, 'routes', out, fmt='csv')
+        routes = list(csv.DictReader(io.StringIO(out.getvalue())))
+        self.assertEqual(num, len(routes))
+        self.assertEqual([r['id'] for r in routes], [r['id'] for r in Routes.route_list_factory(session)])
@@ -0,0 +1,206 @@
+import time
+import unittest
+import simplejson as json
+
+from ott.otp_client.trip_planner import TripPlanner
+from ott.otp_client.trip_planner import parse_batch
+from ott.otp_client.tests.tests_otp_to_ott import get_plan_files, read_file
+
+
+class MockPlanner(TripPlanner):
+    """ TripPlanner whose plan_trip() just echos the request (slowly for 'slow' trips, and raising for 'bad' ones) """
+    def plan_trip(self, request=None, pretty=False):
+        if 'slow' in request:
+            time.sleep(0.2)
+        if 'bad' in request:
+            raise ValueError(request)
+        return '"{}"'.format(request)
+
+
+class MockGeo(object):
+    """ geocoder that 'finds' every place, counting its lookups """
+    calls = 0
+
+    def geostr(self, search, def_val=None):
+        self.calls += 1
+        return "{}::45.5,-122.6".format(search)
+
+
+class MockOtp(TripPlanner):
+    """ TripPlanner answering every trip with a recorded OTP plan (no geocoding), and counting its OTP calls """
+    otp_calls = 0
+
+    def geocode(self, param):
+        return None
+
+    def call_otp(self, param, msg=None):
+        self.otp_calls += 1
+        return read_file([f for f in get_plan_files() if 'pdx2ohsu' in f and 'new' in f][0])
+
+
+class TripPlannerTest(unittest.TestCase):
+
+    def test_parse_batch(self):
+        trips = list(parse_batch('[{"id": "a", "fromPlace": "PDX", "toPlace": "ZOO"}, {"query": "fromPlace=X&toPlace=Y"}]'))
+        self.assertEqual(trips, [('a', 'fromPlace=PDX&toPlace=ZOO'), (1, 'fromPlace=X&toPlace=Y')])
+        trips = list(parse_batch('{"id": 7, "query": "a=b"}\n\n"c=d"\n'))
+        self.assertEqual(trips, [(7, 'a=b'), (1, 'c=d')])
+
+    def test_plan_trips(self):
+        tp = MockPlanner()
+        trips = [(1, 'slow'), (2, 'fast'), (3, 'bad'), (4, 'fast')]
+        results = list(tp.plan_trips(trips, concurrency=2))
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[-1], (1, '"slow"'))  # completion order
+        self.assertIn('error', dict(results)[3])
+
+    def test_od_matrix(self):
+        from ott.otp_client import od_matrix
+        tp = MockOtp(solr=MockGeo())
+        m = od_matrix.plan_matrix(tp, ['A', 'B'], ['C', 'D', '45.5,-122.6'], workers=3)
+        self.assertEqual(tp.geo.calls, 4)  # each place geocoded once (not once per cell)
+        self.assertEqual(tp.otp_calls, 6)
+        duration, transfers, walk = m.get(1, 2)
+        self.assertTrue(0 < walk < duration)
+        self.assertEqual(m.get(0, 0), (duration, transfers, walk))
+        self.assertEqual(len(m.data['duration']), 6)
+
+    def test_od_matrix_errors(self):
+        """ a failed geocode only blanks that place's cells ... and place names are csv escaped """
+        import csv
+        from io import StringIO
+        from ott.otp_client import od_matrix
+
+        class BadGeo(MockGeo):
+            def geostr(self, search, def_val=None):
+                if 'bad' in search:
+                    raise IOError(search)
+                return super(BadGeo, self).geostr(search, def_val)
+
+        tp = MockOtp(solr=BadGeo())
+        m = od_matrix.plan_matrix(tp, ['A "the" stop, OR', 'bad'], ['C'], workers=2)
+        self.assertEqual(tp.otp_calls, 1)
+        self.assertTrue(m.get(0, 0)[0] > 0)
+        self.assertEqual(m.get(1, 0), (od_matrix.NO_TRIP,) * 3)
+
+        out = StringIO()
+        m.write_csv(out)
+        rows = list(csv.reader(StringIO(out.getvalue())))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[1][:2], ['A "the" stop, OR', 'C'])
+        self.assertEqual(rows[2], ['bad', 'C', '-1', '-1', '-1'])
+
+    def test_iter_trip(self):
+        """ the streamed plan is the same json as plan_trip(), in (itinerary sized) chunks """
+        tp = MockOtp()
+        query = 'fromPlace=PDX::45.58,-122.59&toPlace=OHSU::45.49,-122.68'
+        chunks = list(tp.iter_trip(query))
+        self.assertTrue(len(chunks) > 5)
+        self.assertEqual(json.loads(''.join(chunks)), json.loads(tp.plan_trip(query)))
+
+    def test_iter_trip_error(self):
+        """ an error building an itinerary part way through the stream still ends in valid json, with an error """
+        class BadFares(object):
+            calls = 0
+
+            def query(self, name, def_val=None):
+                if name == 'adult_day':
+                    self.calls += 1
+                    if self.calls > 1:
+                        raise ValueError('bad fares')
+                return def_val
+
+        class BadOtp(MockOtp):
+            fares = BadFares()
+
+        query = 'fromPlace=PDX::45.58,-122.59&toPlace=OHSU::45.49,-122.68'
+        chunks = list(BadOtp().iter_trip(query))
+        plan = json.loads(''.join(chunks))
+        self.assertEqual(len(plan['plan']['itineraries']), 1)
+        self.assertEqual(plan['error'], {'id': 500, 'msg': 'bad fares'})
+
+        # and a pretty (built whole) streamed plan is the same pretty json as plan_trip()
+        from ott.otp_client.timing import StageTimer
+        tp = MockOtp()
+        timer = StageTimer()
+        chunks = list(tp.iter_trip(query + '&pretty=true', timer=timer))
+        self.assertEqual(chunks, [tp.plan_trip(query + '&pretty=true')])
+        self.assertEqual([n for n, ms in timer.stages], ['params', 'geocode', 'otp', 'otp_json', 'plan'])
+
+    def test_plan_cache(self):
+        """ a repeated trip is answered from the (initially empty) plan cache, without calling OTP again """
+        from ott.otp_client.plan_cache import PlanCache
+        tp = MockOtp(plan_cache=PlanCache(max_size=10, ttl=60))
+        query = 'fromPlace=PDX::45.58,-122.59&toPlace=OHSU::45.49,-122.68'
+        plan = tp.plan_trip(query)
+        self.assertEqual(tp.plan_trip(query), plan)
+        self.assertEqual(tp.otp_calls, 1)
+        self.assertEqual(tp.plan_cache.stats()['hits'], 1)
+
+        # a nearby trip isn't answered with the first trip's plan (which echoes the first trip's params and urls)
+        near = 'fromPlace=PDX::45.58001,-122.59&toPlace=OHSU::45.49,-122.68'
+        self.assertNotEqual(tp.plan_trip(near), plan)
+        self.assertEqual(tp.otp_calls, 2)
+
+    def test_plan_cache_content(self):
+        """ plans made before the content (e.g., fares) has loaded aren't cached """
+        from ott.otp_client.plan_cache import PlanCache
+        tp = MockOtp(plan_cache=PlanCache(max_size=10, ttl=60))
+        tp.content.add_source('fares', lambda: None)
+        query = 'fromPlace=PDX::45.58,-122.59&toPlace=OHSU::45.49,-122.68'
+        tp.plan_trip(query)
+        tp.plan_trip(query)
+        self.assertEqual(tp.otp_calls, 2)
+        self.assertEqual(len(tp.plan_cache), 0)
+
+    def test_single_flight(self):
+        """ only identical in-flight trips are coalesced (even without a plan cache) ... not merely nearby ones """
+        import threading
+        from ott.otp_client.cache_utils import SingleFlight
+
+        class SlowOtp(MockOtp):
+            def call_otp(self, param, msg=None):
+                time.sleep(0.2)
+                return super(SlowOtp, self).call_otp(param, msg)
+
+        tp = SlowOtp(single_flight=SingleFlight())
+        queries = ['fromPlace=PDX::45.58,-122.59&toPlace=OHSU::45.49,-122.68'] * 2
+        queries.append('fromPlace=PDX::45.58001,-122.59&toPlace=OHSU::45.49,-122.68')
+        plans = {}
+
+        def plan(i, query):
+            plans[i] = tp.plan_trip(query)
+
+        threads = [threading.Thread(target=plan, args=(i, q)) for i, q in enumerate(queries)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(tp.otp_calls, 2)
+        self.assertEqual(plans[0], plans[1])
+        self.assertNotEqual(plans[0], plans[2])
+
+    def test_make_key(self):
+        """ the key is made from a copy of the params, leaving the request's params alone """
+        from ott.utils.parse.url.trip_param_parser import TripParamParser
+        tp = MockOtp(cancelled_routes='TriMet__1')
+        param = TripParamParser('fromPlace=PDX::45.58,-122.59&toPlace=OHSU::45.49,-122.68')
+        key = tp.make_key(param, ('pretty', False))
+        self.assertIn('bannedRoutes', key[0])
+        self.assertFalse(param.banned_routes)
+
+    def test_geocode_cache(self):
+        """ from / to places geocoded once, via the (initially empty) geocode cache ... both ways of setting it up """
+        from ott.otp_client.cache_utils import TtlLruCache
+        from ott.otp_client.geocoder import CachingGeocoder
+        from ott.utils.parse.url.trip_param_parser import TripParamParser
+
+        for tp in (TripPlanner(solr=MockGeo(), geo_cache=TtlLruCache(max_size=10, ttl=60)),
+                   TripPlanner(solr=CachingGeocoder.from_settings(MockGeo(), {}))):
+            self.assertTrue(isinstance(tp.geo, CachingGeocoder))
+            for i in range(3):
+                param = TripParamParser('fromPlace=PDX&toPlace=ZOO')
+                tp.geocode(param)
+                self.assertEqual(param.frm, "PDX::45.5,-122.6")
+            self.assertEqual(tp.geo.geo.calls, 2)
+            self.assertEqual(tp.geo.cache.stats()['hits'], 4)
@@ -0,0 +1,81 @@
+""" Latency histograms and per-stage request timers (e.g., for the Server-Timing header on /plan_trip)
+"""
+import time
+
+from ott.otp_client.metrics import Metrics
+
+import logging
+log = logging.getLogger(__file__)
+
+
+class StageTimer(object):
+    """ high-resolution (perf_counter) timer of the stages of a single request
+
+        with timer.stage('geocode'):
+            ...
+        response.headers['Server-Timing'] = timer.server_timing()
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = []
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def add(self, name, secs):
+        self.stages.append((name, secs * 1000.0))
+
+    def has(self, name):
+        return any(n == name for n, ms in self.stages)
+
+    def total_ms(self):
+        return (time.perf_counter() - self.start) * 1000.0
+
+    def server_timing(self):
+        """ :return: Server-Timing header value, e.g. 'parse;dur=0.21, geocode;dur=12.40, ..., total;dur=80.13' """
+        stages = self.stages + [('total', self.total_ms())]
+        return ", ".join("{};dur={:.2f}".format(n, ms) for n, ms in stages)
+
+
+class _Stage(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.timer.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StageStats(object):
+    """ aggregate (in-process) latency histograms per stage, fed by StageTimers, plus optional slow request logging
+
+        the histograms live in a (per-thread sharded, lock free) Metrics registry, so this is cheap enough to leave on
+        in production ... and when handed the app's METRICS, the stage timings show up at /metrics too
+        slow_ms: log the stage breakdown of requests taking longer than this (0 turns slow request logging off)
+    """
+    def __init__(self, name=None, slow_ms=0, metrics=None):
+        self.name = name
+        self.slow_ms = slow_ms
+        self.metrics = metrics or Metrics()
+        self.metric = "{}_stage".format(name)
+
+    def record(self, timer, info=None):
+        """ add a request's stage timings ... info (or info(), if it's callable) is logged for slow requests """
+        total = timer.total_ms()
+        for n, ms in timer.stages:
+            self.metrics.observe(self.metric, ms, stage=n)
+        self.metrics.observe(self.metric, total, stage='total')
+        if self.slow_ms and total > self.slow_ms:
+            if callable(info):
+                info = info()
+            log.info("slow {} ({:.0f} ms): {} {}".format(self.name, total, timer.server_timing(), info or ""))
+
+    def stats(self):
+        """ :return: dict of stage name to histogram dict """
+        histograms, counters = self.metrics.collect()
+        return dict((dict(labels)['stage'], h.to_dict()) for (name, labels), h in histograms.items() if name == self.metric)
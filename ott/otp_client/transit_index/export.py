@@ -0,0 +1,155 @@
+""" Bulk export of the TI datasets: every stop's route string, plus the full route and stop lists
+    (e.g., rebuilding the geocoder's stop -> route strings, without calling /ti/stops/{stop}/routes/str once per stop)
+
+    each dataset is streamed out of gtfsdb (yield_per / server side cursors), and written row by row as NDJSON (the
+    same dicts the TI endpoints return) or CSV ... memory stays flat however many stops are in the feed:
+
+      - route_strs: {"id": <stop id>, "routes": <route string>} of every stop, as per /ti/stops/{stop}/routes/str
+      - routes:     the route list, as per /ti/routes
+      - stops:      the current stop list (non-detailed), as per the /ti/stops bbox query
+
+    usage:
+      ti_export -d postgresql://ott@localhost/ott -s trimet --agency TriMet -o /tmp/ti route_strs routes stops
+      ti_export -d sqlite:///gtfs.db -f csv --date 3-3-2019 route_strs
+"""
+import os
+import sys
+import csv
+import time
+import argparse
+import itertools
+import simplejson as json
+
+from ott.utils import otp_utils
+
+from .routes import Routes
+from .stops import Stops
+
+import logging
+log = logging.getLogger(__file__)
+
+
+DATASETS = ('route_strs', 'routes', 'stops')
+FIELDS = {
+    'route_strs': ('id', 'routes'),
+    'routes': ('id', 'agencyName', 'shortName', 'longName', 'mode', 'type', 'sortOrder', 'url', 'color', 'textColor'),
+    'stops': ('id', 'agencyName', 'code', 'name', 'desc', 'lat', 'lon', 'url', 'zoneId', 'rsn', 'mode', 'type', 'locationType'),
+}
+
+
+def stop_route_strs(session, date=None, agency_id=None, yield_per=5000):
+    """
+    generator of {'id': stop id, 'routes': route string} for every (current) stop ... one streamed (stop outer join
+    route stop) query, sorted by stop, and then by route stop order, as per Routes.stop_routes_factory()
+    note: as per RouteStop.query_by_stop, the dated route stops are filtered on agency_id (when given)
+    """
+    from sqlalchemy import and_
+    from gtfsdb import Route, Stop, RouteStop, CurrentStops, CurrentRouteStops, util
+
+    # step 1: route table (the small one) ... route id -> (route cfg, agency id)
+    routes = {}
+    for r in session.query(Route):
+        routes[r.route_id] = (Routes._route_cfg_from_gtfsdb_orm(r), r.agency_id)
+
+    # step 2: stop ids and the route ids serving each stop (current, or on date ... and of the agency)
+    agency_col = getattr(RouteStop, 'agency_id', None)  # older gtfsdb route stops have no agency column
+    filter_agency = bool(date) and agency_id is not None
+    if date:
+        date = util.check_date(date)
+        on = and_(RouteStop.stop_id == Stop.stop_id, RouteStop.start_date <= date, date <= RouteStop.end_date)
+        if filter_agency and agency_col is not None:
+            on = and_(on, agency_col == agency_id)
+        q = session.query(Stop.stop_id, RouteStop.route_id).outerjoin(RouteStop, on)
+        q = q.order_by(Stop.stop_id, RouteStop.order, RouteStop.id)
+    else:
+        q = session.query(CurrentStops.stop_id, CurrentRouteStops.route_id)
+        q = q.outerjoin(CurrentRouteStops, CurrentRouteStops.stop_id == CurrentStops.stop_id)
+        q = q.order_by(CurrentStops.stop_id, CurrentRouteStops.order, CurrentRouteStops.id)
+
+    # step 3: one route string per stop (rows of the same stop are adjacent, so only a stop's rows are held)
+    for stop_id, rows in itertools.groupby(q.yield_per(yield_per), key=lambda row: row[0]):
+        route_ids = []
+        stop_routes = []
+        for _, route_id in rows:
+            if route_id is None or route_id in route_ids or route_id not in routes:
+                continue
+            route_ids.append(route_id)
+            cfg, route_agency_id = routes[route_id]
+            if filter_agency and agency_col is None and route_agency_id != agency_id:
+                continue
+            route = Routes._route_from_cfg(cfg, route_id, agency_id if agency_id else route_agency_id)
+            stop_routes.append(route.__dict__)
+        yield {'id': otp_utils.make_otp_id(stop_id, agency_id), 'routes': Routes.routes_str(stop_routes)}
+
+
+def route_list(session, date=None, agency_id=None, yield_per=5000):
+    """ generator of the route list dicts, as per /ti/routes (the route list is small, so it's built in one go) """
+    for r in Routes.route_list_factory(session, date, agency_id):
+        yield r
+
+
+def stop_list(session, date=None, agency_id=None, yield_per=5000):
+    """ generator of the current stop dicts, as per the /ti/stops bbox query (but for every stop) """
+    from gtfsdb import CurrentStops
+    q = Stops._query_current_stops(session).filter(CurrentStops.location_type == 0)
+    q = q.order_by(CurrentStops.stop_id)
+    for cs in q.yield_per(yield_per):
+        yield Stops._stop_from_gtfsdb_currentstop(cs, None, agency_id, False).__dict__
+
+
+GENERATORS = {
+    'route_strs': stop_route_strs,
+    'routes': route_list,
+    'stops': stop_list,
+}
+
+
+def write_dataset(session, dataset, out, fmt='ndjson', date=None, agency_id=None, yield_per=5000):
+    """ write a dataset to the (text) out file, as NDJSON or CSV ... :return: number of rows written """
+    rows = GENERATORS[dataset](session, date, agency_id, yield_per)
+    if fmt == 'csv':
+        writer = csv.DictWriter(out, fieldnames=FIELDS[dataset], extrasaction='ignore', lineterminator='\n')
+        writer.writeheader()
+        write = writer.writerow
+    else:
+        write = lambda row: out.write(json.dumps(row) + "\n")
+
+    ret_val = 0
+    for row in rows:
+        write(row)
+        ret_val += 1
+    return ret_val
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='ti_export', description='bulk export of the TI stop route strings, routes and stops')
+    parser.add_argument('datasets', nargs='*', default=list(DATASETS), help='datasets to export: {} (default all)'.format(', '.join(DATASETS)))
+    parser.add_argument('--database_url', '-d', required=True, help='gtfsdb database url, e.g. postgresql://ott@localhost/ott')
+    parser.add_argument('--schema', '-s', default=None, help='gtfsdb database schema')
+    parser.add_argument('--is_geospatial', '-g', action='store_true', help='gtfsdb database is geospatial (PostGIS)')
+    parser.add_argument('--agency', '-a', default=None, help='agency id used to make the (OTP) ids, e.g. TriMet')
+    parser.add_argument('--date', default=None, help='export routes (and stop route strings) active on this date')
+    parser.add_argument('--format', '-f', default='ndjson', choices=('ndjson', 'csv'), help='output format')
+    parser.add_argument('--output', '-o', default='.', help='output directory (files are named <dataset>.<format>)')
+    parser.add_argument('--yield_per', type=int, default=5000, help='rows fetched per db round trip')
+    args = parser.parse_args()
+
+    bad = [d for d in args.datasets if d not in DATASETS]
+    if bad:
+        sys.exit("unknown dataset(s): {} ... use {}".format(', '.join(bad), ', '.join(DATASETS)))
+
+    from gtfsdb import Database
+    db = Database(url=args.database_url, schema=args.schema, is_geospatial=args.is_geospatial)
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    for dataset in args.datasets:
+        start = time.time()
+        file_path = os.path.join(args.output, "{}.{}".format(dataset, args.format))
+        with db.managed_session() as session, open(file_path, 'w', newline='') as out:
+            num = write_dataset(session, dataset, out, args.format, args.date, args.agency, args.yield_per)
+        print("{} {} rows written to {} in {:.1f} secs".format(num, dataset, file_path, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+""" Version of the GTFS feed loaded into gtfsdb, so in-memory TI caches can tell when a new feed has been loaded
+
+    gtfsdb has no load counter to listen to, so the version is a hash of the feed_info rows plus the row counts of
+    the route and stop (and current route and stop) tables ... a few cheap queries, run at most every check_secs
+
+    once start()ed, the version is polled from a background thread, so the listeners (e.g., index rebuilds) never
+    run on (and block) a request thread, and run whether or not any cache ever calls check()
+
+    .ini settings:
+      feed_check_secs = 60
+"""
+import time
+import hashlib
+import threading
+
+import logging
+log = logging.getLogger(__file__)
+
+
+def query_feed_version(session):
+    """ :return: short hash identifying the feed currently loaded into gtfsdb """
+    from sqlalchemy import func
+    from gtfsdb import FeedInfo, Route, Stop, CurrentRoutes, CurrentStops
+
+    q = session.query(FeedInfo.feed_publisher_name, FeedInfo.feed_version, FeedInfo.feed_start_date, FeedInfo.feed_end_date)
+    parts = [tuple(f) for f in q.order_by(FeedInfo.feed_publisher_name)]
+    for cls in (Route, Stop, CurrentRoutes, CurrentStops):
+        parts.append(session.query(func.count('*')).select_from(cls).scalar())
+    return hashlib.md5(repr(parts).encode('utf-8')).hexdigest()[:12]
+
+
+class FeedWatcher(object):
+    """ keeps the current gtfsdb feed version (re-checked at most every check_secs), and calls its listeners with
+        the new version whenever a new feed shows up ... start() polls for it from a background thread
+    """
+    def __init__(self, db, check_secs=60):
+        self.db = db
+        self.check_secs = check_secs
+        self.version = None
+        self.checked = 0
+        self.listeners = []
+        self._lock = threading.Lock()
+        self._poller = None
+        self._stop = threading.Event()
+
+    def add_listener(self, func):
+        self.listeners.append(func)
+
+    def check(self, force=False):
+        """
+        :return: the feed version ... re-queried when check_secs have passed (or force), by one thread at a time
+        note: once the poller is started, only it (or a force) re-queries the version
+        """
+        if not force and (self._poller is not None or time.time() - self.checked < self.check_secs):
+            return self.version
+        if not self._lock.acquire(False):
+            return self.version  # another thread is checking
+
+        try:
+            self.checked = time.time()
+            with self.db.managed_session(timeout=10) as session:
+                version = query_feed_version(session)
+            if version != self.version:
+                old = self.version
+                self.version = version
+                if old is not None:
+                    log.info("new gtfsdb feed loaded (version {} replaces {})".format(version, old))
+                    for func in self.listeners:
+                        try:
+                            func(version)
+                        except Exception as e:
+                            log.warning(e)
+        except Exception as e:
+            log.warning(e)
+        finally:
+            self._lock.release()
+        return self.version
+
+    def start(self):
+        """ poll the feed version every check_secs from a (daemon) background thread """
+        if self._poller is None and self.check_secs > 0:
+            self._stop.clear()
+            self._poller = threading.Thread(target=self.poll, name='feed-watcher')
+            self._poller.daemon = True
+            self._poller.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._poller = None
+
+    def poll(self):
+        while not self._stop.wait(self.check_secs):
+            self.check(force=True)
+
+    @classmethod
+    def from_settings(cls, db, settings):
+        return cls(db, check_secs=float(settings.get('feed_check_secs', 60)))
@@ -0,0 +1,140 @@
+""" Cache of the /ti/patterns geometry responses: the encoded polyline and GeoJSON json (bytes) of each pattern
+
+    pattern geometries only change when a new feed is loaded, so rather than a db session (and gtfsdb re-encoding the
+    same shape) per request, each response body is kept in a bounded TTL + LRU cache keyed by (agency, pattern id,
+    format) ... along with an ETag (a hash of the body, so the same geometry always gets the same tag), letting clients
+    revalidate with If-None-Match and get a 304
+
+    the cache is dropped whenever the FeedWatcher sees a new feed version.  optionally (pattern_cache_warm), the
+    geometries of the current patterns are computed in bulk (a couple of PostGIS queries) at startup, and again (in
+    the background) after a new feed is loaded.  empty answers (e.g., an unknown pattern) are only kept for
+    pattern_cache_miss_ttl seconds
+
+    .ini settings:
+      pattern_cache_size = 5000
+      pattern_cache_ttl = 86400
+      pattern_cache_miss_ttl = 60
+      pattern_cache_warm = false
+"""
+import hashlib
+import threading
+import simplejson as json
+
+from ott.otp_client.cache_utils import TtlLruCache, MISSING
+
+import logging
+log = logging.getLogger(__file__)
+
+
+ENCODED = 'encoded'
+GEOJSON = 'geojson'
+TRIP = 'trip'  # trip id -> pattern id lookups (for /ti/patterns/trip/{agency}:{trip}/geometry/geojson)
+
+
+class PatternGeometryCache(TtlLruCache):
+    """ (body, etag) of the pattern geometry responses, per (agency, pattern id, format) key """
+    def __init__(self, db, watcher, max_size=5000, ttl=86400, miss_ttl=60, name='pattern_cache'):
+        super(PatternGeometryCache, self).__init__(max_size, ttl, name)
+        self.db = db
+        self.watcher = watcher
+        self.miss_ttl = miss_ttl
+        self.version = None
+        self.warm_agencies = []
+        watcher.add_listener(self.on_new_feed)
+
+    def check_version(self):
+        """ drop the cache when the feed version changes """
+        version = self.watcher.check()
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def geometry(self, pattern_id, agency_id=None, fmt=ENCODED):
+        """ :return: (json bytes, etag) of a pattern's encoded or geojson geometry """
+        self.check_version()
+        key = (agency_id, pattern_id, fmt)
+        ret_val = self.get(key)
+        if ret_val is MISSING:
+            geom = self.query_geometry(pattern_id, agency_id, fmt)
+            ret_val = self.add(key, geom)
+        return ret_val
+
+    def pattern_id_from_trip(self, trip_id, agency_id, query):
+        """ :return: pattern id of a trip, via the query(trip_id, agency_id) function on a cache miss """
+        self.check_version()
+        key = (agency_id, trip_id, TRIP)
+        ret_val = self.get(key)
+        if ret_val is MISSING:
+            ret_val = query(trip_id, agency_id)
+            self.put(key, ret_val, None if ret_val else self.miss_ttl)
+        return ret_val
+
+    def query_geometry(self, pattern_id, agency_id=None, fmt=ENCODED):
+        import gtfsdb
+        with self.db.managed_session(timeout=10) as session:
+            if fmt == GEOJSON:
+                ret_val = gtfsdb.Pattern.get_geometry_geojson(session, pattern_id, agency_id)
+            else:
+                ret_val = gtfsdb.Pattern.get_geometry_encoded(session, pattern_id, agency_id)
+        return ret_val
+
+    def add(self, key, geom):
+        """ cache a geometry's json body and etag ... :return: (body, etag) """
+        body = json.dumps(geom).encode('utf-8')
+        ret_val = (body, self.make_etag(body))
+        is_empty = not geom or (key[2] == ENCODED and not geom.get('points'))
+        self.put(key, ret_val, self.miss_ttl if is_empty else None)
+        return ret_val
+
+    @classmethod
+    def make_etag(cls, body):
+        return hashlib.md5(body).hexdigest()
+
+    def warm(self, agency_ids):
+        """ compute the encoded and geojson geometries of the current patterns in bulk (needs a PostGIS gtfsdb) """
+        self.warm_agencies = list(agency_ids)
+        try:
+            from sqlalchemy import func
+            from gtfsdb import Pattern, Trip, CurrentRoutes
+            if not hasattr(Pattern, 'geom'):
+                log.info("gtfsdb isn't geospatial ... no pattern geometries to warm the cache with")
+                return
+
+            self.check_version()
+            num = 0
+            with self.db.managed_session(timeout=10) as session:
+                current = session.query(Trip.shape_id).filter(Trip.route_id.in_(session.query(CurrentRoutes.route_id)))
+                q = session.query(Pattern.shape_id, func.st_asencodedpolyline(Pattern.geom),
+                                  func.st_npoints(Pattern.geom), func.st_asgeojson(Pattern.geom))
+                q = q.filter(Pattern.shape_id.in_(current)).order_by(Pattern.shape_id)
+                q = q.limit(self.max_size // (2 * max(len(self.warm_agencies), 1)))
+                for pattern_id, points, length, geojson in q.yield_per(100):
+                    for agency_id in self.warm_agencies:
+                        self.add((agency_id, pattern_id, ENCODED), {'points': points, 'length': length})
+                        self.add((agency_id, pattern_id, GEOJSON), json.loads(geojson) if geojson else None)
+                    num += 1
+            log.info("pattern cache warmed with the geometries of {} patterns".format(num))
+        except Exception as e:
+            log.warning(e)
+
+    def on_new_feed(self, version):
+        """ FeedWatcher listener: re-warm (in the background) for the new feed """
+        if self.warm_agencies:
+            t = threading.Thread(target=self.warm, args=(self.warm_agencies,), name='pattern-cache-warm')
+            t.daemon = True
+            t.start()
+
+    @classmethod
+    def from_settings(cls, db, watcher, settings, prefix='pattern_cache'):
+        """ :return: cache, or None when pattern_cache_size is 0 """
+        ret_val = None
+        size = int(settings.get('{}_size'.format(prefix), 5000))
+        if size > 0:
+            ret_val = cls(
+                db, watcher,
+                max_size=size,
+                ttl=float(settings.get('{}_ttl'.format(prefix), 86400)),
+                miss_ttl=float(settings.get('{}_miss_ttl'.format(prefix), 60)),
+                name=prefix
+            )
+        return ret_val
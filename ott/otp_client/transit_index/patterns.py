@@ -22,6 +22,8 @@ class Patterns(Base):
       - SINGLE PATTERN - https://<domain & port>/otp/routers/default/index/pattern/<ID>/geometry
 
     """
+    geometry_cache = None  # optional PatternGeometryCache (see pattern_cache.py) of the geometry responses
+
     def __init__(self, args={}):
         super(Pattern, self).__init__(args)
         ## TODO: Is this class needed?  Maybe for converting gtfsdb route patterns (list), but ???
@@ -47,13 +49,30 @@ class Patterns(Base):
         return ret_val
 
     @classmethod
-    def query_pattern_id_from_trip_id(cls, app_config, trip_id, agency_id=None):
+    def cached_geometry(cls, app_config, pattern_id, agency_id=None, fmt='encoded'):
+        """ :return: (json bytes, etag) of a pattern's 'encoded' or 'geojson' geometry, or None when there's no cache """
         ret_val = None
-
-        try:
+        if cls.geometry_cache is not None:
             if agency_id is None:
                 agency_id = app_config.get_agency()
+            ret_val = cls.geometry_cache.geometry(pattern_id, agency_id, fmt)
+        return ret_val
 
+    @classmethod
+    def query_pattern_id_from_trip_id(cls, app_config, trip_id, agency_id=None):
+        if agency_id is None:
+            agency_id = app_config.get_agency()
+
+        if cls.geometry_cache is not None:
+            query = lambda t, a: cls._query_pattern_id_from_trip_id(app_config, t, a)
+            return cls.geometry_cache.pattern_id_from_trip(trip_id, agency_id, query)
+        return cls._query_pattern_id_from_trip_id(app_config, trip_id, agency_id)
+
+    @classmethod
+    def _query_pattern_id_from_trip_id(cls, app_config, trip_id, agency_id):
+        ret_val = None
+
+        try:
             with app_config.db.managed_session(timeout=10) as session:
                 t = gtfsdb.Trip.query_trip(session, trip_id)
                 if t and t.shape_id:
@@ -0,0 +1,106 @@
+""" Prebuilt /ti/routes responses: the route list json (bytes) per (agency, service date)
+
+    route lists only change when a new feed is loaded, so rather than querying (and serializing) the route list on
+    every /ti/routes call, lists are built once per feed version: for the current routes, and for each service date
+    in a rolling window of route_list_days days from today ... dates outside the window are queried as before
+
+    lists are warmed at startup (and again, in the background, after a new feed is loaded), and the whole cache is
+    dropped whenever the FeedWatcher sees a new feed version ... concurrent misses on the same list share one build
+
+    .ini settings:
+      route_list_cache = true
+      route_list_days = 7
+"""
+import datetime
+import threading
+import simplejson as json
+
+from ott.otp_client.cache_utils import SingleFlight
+
+from .routes import Routes
+
+import logging
+log = logging.getLogger(__file__)
+
+
+class RouteListCache(object):
+    """ route list json (bytes) per (agency, date) key ... a date of None is the current routes """
+    def __init__(self, db, watcher, days=7):
+        self.db = db
+        self.watcher = watcher
+        self.days = days
+        self.version = None
+        self.lists = {}
+        self.warm_agencies = []
+        self._lock = threading.Lock()
+        self._builds = SingleFlight(name='route_list_cache')
+        watcher.add_listener(self.on_new_feed)
+
+    def make_key(self, agency_id, date=None):
+        """ :return: (agency, date) key, or None when the date is outside the window """
+        ret_val = (agency_id, None)
+        if date:
+            from gtfsdb import util
+            d = util.check_date(date)
+            today = datetime.date.today()
+            ret_val = (agency_id, d) if today <= d < today + datetime.timedelta(days=self.days) else None
+        return ret_val
+
+    def get(self, agency_id=None, date=None):
+        """ :return: route list json bytes, or None when the date is outside the window (so query the db instead) """
+        version = self.watcher.check()
+        if version != self.version:
+            with self._lock:
+                self.lists = {}
+                self.version = version
+
+        key = self.make_key(agency_id, date)
+        if key is None:
+            return None
+        lists = self.lists
+        ret_val = lists.get(key)
+        if ret_val is None:
+            ret_val = self._builds.do((version, key), self.add, lists, key)
+        return ret_val
+
+    def add(self, lists, key):
+        """ build (one thread per key, via SingleFlight) and keep a route list """
+        ret_val = lists.get(key)
+        if ret_val is None:
+            ret_val = lists[key] = self.build(*key)
+            self.prune(lists)
+        return ret_val
+
+    def build(self, agency_id, date):
+        with self.db.managed_session(timeout=10) as session:
+            routes = Routes.route_list_factory(session, date, agency_id)
+        return json.dumps(routes).encode('utf-8')
+
+    def prune(self, lists):
+        """ roll the window forward ... drop the lists of days gone by """
+        today = datetime.date.today()
+        for k in [k for k in list(lists) if k[1] and k[1] < today]:
+            lists.pop(k, None)
+
+    def warm(self, agency_ids):
+        """ build the current and (window of) dated route lists for these agencies """
+        self.warm_agencies = list(agency_ids)
+        today = datetime.date.today()
+        dates = [None] + [today + datetime.timedelta(days=i) for i in range(self.days)]
+        for agency_id in self.warm_agencies:
+            for d in dates:
+                try:
+                    self.get(agency_id, d)
+                except Exception as e:
+                    log.warning(e)
+
+    def on_new_feed(self, version):
+        """ FeedWatcher listener: re-warm (in the background) for the new feed """
+        if self.warm_agencies:
+            t = threading.Thread(target=self.warm, args=(self.warm_agencies,), name='route-list-warm')
+            t.daemon = True
+            t.start()
+
+    @classmethod
+    def from_settings(cls, db, watcher, settings):
+        return cls(db, watcher, days=int(settings.get('route_list_days', 7)))
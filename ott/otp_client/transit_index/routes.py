@@ -20,6 +20,8 @@ class Routes(Base):
       - SINGLE ROUTE - https://<domain & port>/otp/routers/default/index/route/<route_id>
       - STOP's ROUTE - https://<domain & port>/otp/routers/default/index/stops/TriMet:<route_id>/routes
     """
+    stop_routes_index = None  # optional in-memory StopRoutesIndex (see stop_routes_index.py), for stop_routes_factory
+
     def __init__(self, args={}):
         super(Routes, self).__init__(args)
         object_utils.safe_set_from_dict(self, 'mode', args)
@@ -52,6 +54,9 @@ class Routes(Base):
         ]
         """
         # import pdb; pdb.set_trace()
+        if cls.stop_routes_index and cls.stop_routes_index.is_loaded():
+            return cls.stop_routes_index.stop_routes(stop_id, date, agency_id)
+
         if date:
             from gtfsdb import RouteStop
             routes = RouteStop.unique_routes_at_stop(session, stop_id=stop_id, agency_id=agency_id, date=date)
@@ -62,6 +67,25 @@ class Routes(Base):
         ret_val = cls._route_list_from_gtfsdb_orm_list(routes, agency_id)
         return ret_val
 
+    @classmethod
+    def routes_str(cls, routes):
+        """
+        :return string of route(s) details (ala string originally formatted for TriMet SOLR geocoder)
+        e.g., "37:37:Lake Grove:;78:78:Denney/Kerr Pkwy:snow"
+        """
+        ret_val = ""
+        if routes and len(routes):
+            spc = ""
+            for r in routes:
+                snow_stop = ""  # data not in GTFS atm, but....
+                agency_id, route_id = otp_utils.breakout_agency_id(r.get("id"))
+                long_name = r.get("longName", "")
+                short_name = r.get("shortName", "")
+                rte = "{}:{}:{}:{}".format(route_id, short_name, long_name, snow_stop)
+                ret_val = "{}{}{}".format(ret_val, spc, rte)
+                spc = ";"
+        return ret_val
+
     @classmethod
     def route_list_factory(cls, session, date=None, agency_id=None):
         """
@@ -90,11 +114,37 @@ class Routes(Base):
             }
         ]
         """
-        from gtfsdb import CurrentRoutes
-        routes = CurrentRoutes.query_active_routes(session, date)
+        if date:
+            routes = cls._query_active_routes(session, date)
+        else:
+            from gtfsdb import CurrentRoutes
+            routes = CurrentRoutes.query_active_routes(session)
         ret_val = cls._route_list_from_gtfsdb_orm_list(routes, agency_id)
         return ret_val
 
+    @classmethod
+    def _query_active_routes(cls, session, date):
+        """
+        routes running service on a date, in 2 queries ... gtfsdb's Route.query_active_routes() queries the service
+        dates of each route, one route at a time
+        """
+        from sqlalchemy import func
+        from gtfsdb import Route, Trip, UniversalCalendar, util
+        date = util.check_date(date)
+
+        # step 1: first and last service date of every route
+        q = session.query(Trip.route_id, func.min(UniversalCalendar.date), func.max(UniversalCalendar.date))
+        q = q.filter(UniversalCalendar.service_id == Trip.service_id).group_by(Trip.route_id)
+        dates = dict((route_id, (start, end)) for route_id, start, end in q)
+
+        # step 2: filter the route list by those dates (ala Route.is_active)
+        ret_val = []
+        for r in Route.query_route_list(session):
+            start, end = dates.get(r.route_id, (None, None))
+            if (start is None or start <= date) and (end is None or date <= end):
+                ret_val.append(r)
+        return ret_val
+
     @classmethod
     def route_factory(cls, session, route_id, agency_id=None):
         """
@@ -148,17 +198,26 @@ class Routes(Base):
     @classmethod
     def _route_from_gtfsdb_orm(cls, r, agency_id=None):
         """ factory to genereate a Route obj from a queried gtfsdb route """
-        agency = agency_id if agency_id else r.agency_id
-        otp_route_id = otp_utils.make_otp_id(r.route_id, agency)
+        cfg = cls._route_cfg_from_gtfsdb_orm(r)
+        ret_val = cls._route_from_cfg(cfg, r.route_id, agency_id if agency_id else r.agency_id)
+        return ret_val
+
+    @classmethod
+    def _route_cfg_from_gtfsdb_orm(cls, r):
+        """ :return: the (agency id independent) Route cfg dict of a gtfsdb route """
         cfg = {
-            'agencyName': r.agency.agency_name, 'id': otp_route_id,
+            'agencyName': r.agency.agency_name,
             'longName': r.route_long_name, 'shortName': r.route_short_name,
             'mode': r.type.otp_type, 'type': r.type.route_type,
             'sortOrder': r.route_sort_order,
             'color': r.route_color, 'textColor': r.route_text_color
         }
-        ret_val = Routes(cfg)
-        return ret_val
+        return cfg
+
+    @classmethod
+    def _route_from_cfg(cls, cfg, route_id, agency_id):
+        cfg = dict(cfg, id=otp_utils.make_otp_id(route_id, agency_id))
+        return Routes(cfg)
 
     @classmethod
     def mock(cls, agency_id="MOCK"):
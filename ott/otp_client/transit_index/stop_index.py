@@ -0,0 +1,202 @@
+""" In-memory spatial index of the current stops, for the /ti/stops bbox and nearest stop queries
+
+    the current stop set is small (thousands of stops) and only changes on a feed load, so rather than a PostGIS
+    query per map pan, the stops are held in numpy lat / lon columns, bucketed into a uniform grid of cell_deg
+    sized cells ... a query only looks at the cells it overlaps, and computes the distances of all those candidate
+    stops at once (vectorized)
+
+    the index is built from gtfsdb at startup (stop_index = true), and rebuild() swaps in a new grid atomically (e.g.,
+    after a new feed is loaded) ... queries in flight keep using the grid they started with
+
+    .ini settings:
+      stop_index = false
+      stop_index_cell_deg = 0.01
+"""
+import math
+import threading
+
+from .stops import Stops
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import logging
+log = logging.getLogger(__file__)
+
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def distances(lat, lon, lats, lons):
+    """ :return: numpy array of the great circle (haversine) distances in meters, from a point to arrays of points """
+    lat1, lon1 = math.radians(lat), math.radians(lon)
+    lat2, lon2 = numpy.radians(lats), numpy.radians(lons)
+    a = numpy.sin((lat2 - lat1) / 2.0) ** 2 + math.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS_M * numpy.arcsin(numpy.sqrt(a))
+
+
+class StopGrid(object):
+    """ immutable uniform grid of stops: lat / lon columns, sorted by grid cell, and each cell's slice of them """
+    def __init__(self, stop_ids, cfgs, lats, lons, cell_deg=0.01):
+        self.cell_deg = cell_deg
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        lons = numpy.asarray(lons, dtype=numpy.float64)
+        self.min_lat = float(lats.min()) if len(lats) else 0.0
+        self.min_lon = float(lons.min()) if len(lons) else 0.0
+        self.num_rows = int(self.cell(lats.max(), 'lat')) + 1 if len(lats) else 0
+        self.num_cols = int(self.cell(lons.max(), 'lon')) + 1 if len(lons) else 0
+
+        # step 1: sort the stops by grid cell
+        cells = self.cell(lats, 'lat') * self.num_cols + self.cell(lons, 'lon')
+        order = numpy.argsort(cells, kind='stable')
+        self.lats = lats[order]
+        self.lons = lons[order]
+        self.stop_ids = [stop_ids[i] for i in order]
+        self.cfgs = [cfgs[i] for i in order]
+
+        # step 2: cell number -> (start, end) slice of the sorted columns
+        self.cells = {}
+        cells = cells[order]
+        keys, starts = numpy.unique(cells, return_index=True)
+        ends = list(starts[1:]) + [len(cells)]
+        for k, s, e in zip(keys, starts, ends):
+            self.cells[int(k)] = (int(s), int(e))
+
+    def __len__(self):
+        return len(self.stop_ids)
+
+    def cell(self, val, axis):
+        origin = self.min_lat if axis == 'lat' else self.min_lon
+        return numpy.floor((val - origin) / self.cell_deg).astype(numpy.int64)
+
+    def candidates(self, min_lat, max_lat, min_lon, max_lon):
+        """ :return: numpy array of the (sorted column) indexes of the stops in the grid cells overlapping a bbox """
+        r0 = max(int(math.floor((min_lat - self.min_lat) / self.cell_deg)), 0)
+        r1 = min(int(math.floor((max_lat - self.min_lat) / self.cell_deg)), self.num_rows - 1)
+        c0 = max(int(math.floor((min_lon - self.min_lon) / self.cell_deg)), 0)
+        c1 = min(int(math.floor((max_lon - self.min_lon) / self.cell_deg)), self.num_cols - 1)
+        if r1 < r0 or c1 < c0:
+            return numpy.arange(0)
+        if (r1 - r0 + 1) * (c1 - c0 + 1) >= len(self.cells):
+            return numpy.arange(len(self.stop_ids))  # big bbox ... cheaper to scan every stop
+
+        slices = []
+        for r in range(r0, r1 + 1):
+            for c in range(c0, c1 + 1):
+                s = self.cells.get(r * self.num_cols + c)
+                if s:
+                    slices.append(numpy.arange(s[0], s[1]))
+        return numpy.concatenate(slices) if slices else numpy.arange(0)
+
+    def in_bbox(self, min_lat, max_lat, min_lon, max_lon, limit=1000):
+        """ :return: indexes of (up to limit) stops within the bbox """
+        i = self.candidates(min_lat, max_lat, min_lon, max_lon)
+        lats = self.lats[i]
+        lons = self.lons[i]
+        mask = (lats >= min_lat) & (lats <= max_lat) & (lons >= min_lon) & (lons <= max_lon)
+        return i[mask][:limit]
+
+    def nearest(self, lat, lon, limit=10, radius=None):
+        """ :return: list of (index, distance in meters) of the limit nearest stops (within radius meters, if given)
+
+            searches (doubling) rings of grid cells around the point, until a ring holds enough stops that are closer
+            than the ring's edge
+        """
+        ret_val = []
+        if len(self.stop_ids) == 0:
+            return ret_val
+
+        ring = 1
+        while True:
+            # step 1: distances to every stop in the cells within ring cells of the point
+            d = self.cell_deg * ring
+            i = self.candidates(lat - d, lat + d, lon - d, lon + d)
+            dist = distances(lat, lon, self.lats[i], self.lons[i])
+            if radius is not None:
+                keep = dist <= radius
+                i, dist = i[keep], dist[keep]
+
+            # step 2: no closer stops can be outside the ring's square, so stop once it holds enough stops
+            covered = math.radians(d) * EARTH_RADIUS_M * math.cos(math.radians(min(abs(lat) + d, 89.9)))
+            if numpy.count_nonzero(dist <= covered) >= limit or len(i) == len(self.stop_ids):
+                break
+            if radius is not None and covered >= radius:
+                break
+            ring *= 2
+
+        order = numpy.argsort(dist, kind='stable')[:limit]
+        for o in order:
+            ret_val.append((int(i[o]), float(dist[o])))
+        return ret_val
+
+    @classmethod
+    def from_session(cls, session, cell_deg=0.01):
+        """ build a grid from the gtfsdb CurrentStops (the stop and amenity details too, in a couple of queries) """
+        from gtfsdb import CurrentStops
+        stop_ids, cfgs, lats, lons = [], [], [], []
+        q = Stops._query_current_stops(session, detailed=True).filter(CurrentStops.location_type == 0)
+        for cs in q:
+            stop_ids.append(cs.stop_id)
+            cfgs.append(Stops._stop_cfg_from_gtfsdb_currentstop(cs, detailed=True))
+            lats.append(float(cs.stop_lat))
+            lons.append(float(cs.stop_lon))
+        return cls(stop_ids, cfgs, lats, lons, cell_deg)
+
+
+class StopIndex(object):
+    """ bbox and nearest stop queries, answered from the current StopGrid (see rebuild()) """
+    def __init__(self, cell_deg=0.01):
+        self.cell_deg = cell_deg
+        self.grid = None
+        self._lock = threading.Lock()
+
+    def is_loaded(self):
+        return self.grid is not None
+
+    def rebuild(self, session):
+        """ build a new grid from gtfsdb, and swap it in """
+        with self._lock:
+            grid = StopGrid.from_session(session, self.cell_deg)
+            self.grid = grid
+        log.info("stop index built with {} stops".format(len(grid)))
+        return grid
+
+    def bbox_stops(self, bbox, agency_id=None, limit=1000, detailed=False):
+        """ :return: list of stop dicts within the bbox, as per Stops.bbox_stops() """
+        grid = self.grid
+        ret_val = []
+        for i in grid.in_bbox(bbox.min_lat, bbox.max_lat, bbox.min_lon, bbox.max_lon, limit):
+            ret_val.append(self.make_stop(grid, i, agency_id, detailed))
+        return ret_val
+
+    def nearest_stops(self, point, agency_id=None, limit=10, radius=None, detailed=False):
+        """ :return: list of the nearest stop dicts (with dist in meters), as per Stops.nearest_stops() """
+        grid = self.grid
+        ret_val = []
+        for i, dist in grid.nearest(point.lat, point.lon, limit, radius):
+            ret_val.append(self.make_stop(grid, i, agency_id, detailed, dist))
+        return ret_val
+
+    @classmethod
+    def make_stop(cls, grid, i, agency_id, detailed, dist=None):
+        cfg = grid.cfgs[i]
+        if not detailed or dist is not None:
+            cfg = dict(cfg)
+            if not detailed:
+                cfg.pop('amenities', None)
+            if dist is not None:
+                cfg['dist'] = round(dist, 1)
+        return Stops._stop_from_cfg(cfg, grid.stop_ids[i], agency_id).__dict__
+
+    @classmethod
+    def from_db(cls, db, cell_deg=0.01):
+        """ :return: a StopIndex built from a gtfsdb Database (or None, when numpy isn't installed) """
+        if numpy is None:
+            log.warning("numpy is needed for the stop index (pip install ott.otp_client[numpy])")
+            return None
+        ret_val = cls(cell_deg)
+        with db.managed_session() as session:
+            ret_val.rebuild(session)
+        return ret_val
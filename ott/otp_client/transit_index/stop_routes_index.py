@@ -0,0 +1,143 @@
+""" In-memory stop -> routes index, for /ti/stops/{stop}/routes (and its /str variant) without a db query
+
+    the geocoder build asks for the routes of every stop in the system, and each answer used to be a
+    (Current)RouteStops query ... instead, the route stops are loaded once per feed into:
+
+      - a route table: the Route cfg (see Routes._route_cfg_from_gtfsdb_orm) and agency id of every route
+      - current: stop id -> array of route table indexes (the CurrentRouteStops, in stop order)
+      - dated: stop id -> (array of route table indexes, list of day bitsets, list of agency ids) from the
+        RouteStops ... bit n of a bitset is set when that route serves the stop on the n'th day after first_date, so a
+        date lookup is a shift
+
+    lookups are O(routes at the stop).  rebuild() swaps in new tables atomically (e.g., from a FeedWatcher listener).
+    note: as per gtfsdb's unique_routes_at_stop(), dated lookups only return the route stops of the given agency
+    (RouteStop.agency_id, or the route's agency when gtfsdb's RouteStop has no agency column), while current lookups
+    (CurrentRouteStops) don't filter on agency ... either way, the agency id makes the route ids
+
+    .ini settings:
+      stop_routes_index = true
+"""
+import array
+import threading
+
+from .routes import Routes
+
+import logging
+log = logging.getLogger(__file__)
+
+
+class StopRoutesTables(object):
+    """ immutable route table, plus current and dated stop -> route indexes """
+    def __init__(self):
+        self.route_ids = []
+        self.agency_ids = []
+        self.cfgs = []
+        self.current = {}
+        self.dated = {}
+        self.first_date = None
+        self._route_index = {}
+
+    @classmethod
+    def from_session(cls, session):
+        """ load the tables with a handful of (mostly column only, streamed) queries """
+        from gtfsdb import Route, RouteStop, CurrentRouteStops
+        ret_val = cls()
+
+        # step 1: route table
+        for r in session.query(Route).order_by(Route.route_sort_order, Route.route_id):
+            ret_val._route_index[r.route_id] = len(ret_val.route_ids)
+            ret_val.route_ids.append(r.route_id)
+            ret_val.agency_ids.append(r.agency_id)
+            ret_val.cfgs.append(Routes._route_cfg_from_gtfsdb_orm(r))
+
+        # step 2: current route stops, in (stop) order
+        q = session.query(CurrentRouteStops.stop_id, CurrentRouteStops.route_id)
+        q = q.order_by(CurrentRouteStops.stop_id, CurrentRouteStops.order, CurrentRouteStops.id)
+        for stop_id, route_id in q.yield_per(5000):
+            i = ret_val._route_index.get(route_id)
+            if i is not None:
+                routes = ret_val.current.get(stop_id)
+                if routes is None:
+                    routes = ret_val.current[stop_id] = array.array('i')
+                if i not in routes:
+                    routes.append(i)
+
+        # step 3: dated route stops, as a bitset of the days each serves the stop
+        from sqlalchemy import func
+        ret_val.first_date = session.query(func.min(RouteStop.start_date)).scalar()
+        agency_col = getattr(RouteStop, 'agency_id', None)  # older gtfsdb route stops have no agency column
+        cols = [RouteStop.stop_id, RouteStop.route_id, RouteStop.start_date, RouteStop.end_date]
+        if agency_col is not None:
+            cols.append(agency_col)
+        q = session.query(*cols).order_by(RouteStop.stop_id, RouteStop.order, RouteStop.id)
+        for row in q.yield_per(5000):
+            stop_id, route_id, start, end = row[:4]
+            i = ret_val._route_index.get(route_id)
+            if i is None or start is None or end is None or end < start:
+                continue
+            days = (end - start).days + 1
+            bits = ((1 << days) - 1) << (start - ret_val.first_date).days
+            dated = ret_val.dated.get(stop_id)
+            if dated is None:
+                dated = ret_val.dated[stop_id] = (array.array('i'), [], [])
+            dated[0].append(i)
+            dated[1].append(bits)
+            dated[2].append(row[4] if agency_col is not None else ret_val.agency_ids[i])
+        return ret_val
+
+    def route_indexes(self, stop_id, date=None, agency_id=None):
+        """
+        :return: unique route table indexes at a stop ... current routes, or those serving the stop on date
+                 (and, when given, run by agency_id)
+        """
+        if date is None:
+            return list(self.current.get(stop_id, ()))
+
+        ret_val = []
+        dated = self.dated.get(stop_id)
+        if dated and self.first_date:
+            day = (date - self.first_date).days
+            if day >= 0:
+                for i, bits, agency in zip(*dated):
+                    if agency_id is not None and agency != agency_id:
+                        continue
+                    if (bits >> day) & 1 and i not in ret_val:
+                        ret_val.append(i)
+        return ret_val
+
+
+class StopRoutesIndex(object):
+    """ Routes.stop_routes_factory() answers, from the current StopRoutesTables """
+    def __init__(self):
+        self.tables = None
+        self._lock = threading.Lock()
+
+    def is_loaded(self):
+        return self.tables is not None
+
+    def rebuild(self, session):
+        with self._lock:
+            tables = StopRoutesTables.from_session(session)
+            self.tables = tables
+        log.info("stop routes index built for {} stops and {} routes".format(len(tables.current), len(tables.route_ids)))
+        return tables
+
+    def stop_routes(self, stop_id, date=None, agency_id=None):
+        """ :return: list of route dicts serving a stop, as per Routes.stop_routes_factory() """
+        tables = self.tables
+        if date:
+            from gtfsdb import util
+            date = util.check_date(date)
+
+        ret_val = []
+        for i in tables.route_indexes(stop_id, date, agency_id):
+            agency = agency_id if agency_id else tables.agency_ids[i]
+            ret_val.append(Routes._route_from_cfg(tables.cfgs[i], tables.route_ids[i], agency).__dict__)
+        return ret_val
+
+    @classmethod
+    def from_db(cls, db):
+        ret_val = cls()
+        with db.managed_session(timeout=10) as session:
+            ret_val.rebuild(session)
+        return ret_val
@@ -1,3 +1,5 @@
+import math
+
 from ott.utils import object_utils
 from ott.utils import otp_utils
 from ott.utils import geo_utils
@@ -35,6 +37,8 @@ class Stops(Base):
     https://trimet-otp.conveyal.com/otp/routers/default/index/stops/TriMet:823/stoptimes?timeRange=14400
 
     """
+    stop_index = None  # optional in-memory StopIndex (see stop_index.py), used for the bbox and nearest stop queries
+
     def __init__(self, args={}):
         super(Stops, self).__init__(args)
         object_utils.safe_set_from_dict(self, 'code', args)
@@ -62,7 +66,11 @@ class Stops(Base):
         """
         ret_val = def_val
         from gtfsdb import CurrentStops
-        cs = CurrentStops.query_orm_for_stop(session, stop_id, detailed)
+        try:
+            cs = cls._query_current_stops(session, detailed).filter(CurrentStops.stop_id == stop_id).first()
+        except Exception as e:
+            log.info(e)
+            cs = None
         if cs:
             ret_val = cls._stop_from_gtfsdb_currentstop(cs, None, agency_id, detailed)
         return ret_val
@@ -87,16 +95,25 @@ class Stops(Base):
 
         :return a list of stops within the bbox
         """
+        if cls.stop_index and cls.stop_index.is_loaded():
+            return cls.stop_index.bbox_stops(bbox, agency_id, limit, detailed)
+
         from gtfsdb import CurrentStops
-        stops = CurrentStops.query_stops_via_bbox(session, bbox.to_gtfsdb_bbox(), limit)
+        try:
+            q = cls._query_current_stops(session, detailed).filter(CurrentStops.location_type == 0)
+            q = q.filter(CurrentStops.geom.ST_Within(bbox.to_gtfsdb_bbox().to_geojson()))
+            stops = q.limit(limit).all()
+        except Exception as e:
+            log.warning(e)
+            stops = []
         ret_val = cls._stop_list_from_gtfsdb_list(stops, None, agency_id, limit, detailed)
         return ret_val
 
     @classmethod
-    def nearest_stops(cls, session, point, agency_id=None, limit=10, detailed=False):
+    def nearest_stops(cls, session, point, agency_id=None, limit=10, detailed=False, radius=None):
         """
         query nearest stops based on walk graph
-        :params db session, POINT(x,y), limit=10:
+        :params db session, POINT(x,y), limit=10, radius (meters) or None for no limit:
 
         https://<domain & port>/otp/routers/default/index/stops?
         radius=1000&lat=45.4926336&lon=-122.63915519999999
@@ -114,17 +131,96 @@ class Stops(Base):
 
         :return a list of nearest stops
         """
+        if cls.stop_index and cls.stop_index.is_loaded():
+            return cls.stop_index.nearest_stops(point, agency_id, limit, radius, detailed)
+
+        try:
+            if session.get_bind().dialect.name == 'postgresql':
+                stops = cls._query_nearest_postgis(session, point, limit, radius, detailed)
+            else:
+                stops = cls._query_nearest_vectorized(session, point, limit, radius, detailed)
+        except Exception as e:
+            log.warning(e)
+            stops = []
+
+        ret_val = []
+        for cs, dist in stops:
+            cfg = cls._stop_cfg_from_gtfsdb_currentstop(cs, detailed)
+            cfg['dist'] = round(dist, 1)
+            stop = cls._stop_from_cfg(cfg, cs.stop_id, agency_id)
+            ret_val.append(stop.__dict__)
+        return ret_val
+
+    @classmethod
+    def _query_nearest_postgis(cls, session, point, limit=10, radius=None, detailed=False):
+        """
+        single, index assisted PostGIS query for the nearest stops: ordered by the KNN (<->) operator, bounded by
+        ST_DWithin(radius) and with the distance (meters, on the spheroid) calculated in the db
+        :return list of (CurrentStops, dist) tuples
+        """
+        from sqlalchemy import cast, func
+        from geoalchemy2 import Geography
         from gtfsdb import CurrentStops
-        stops = CurrentStops.query_stops_via_point(session, point.to_gtfsdb_point(), limit)
-        ret_val = cls._stop_list_from_gtfsdb_list(stops, point, agency_id, limit, detailed)
+
+        pt = func.ST_GeomFromEWKT(point.to_gtfsdb_point().to_geojson())
+        dist = func.ST_Distance(cast(CurrentStops.geom, Geography), cast(pt, Geography))
+        q = cls._query_current_stops(session, detailed).add_columns(dist.label('dist'))
+        q = q.filter(CurrentStops.location_type == 0)
+        if radius:
+            # note: the (degrees) geometry ST_DWithin uses the geom index, the geography one is exact (meters)
+            deg = 1.5 * radius / 111320.0 / max(math.cos(math.radians(abs(point.lat))), 0.01)
+            q = q.filter(CurrentStops.geom.ST_DWithin(pt, deg))
+            q = q.filter(func.ST_DWithin(cast(CurrentStops.geom, Geography), cast(pt, Geography), radius))
+        q = q.order_by(CurrentStops.geom.distance_centroid(pt))
+        ret_val = [(cs, float(d)) for cs, d in q.limit(limit)]
+        ret_val.sort(key=lambda x: x[1])  # KNN order is by (planar) degrees, so fix up any near ties
         return ret_val
 
+    @classmethod
+    def _query_nearest_vectorized(cls, session, point, limit=10, radius=None, detailed=False):
+        """
+        nearest stops for dbs without PostGIS (e.g., SQLite): stops within the radius's bbox (or else all stops), then
+        the distances of all of them computed at once (numpy), and sorted
+        :return list of (CurrentStops, dist) tuples
+        """
+        from gtfsdb import CurrentStops
+        q = cls._query_current_stops(session, detailed).filter(CurrentStops.location_type == 0)
+        if radius:
+            dlat = radius / 111320.0
+            dlon = dlat / max(math.cos(math.radians(abs(point.lat) + dlat)), 0.01)
+            q = q.filter(CurrentStops.stop_lat.between(point.lat - dlat, point.lat + dlat))
+            q = q.filter(CurrentStops.stop_lon.between(point.lon - dlon, point.lon + dlon))
+        stops = q.all()
+
+        from .stop_index import distances, numpy
+        if numpy is not None:
+            dists = distances(point.lat, point.lon, [float(cs.stop_lat) for cs in stops], [float(cs.stop_lon) for cs in stops]).tolist()
+        else:
+            dists = [geo_utils.distance(point.lat, point.lon, cs.stop_lat, cs.stop_lon) for cs in stops]
+
+        ret_val = [(cs, d) for cs, d in zip(stops, dists) if radius is None or d <= radius]
+        ret_val.sort(key=lambda x: x[1])
+        return ret_val[:limit]
+
+    @classmethod
+    def _query_current_stops(cls, session, detailed=False):
+        """
+        CurrentStops query, eager loading everything _stop_from_gtfsdb_currentstop() reads, so a list of stops is a
+        constant number of queries: the stop is joined, and (detailed) amenities are a single 'select in' query
+        """
+        from sqlalchemy.orm import joinedload
+        from gtfsdb import CurrentStops, Stop
+        load = joinedload(CurrentStops.stop)
+        if detailed:
+            load = load.selectinload(Stop.stop_features)
+        return session.query(CurrentStops).options(load)
+
     @classmethod
     def _stop_list_from_gtfsdb_list(cls, gtfsdb_currentstop_list, point, agency_id, limit=10, detailed=False):
         """ input gtfsdb list, output Route obj list """
         ret_val = []
         for i, cs in enumerate(gtfsdb_currentstop_list):
-            if i > limit:
+            if i >= limit:
                 break
             stop = cls._stop_from_gtfsdb_currentstop(cs, point, agency_id, detailed)
             ret_val.append(stop.__dict__)
@@ -138,13 +234,17 @@ class Stops(Base):
               agency, routes, tiny names, etc... are pre-calculated
               and stops are updated weekly (daily) in this current schema
         """
-        agency_name = agency_id
-
-        otp_stop_id = otp_utils.make_otp_id(cs.stop_id, agency_id)
+        cfg = cls._stop_cfg_from_gtfsdb_currentstop(cs, detailed)
+        if point:
+            cfg['dist'] = geo_utils.distance(point.lat, point.lon, cs.stop_lat, cs.stop_lon)
+        ret_val = cls._stop_from_cfg(cfg, cs.stop_id, agency_id)
+        return ret_val
 
+    @classmethod
+    def _stop_cfg_from_gtfsdb_currentstop(cls, cs, detailed):
+        """ :return: the (agency independent) Stop cfg dict of a gtfsdb stop """
         cfg = {
-            'agencyName': agency_name,
-            'id': otp_stop_id, 'code': cs.stop.stop_code,
+            'code': cs.stop.stop_code,
             'name': cs.stop.stop_name, 'desc': cs.stop.stop_desc,
             'lat': float(cs.stop_lat), 'lon': float(cs.stop_lon),
             'url': getattr(cs.stop, 'stop_url', None),
@@ -153,16 +253,14 @@ class Stops(Base):
             'rsn': cs.route_short_names,
             'locationType': cs.location_type,
         }
-
         if detailed:
             cfg['amenities'] = cs.stop.amenities
+        return cfg
 
-        if point:
-            # todo ... have the dist come from PostGIS (Duh!)
-            cfg['dist'] = geo_utils.distance(point.lat, point.lon, cs.stop_lat, cs.stop_lon)
-
-        ret_val = Stops(cfg)
-        return ret_val
+    @classmethod
+    def _stop_from_cfg(cls, cfg, stop_id, agency_id):
+        cfg = dict(cfg, agencyName=agency_id, id=otp_utils.make_otp_id(stop_id, agency_id))
+        return Stops(cfg)
 
     @classmethod
     def mock(cls, num_recs=5):
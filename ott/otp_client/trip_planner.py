@@ -2,13 +2,30 @@ from ott.utils import json_utils
 from ott.utils import html_utils
 from ott.utils import otp_utils
 from ott.otp_client import otp_to_ott
+from ott.otp_client import http_utils
+from ott.otp_client.cache_utils import MISSING
+from ott.otp_client.plan_cache import PlanCache
+from ott.otp_client.geocoder import CachingGeocoder
+from ott.otp_client.content import ContentRefresher
+from ott.otp_client.content import ADVERT_MODES
+from ott.otp_client.otp_backends import OtpBackends
+from ott.otp_client.timing import StageTimer
+from ott.otp_client.timing import StageStats
+from ott.otp_client.metrics import METRICS
 from ott.utils.parse.url.trip_param_parser import TripParamParser
 from ott.geocoder.geosolr import GeoSolr
 
 import sys
+import time
 import simplejson as json
 import urllib
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
 import contextlib
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import logging
 log = logging.getLogger(__file__)
 
@@ -17,95 +34,293 @@ class TripPlanner(object):
     """
     example trip queries:
     """
-    def __init__(self, otp_url="http://localhost/prod", solr='http://localhost/solr', adverts=None, fares=None, cancelled_routes=None):
-        self.otp_url = otp_url
+    def __init__(self, otp_url="http://localhost/prod", solr='http://localhost/solr', adverts=None, fares=None, cancelled_routes=None, plan_cache=None, otp_pool=None, geo_cache=None, single_flight=None, content_refresh=0, langs=('en', 'es'), otp_backends=None, slow_ms=0):
+        self.otp_url = otp_url  # one (or a list / comma separated string of) OTP planner url(s)
+        self.plan_cache = plan_cache  # optional PlanCache (see plan_cache.py)
+        self.single_flight = single_flight  # optional SingleFlight, coalescing identical in-flight requests
+        self.stage_stats = StageStats('plan_trip', slow_ms, METRICS)  # latency histograms of each plan_trip() stage
+        self.otp_pool = otp_pool or http_utils.get_pool('otp')  # keep-alive connections to OTP (see http_utils.py)
+        self.otp = otp_backends or OtpBackends(otp_url, self.otp_pool)  # load balancing over the OTP url(s)
 
         self.geo = solr
         if isinstance(solr, str):
             self.geo = GeoSolr(solr)
+        if geo_cache is not None:
+            self.geo = CachingGeocoder(self.geo, geo_cache)  # optional TtlLruCache of geocodes (see geocoder.py)
+        self.geo_pool = ThreadPoolExecutor(max_workers=10)  # for geocoding 'from' and 'to' concurrently
 
-        self.adverts = adverts
-        self.fares = fares
-        self.cancelled_routes = cancelled_routes
-
-        # optionally create Adverts and Fares objects
+        # optionally create Adverts, Fares and CancelledRoutes content, kept fresh by a background ContentRefresher
         # note: requires change to this buildout to include the ott.data project
-        try:
-            if isinstance(adverts, str):
-                from ott.data.content import Adverts
-                self.adverts = Adverts(adverts)
-        except Exception as e:
-            log.warning(e)
+        self.content = ContentRefresher()
+        if isinstance(adverts, str):
+            queries = [(m, l) for m in ADVERT_MODES for l in langs]
+            self.content.add_source('adverts', partial(self.make_content, 'Adverts', adverts), content_refresh or 300, queries)
+        elif adverts:
+            self.content.set('adverts', adverts)
 
-        try:
-            if isinstance(fares, str):
-                from ott.data.content import Fares
-                self.fares = Fares(fares)
-        except Exception as e:
-            log.warning(e)
+        if isinstance(fares, str):
+            queries = otp_to_ott.Fare.FARE_INFO
+            self.content.add_source('fares', partial(self.make_content, 'Fares', fares), content_refresh or 300, queries)
+        elif fares:
+            self.content.set('fares', fares)
 
-        try:
-            if isinstance(cancelled_routes, str) and 'http' in cancelled_routes:
-                self.cancelled_routes = ""
-                from ott.data.content import CancelledRoutes
-                self.cancelled_routes = CancelledRoutes(cancelled_routes)
-        except Exception as e:
-            log.warning(e)
+        if isinstance(cancelled_routes, str) and 'http' in cancelled_routes:
+            self.content.set('cancelled_routes', "")
+            self.content.add_source('cancelled_routes', partial(self.make_content, 'CancelledRoutes', cancelled_routes), content_refresh or 300)
+        else:
+            self.content.set('cancelled_routes', cancelled_routes)
+
+        if content_refresh:
+            self.content.start()
+        else:
+            self.content.refresh_all()
+
+    @property
+    def adverts(self):
+        return self.content.get('adverts')
 
-    def plan_trip(self, request=None, pretty=False):
+    @property
+    def fares(self):
+        return self.content.get('fares')
+
+    @property
+    def cancelled_routes(self):
+        return self.content.get('cancelled_routes')
+
+    @classmethod
+    def make_content(cls, class_name, url):
+        """ :return: new ott.data.content object (e.g., Adverts, Fares or CancelledRoutes) for the url """
+        from ott.data import content
+        return getattr(content, class_name)(url)
+
+    def plan_trip(self, request=None, pretty=False, timer=None):
         """
         ...
         powell%20blvd::45.49063653,-122.4822897"  "45.433507,-122.559709
+
+        :param timer: optional StageTimer, which gets the time spent in each stage (e.g., for a Server-Timing header)
         """
         # import pdb; pdb.set_trace()
+        if timer is None:
+            timer = StageTimer()
+
+        # step 1: parse params (and the optional fields / include param, for which parts of the plan to build)
+        with timer.stage('params'):
+            param = TripParamParser(request)
+            fields = otp_to_ott.Fields.from_param_parser(param)
 
-        # step 1: parse params
-        param = TripParamParser(request)
+            pretty = pretty or param.pretty_output()
+            lang = html_utils.get_lang(request)
 
         # step 2: handle any geocoding needing to be done -- note, changes param object implicitly in the call
-        msg = self.geocode(param)
+        with timer.stage('geocode'):
+            msg = self.geocode(param)
         if msg:
             # TODO -- trip error or plan?
             pass
 
-        # step 3: call the trip planner...
-        otp_params = param
-        otp_params.banned_routes = self.cancelled_routes
-        if otp_params.is_latest():
-            # step 3b: if we have Arr=L (latest trip), we need to increase the date by 1 day, since LATEST
-            # trip is essentially an ArriveBy 1:30am trip
-            if msg == 'chk':
-                otp_utils.kill()
-            otp_params = param.clone()
-            otp_params.date_offset(day_offset=1)
+        # step 3: check the plan cache (keyed on the geocoded params echoed in our output, plus anything changing it)
+        key = None
+        if self.plan_cache is not None or self.single_flight:
+            key = self.make_key(param, ('fields', tuple(sorted(fields.names))), ('pretty', bool(pretty)),
+                                ('itin_num', param.get_itin_num_as_int()), ('lang', lang))
+        if self.plan_cache is not None:
+            with timer.stage('cache'):
+                ret_val = self.plan_cache.get(key)
+            if ret_val is not MISSING:
+                self.stage_stats.record(timer, param.otp_url_params)
+                return ret_val
 
-        url = "{0}?{1}".format(self.otp_url, otp_params.otp_url_params())
-        f = otp_utils.call_planner_svc(url)
-        j = json.loads(f)
+        # step 4: call OTP and build our response (only good plans get cached, and only once all the content, like
+        #         fares and adverts, has loaded) ... identical requests (same exact key) already in flight are
+        #         coalesced, sharing the one OTP call and response
+        if self.single_flight:
+            start = time.perf_counter()
+            ret_val, is_plan = self.single_flight.do(key, self.make_plan, param, fields, pretty, lang, msg, timer)
+            if not timer.has('otp'):
+                timer.add('coalesced', time.perf_counter() - start)
+        else:
+            ret_val, is_plan = self.make_plan(param, fields, pretty, lang, msg, timer)
+        if self.plan_cache is not None and is_plan and self.content.is_loaded():
+            self.plan_cache.put(key, ret_val)
 
-        # step 4: process any planner errors
+        self.stage_stats.record(timer, param.otp_url_params)
+        return ret_val
+
+    def make_key(self, param, *extra):
+        """ :return: exact key for a trip request (see PlanCache.make_key), for both the plan cache and coalescing
+            note: made from a copy of param, with the banned routes call_otp() will add
+        """
+        param = param.clone()
+        param.banned_routes = self.cancelled_routes
+        return PlanCache.make_key(param, *extra)
+
+    def plan_trips(self, trips, concurrency=8):
+        """ plan a batch of trips, with at most 'concurrency' of them being planned (e.g., calling OTP) at a time
+            :param trips: iterable of (id, request) tuples, where the request is anything plan_trip() takes
+            :return: generator of (id, plan json) tuples, in the order the plans complete ... errors planning a
+                     trip are returned as that trip's (error) json, rather than stopping the batch
+        """
+        trips = iter(trips)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = {}
+            while True:
+                # step 1: keep up to 'concurrency' trips in flight (pulling lazily from the trips iterable)
+                for trip_id, request in trips:
+                    pending[executor.submit(self.plan_trip, request)] = trip_id
+                    if len(pending) >= concurrency:
+                        break
+                if not pending:
+                    break
+
+                # step 2: hand back each plan as it finishes
+                done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    trip_id = pending.pop(f)
+                    try:
+                        ret_val = f.result()
+                    except Exception as e:
+                        log.warning("batch trip {} failed: {}".format(trip_id, e))
+                        ret_val = json_utils.json_repr({'error': {'id': 500, 'msg': str(e)}})
+                    yield trip_id, ret_val
+
+    def make_plan(self, param, fields, pretty=False, lang=None, msg=None, timer=None):
+        """ call OTP, and parse its response into our OTT plan json
+            :return: tuple of the json string, and whether that json is a plan (True) or an error (False)
+        """
+        is_plan = False
+        if timer is None:
+            timer = StageTimer()
+
+        # step 1: call the trip planner...
+        with timer.stage('otp'):
+            f = self.call_otp(param, msg)
+        with timer.stage('otp_json'):
+            j = json.loads(f) if f else None
+
+        # step 2: process any planner errors
         if j is None:
             pass
             # TODO -- trip error or plan?
 
-        # step 5: parse the OTP trip plan into OTT format
+        # step 3: parse the OTP trip plan into OTT format
         ret_val = {}
         try:
-            plan = otp_to_ott.Plan(jsn=j['plan'], params=param, fares=self.fares)
-            ret_val['plan'] = plan
+            with timer.stage('plan'):
+                plan = otp_to_ott.Plan(jsn=j['plan'], params=param, fares=self.fares, fields=fields)
+                ret_val['plan'] = plan.to_dict()
 
             if self.adverts:
                 m = plan.dominant_transit_mode()
-                l = html_utils.get_lang(request)
-                ret_val['adverts'] = self.adverts.query(m, l)
+                ret_val['adverts'] = self.adverts.query(m, lang)
+            is_plan = True
         except Exception as e:
             try:
-                ret_val['error'] = otp_to_ott.Error(j['error'], param)
+                ret_val['error'] = otp_to_ott.Error(j['error'], param).to_dict()
             except:
                 log.warning("I think we had a problem parsing the JSON from OTP ... see exception below:")
                 log.warning(e)
 
-        ret_val = json_utils.json_repr(ret_val, pretty or param.pretty_output())
+        with timer.stage('json'):
+            ret_val = json_utils.json_repr(ret_val, pretty)
+        return ret_val, is_plan
+
+    def stream_trip(self, out, request=None):
+        """
+        streaming version of plan_trip(), which writes the OTT json response to the file-like 'out' object
+        NOTE: the OTP response is parsed and written one itinerary at a time (see otp_stream.py), so peak memory
+              is (roughly) that of a single itinerary, rather than the entire plan's object tree
+        """
+        for chunk in self.iter_trip(request):
+            out.write(chunk)
+
+    def iter_trip(self, request=None, pretty=False, timer=None):
+        """
+        streaming version of plan_trip() (e.g., for a streaming http response) ... the geocoding and OTP call happen
+        here, while the returned generator builds and serializes the OTT json one itinerary at a time as it's read
+        NOTE: the plan cache and request coalescing are bypassed (there's no complete response to share)
+        NOTE: an error part way through the plan ends the stream with the json closed and an 'error' object added
+        NOTE: pretty output can't be indented a chunk at a time, so a pretty plan is built whole (a single chunk)
+
+        :param timer: optional StageTimer, which gets the time spent in each stage ... the 'plan' stage (building and
+                      serializing the itineraries) is only added once the generator is done
+        """
+        from ott.otp_client import otp_stream
+        if timer is None:
+            timer = StageTimer()
+
+        # step 1: parse params, geocode and call OTP (all before the first chunk, as with plan_trip())
+        with timer.stage('params'):
+            param = TripParamParser(request)
+            fields = otp_to_ott.Fields.from_param_parser(param)
+            pretty = pretty or param.pretty_output()
+            lang = html_utils.get_lang(request)
+        with timer.stage('geocode'):
+            msg = self.geocode(param)
+        with timer.stage('otp'):
+            f = self.call_otp(param, msg)
+
+        # step 2: scan (but don't decode) the OTP response
+        reader = None
+        with timer.stage('otp_json'):
+            try:
+                reader = otp_stream.PlanReader(f)
+            except Exception as e:
+                log.warning("I think we had a problem scanning the JSON from OTP ... see exception below:")
+                log.warning(e)
+
+        # step 3: the generator of OTT json chunks
+        ret_val = self._iter_trip_json(otp_stream, reader, param, fields, lang, timer)
+        if pretty:
+            ret_val = iter([json_utils.json_repr(json.loads(''.join(ret_val)), pretty)])
+        return ret_val
+
+    def _iter_trip_json(self, otp_stream, reader, param, fields, lang, timer):
+        closer = otp_stream.JsonCloser()
+        start = time.perf_counter()
+        try:
+            if reader and reader.has_plan():
+                modes = []
+                prefix = '{"plan": '
+                for chunk in otp_stream.iter_plan(reader, params=param, fares=self.fares, fields=fields, modes=modes):
+                    yield closer.add(prefix + chunk)
+                    prefix = ''
+                if self.adverts:
+                    adverts = json_utils.json_repr(self.adverts.query(modes[0] if modes else 'rail', lang))
+                    yield closer.add(', "adverts": ' + adverts)
+                yield closer.add('}')
+            else:
+                ret_val = {}
+                try:
+                    ret_val['error'] = otp_to_ott.Error(reader.get_error(), param).to_dict()
+                except Exception as e:
+                    log.warning(e)
+                yield closer.add(json_utils.json_repr(ret_val))
+        except Exception as e:
+            log.warning("streamed plan failed part way through: {}".format(e))
+            yield closer.close({'id': 500, 'msg': str(e)})
+        finally:
+            timer.add('plan', time.perf_counter() - start)
+            self.stage_stats.record(timer, param.otp_url_params)
+
+    def call_otp(self, param, msg=None):
+        """ call the OTP trip planner with our (geocoded) params ... :return: the raw OTP response text """
+        otp_params = param
+        otp_params.banned_routes = self.cancelled_routes
+        if otp_params.is_latest():
+            # if we have Arr=L (latest trip), we need to increase the date by 1 day, since LATEST
+            # trip is essentially an ArriveBy 1:30am trip
+            if msg == 'chk':
+                otp_utils.kill()
+            otp_params = param.clone()
+            otp_params.date_offset(day_offset=1)
+
+        query = otp_params.otp_url_params()
+        try:
+            ret_val = self.otp.get_text(query)
+        except Exception as e:
+            log.warning("OTP call ?{} failed: {}".format(query, e))
+            ret_val = None
         return ret_val
 
     def geocode(self, param):
@@ -116,21 +331,24 @@ class TripPlanner(object):
         """
         ret_val = None
 
-        # step 2: get your origin
+        # step 1: which of the origin and destination need geocoding (e.g., don't have a valid ::LatLon)?
         f = param.get_from()
-        if not param.has_valid_coord(f):
-            # step 2b: geocode the origin if you don't have a valid ::LatLon
-            f = param.strip_coord(f)
-            f = self.geo.geostr(f)
-            param.frm = f
-
-        # step 3: get your destination
         t = param.get_to()
-        if not param.has_valid_coord(t):
-            # step 3b: geocode the destination if you don't have a valid ::LatLon
-            t = param.strip_coord(t)
-            t = self.geo.geostr(t)
-            param.to = t
+        geo_frm = not param.has_valid_coord(f)
+        geo_to = not param.has_valid_coord(t)
+
+        # step 2: geocode the origin in the background, when we also need to geocode the destination
+        frm_future = None
+        if geo_frm and geo_to:
+            frm_future = self.geo_pool.submit(self.geo.geostr, param.strip_coord(f))
+        elif geo_frm:
+            param.frm = self.geo.geostr(param.strip_coord(f))
+
+        # step 3: geocode the destination (on this thread), then wait for any origin geocode
+        if geo_to:
+            param.to = self.geo.geostr(param.strip_coord(t))
+        if frm_future:
+            param.frm = frm_future.result()
 
         # step 4: check test scenario
         if ret_val is None and "pdx" in param.get('to') and "ohsu" in param.get('from') and "1:11" in param.get('time'):
@@ -139,6 +357,27 @@ class TripPlanner(object):
         return ret_val
 
 
+def parse_batch(text):
+    """ parse a batch of trip requests (for TripPlanner.plan_trips) from either a json list, or ndjson lines
+        each trip is either a url query string, or an object of trip params, with an optional 'id':
+          [{"id": "a", "fromPlace": "PDX", "toPlace": "ZOO"}, {"id": "b", "query": "fromPlace=PDX&toPlace=OHSU"}]
+        :return: generator of (id, query string) tuples ... the id defaults to the trip's index in the batch
+    """
+    text = text.strip()
+    if text.startswith('['):
+        trips = json.loads(text)
+    else:
+        trips = (json.loads(l) for l in text.splitlines() if l.strip())
+
+    for i, t in enumerate(trips):
+        trip_id = i
+        if isinstance(t, dict):
+            t = dict(t)
+            trip_id = t.pop('id', i)
+            t = t.pop('query', None) or urlencode(t)
+        yield trip_id, t
+
+
 def main():
     argv = sys.argv
     pretty = 'pretty' in argv or 'p' in argv
@@ -150,8 +389,12 @@ def main():
     else:
         tp = TripPlanner()
 
-    plan = tp.plan_trip(argv[1], pretty)
-    print(plan)
+    if 'stream' in argv:
+        tp.stream_trip(sys.stdout, argv[1])
+        print("")
+    else:
+        plan = tp.plan_trip(argv[1], pretty)
+        print(plan)
 
 
 if __name__ == '__main__':
@@ -30,6 +30,7 @@ requires = [
 
 extras_require = dict(
     dev=[],
+    numpy=['numpy'],  # optional: vectorized elevation profiles (see elevation.py)
 )
 
 setup(
@@ -65,7 +66,13 @@ setup(
 
         [console_scripts]
         parse_otp_json = ott.otp_client.otp_to_ott:main
+        stream_otp_json = ott.otp_client.otp_stream:main
+        plan_bench = ott.otp_client.bench.plan_bench:main
+        stub_otp_server = ott.otp_client.bench.stub_server:main
+        replay_load = ott.otp_client.bench.replay:main
         trip_planner = ott.otp_client.trip_planner:main
+        od_matrix = ott.otp_client.od_matrix:main
         ti = ott.otp_client.transit_index.base:main
+        ti_export = ott.otp_client.transit_index.export:main
     """,
 )